@@ -1,37 +1,96 @@
+import contextvars
+import io
 import json
 import logging
+import os
 import shutil
-from itertools import combinations
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from subprocess import PIPE, Popen
 
 import numpy as np
 import pandas as pd
-from Bio.Seq import Seq
+from tabulate import tabulate
 
-from dissectBCL.misc import hamming, joinLis, lenMask
+from dissectBCL.misc import hammingMatrix, joinLis, lenMask
 
 
-def misMatcher(P7s, P5s, sequencer):
+def misMatcher(P7s, P5s, sequencer, returnCollisions=False):
     """
     return the number of mismatches allowed in demux.
     [0, 1 or 2]
 
     if P7s and P5s are both empty, return an empty dictionary.
+    Every index first gets the threshold its own minimal distance allows.
+    For dual indices these are then raised as far as the (P7, P5) pairs
+    allow, see jointMismatch.
+    With returnCollisions, also return the pairs of barcodes that set the
+    threshold (those at the minimal distance) per index, as
+    {key: [(barcode, barcode, distance), ...]}.
     """
     mmDic = {}
+    collisions = {}
+    pairDists = {}
     for i, ix_list in enumerate((P7s, P5s)):
-        hammings = []
-        if not ix_list.empty and not ix_list.isnull().all():
-            for comb in combinations(ix_list, 2):
-                hammings.append(hamming(comb[0], comb[1]))
-                if sequencer == "aviti":
-                    barcode_mm = f"I{i + 1}MismatchThreshold"
-                else:
-                    barcode_mm = f"BarcodeMismatchesIndex{i + 1}"
-                mmDic[barcode_mm] = hamming2Mismatch(min(hammings))
+        if ix_list.empty or ix_list.isnull().all() or len(ix_list) < 2:
+            continue
+        if sequencer == "aviti":
+            barcode_mm = f"I{i + 1}MismatchThreshold"
+        else:
+            barcode_mm = f"BarcodeMismatchesIndex{i + 1}"
+        barcodes = list(ix_list)
+        dist = hammingMatrix(barcodes)
+        rows, cols = np.triu_indices(len(barcodes), k=1)
+        pairDist = dist[rows, cols]
+        pairDists[barcode_mm] = pairDist
+        minVal = int(pairDist.min())
+        mmDic[barcode_mm] = hamming2Mismatch(minVal)
+        collisions[barcode_mm] = [
+            (barcodes[r], barcodes[c], minVal)
+            for r, c in zip(
+                rows[pairDist == minVal], cols[pairDist == minVal], strict=True
+            )
+        ]
+    if len(mmDic) == 2 and len(P7s) == len(P5s):
+        (k7, k5), (d7, d5) = mmDic.keys(), pairDists.values()
+        perIndex = (mmDic[k7], mmDic[k5])
+        mmDic[k7], mmDic[k5] = jointMismatch(d7, d5, perIndex)
+        if (mmDic[k7], mmDic[k5]) != perIndex:
+            logging.info(
+                f"Demux - misMatcher - {k7}, {k5} raised from {perIndex[0]}, {perIndex[1]} "
+                f"to {mmDic[k7]}, {mmDic[k5]}: no two samples are within reach on both indices."
+            )
+    if returnCollisions:
+        return mmDic, collisions
     return mmDic
 
 
+def jointMismatch(d7, d5, start=(0, 0)):
+    """
+    Highest (P7, P5) mismatch setting that keeps every sample pair apart.
+    d7 and d5 are the P7 and P5 distances of the same sample pairs.
+    A read can only be assigned to both samples of a pair if it is within
+    mm1 of both P7s and within mm2 of both P5s, i.e. if d7 <= 2*mm1 and
+    d5 <= 2*mm2. Two samples that are close on P7 but far apart on P5 are
+    thus no reason to drop mm1 to 0.
+    Only settings at least as high as start (the per-index thresholds) are
+    considered; of the safe ones the highest total wins, then the most
+    balanced one, then the one with the higher P7 mismatch.
+    """
+    best = start
+    for mm1 in range(start[0], 3):
+        for mm2 in range(start[1], 3):
+            if np.any((d7 <= 2 * mm1) & (d5 <= 2 * mm2)):
+                continue
+            rank = (mm1 + mm2, min(mm1, mm2), mm1)
+            if rank > (sum(best), min(best), best[0]):
+                best = (mm1, mm2)
+    return best
+
+
 def hamming2Mismatch(minVal):
     if minVal > 2 and minVal <= 4:
         return 1
@@ -256,159 +315,93 @@ def detMask(seqRecipe, sampleSheetDF, outputFolder, sequencer):
         logging.info("parkour failure probably, revert back to what we can.")
 
 
-def writeDemuxSheet(demuxOut, ssDic, laneSplitStatus):
-    demuxSheetLines = []
-    # Header first.
-    demuxSheetLines.append("[Header],,,")
-    demuxSheetLines.append("FileFormatVersion,2,,")
-    demuxSheetLines.append(",,,")
-    demuxSheetLines.append("[BCLConvert_Settings],,,")
-    if "mismatch" in ssDic:
-        for i in (1, 2):
-            bc_str = f"BarcodeMismatchesIndex{i}"
-            if i == 2 and not ssDic["dualIx"]:
-                continue
-            if bc_str in ssDic["mismatch"]:
-                demuxSheetLines.append(
-                    "{},{},,".format(bc_str, ssDic["mismatch"][bc_str])
-                )
-
-            # TODO do we want this behavior?
-            # log.warning("dualIx set, but no mismatch returned. Overriding.")
-            # ssDic['dualIx'] = False
-
-    demuxSheetLines.append("OverrideCycles,{},,".format(ssDic["mask"]))
-    if len(ssDic["convertOpts"]) > 0:
-        for opts in ssDic["convertOpts"]:
-            demuxSheetLines.append(opts)
-    demuxSheetLines.append(",,,")
-
-    # replace nans with empty string
-    ssdf_towrite = ssDic["sampleSheet"].fillna("")
-
-    # Todo - deduplicate this mess.
-    if ssDic["dualIx"]:
-        demuxSheetLines.append("[BCLConvert_Data],,,,,,")
-        if laneSplitStatus:
-            demuxSheetLines.append("Lane,Sample_ID,index,index2,Sample_Project")
-            for _index, row in ssdf_towrite.iterrows():
-                demuxSheetLines.append(
-                    joinLis(
-                        [
-                            row["Lane"],
-                            row["Sample_ID"],
-                            row["index"],
-                            row["index2"],
-                            row["Sample_Project"],
-                        ],
-                        joinStr=",",
-                    )
-                )
-        else:
-            demuxSheetLines.append("Sample_ID,index,index2,Sample_Project")
-            for _index, row in ssdf_towrite.iterrows():
-                demuxSheetLines.append(
-                    joinLis(
-                        [
-                            row["Sample_ID"],
-                            row["index"],
-                            row["index2"],
-                            row["Sample_Project"],
-                        ],
-                        joinStr=",",
-                    )
-                )
-    else:
-        demuxSheetLines.append("[BCLConvert_Data],,,,,")
-        if laneSplitStatus:
-            demuxSheetLines.append("Lane,Sample_ID,index,Sample_Project")
-            for _index, row in ssdf_towrite.iterrows():
-                demuxSheetLines.append(
-                    joinLis(
-                        [
-                            row["Lane"],
-                            row["Sample_ID"],
-                            row["index"],
-                            row["Sample_Project"],
-                        ],
-                        joinStr=",",
-                    )
-                )
-        else:
-            demuxSheetLines.append("Sample_ID,index,Sample_Project")
-            for _index, row in ssdf_towrite.iterrows():
-                demuxSheetLines.append(
-                    joinLis(
-                        [row["Sample_ID"], row["index"], row["Sample_Project"]],
-                        joinStr=",",
-                    )
-                )
-    with open(demuxOut, "w") as f:
-        for line in demuxSheetLines:
-            f.write(f"{line}\n")
+# Layout of the demux sheet per platform: bcl-convert's samplesheet for
+# illumina, bases2fastq's RunManifest.csv for aviti.
+# data: the data section header for (single index, dual index).
+# laneSplitOnly: a column that is only written if we split per lane.
+DEMUXSHEETSCHEMA = {
+    "illumina": {
+        "settings": [
+            "[Header],,,",
+            "FileFormatVersion,2,,",
+            ",,,",
+            "[BCLConvert_Settings],,,",
+        ],
+        "mismatch": "BarcodeMismatchesIndex{}",
+        "pad": ",,",
+        "settingsEnd": [",,,"],
+        "data": ("[BCLConvert_Data],,,,,", "[BCLConvert_Data],,,,,,"),
+        "columns": ["Lane", "Sample_ID", "index", "index2", "Sample_Project"],
+        "index2": "index2",
+        "laneSplitOnly": "Lane",
+    },
+    "aviti": {
+        "settings": ["[SETTINGS],,,,", "SettingName,Value,Lane,,"],
+        "mismatch": "I{}MismatchThreshold",
+        "pad": ",,,",
+        "settingsEnd": [],
+        "data": ("[SAMPLES],,,,", "[SAMPLES],,,,"),
+        "columns": ["SampleName", "Index1", "Index2", "Lane", "Project"],
+        "index2": "Index2",
+        "laneSplitOnly": None,
+    },
+}
 
 
-def writeDemuxSheetAviti(demuxOut, ssDic, laneSplitStatus):
-    demuxSheetLines = []
-    # Header first.
-    demuxSheetLines.append("[SETTINGS],,,,")
-    demuxSheetLines.append("SettingName,Value,Lane,,")
+def writeDemuxSheet(demuxOut, ssDic, laneSplitStatus, sequencer="illumina"):
+    """
+    Write the demux sheet (bcl-convert samplesheet, or the RunManifest.csv
+    for bases2fastq when sequencer == 'aviti') for one output lane.
+    Rows are formatted column-wise rather than per row, and the file is
+    written to a temporary file first and moved in place, so a crash never
+    leaves a half-written sheet behind (it would be reused on a rerun).
+    """
+    schema = DEMUXSHEETSCHEMA[sequencer]
+    demuxSheetLines = list(schema["settings"])
     if "mismatch" in ssDic:
         for i in (1, 2):
-            bc_str = f"I{i}MismatchThreshold"
+            bc_str = schema["mismatch"].format(i)
             if i == 2 and not ssDic["dualIx"]:
                 continue
             if bc_str in ssDic["mismatch"]:
                 demuxSheetLines.append(
-                    "{},{},,,".format(bc_str, ssDic["mismatch"][bc_str])
+                    f"{bc_str},{ssDic['mismatch'][bc_str]}{schema['pad']}"
                 )
+    # illumina has one OverrideCycles string, aviti a mask per read.
+    mask = ssDic["mask"]
+    if not isinstance(mask, dict):
+        mask = {"OverrideCycles": mask}
+    for k, v in mask.items():
+        demuxSheetLines.append(f"{k},{v}{schema['pad']}")
+    demuxSheetLines.extend(ssDic["convertOpts"])
+    demuxSheetLines.extend(schema["settingsEnd"])
 
-            # TODO do we want this behavior?
-            # log.warning("dualIx set, but no mismatch returned. Overriding.")
-            # ssDic['dualIx'] = False
-
-    for k, v in ssDic["mask"].items():
-        demuxSheetLines.append(f"{k},{v},,,")
-
-    if len(ssDic["convertOpts"]) > 0:
-        for opts in ssDic["convertOpts"]:
-            demuxSheetLines.append(opts)
-
-    # replace nans with empty string
-    ssdf_towrite = ssDic["sampleSheet"].fillna("")
-
-    # Todo - deduplicate this mess.
-    if ssDic["dualIx"]:
-        demuxSheetLines.append("[SAMPLES],,,,")
-        demuxSheetLines.append("SampleName,Index1,Index2,Lane,Project")
-        for _index, row in ssdf_towrite.iterrows():
-            demuxSheetLines.append(
-                joinLis(
-                    [
-                        row["SampleName"],
-                        row["Index1"],
-                        row["Index2"],
-                        row["Lane"],
-                        row["Project"],
-                    ],
-                    joinStr=",",
-                )
-            )
+    columns = [
+        c
+        for c in schema["columns"]
+        if (c != schema["index2"] or ssDic["dualIx"])
+        and (c != schema["laneSplitOnly"] or laneSplitStatus)
+    ]
+    demuxSheetLines.append(schema["data"][int(bool(ssDic["dualIx"]))])
+    demuxSheetLines.append(",".join(columns))
 
-    else:
-        demuxSheetLines.append("[SAMPLES],,,,")
-        demuxSheetLines.append("SampleName,Index1,Lane,Project")
-        for _index, row in ssdf_towrite.iterrows():
-            demuxSheetLines.append(
-                joinLis(
-                    [row["SampleName"], row["Index1"], row["Lane"], row["Project"]],
-                    joinStr=",",
-                )
-            )
+    buf = io.StringIO()
+    for line in demuxSheetLines:
+        buf.write(f"{line}\n")
+    # replace nans with empty string, str() every value like joinLis did.
+    ssdf_towrite = ssDic["sampleSheet"][columns].fillna("")
+    if not ssdf_towrite.empty:
+        rows = ssdf_towrite[columns[0]].astype(str)
+        for c in columns[1:]:
+            rows = rows + "," + ssdf_towrite[c].astype(str)
+        buf.write("\n".join(rows))
+        buf.write("\n")
 
-    with open(demuxOut, "w") as f:
-        for line in demuxSheetLines:
-            f.write(f"{line}\n")
+    demuxOut = Path(demuxOut)
+    tmpOut = demuxOut.with_name(f".{demuxOut.name}.{os.getpid()}.tmp")
+    with open(tmpOut, "w") as f:
+        f.write(buf.getvalue())
+    os.replace(tmpOut, demuxOut)
 
 
 def readDemuxSheet(demuxSheet, what="all"):
@@ -453,91 +446,89 @@ def readDemuxSheet(demuxSheet, what="all"):
         return df
 
 
+def _readAvitiStats(statsFile):
+    """
+    (Sample_ID, meanQ, percQ30, gotDepth) from a bases2fastq
+    <sample>_stats.json, or None if bases2fastq didn't write it.
+    """
+    try:
+        with open(statsFile) as f:
+            stats = json.load(f)
+    except FileNotFoundError:
+        return None
+    _qsm = stats["QualityScoreMean"]
+    _q30 = stats["PercentQ30"]
+    # Single-end or paired-end, the means cover all reads.
+    reads = range(1, len(stats["Reads"]) + 1)
+    return (
+        statsFile.name.replace("_stats.json", ""),
+        ",".join(f"{r}:{_qsm}" for r in reads),
+        ",".join(f"{r}:{_q30}" for r in reads),
+        int(stats["NumPolonies"]),
+    )
+
+
 def parseStats(outputFolder, ssdf, mode="illumina") -> pd.DataFrame:
+    """
+    Add meanQ, percQ30 ('<read>:<value>,...') and gotDepth per sample to
+    the sampleSheet. Illumina values are averaged over lanes.
+    """
     if mode == "illumina":
         QCmetFile = outputFolder / "Reports" / "Quality_Metrics.csv"
         DemuxmetFile = outputFolder / "Reports" / "Demultiplex_Stats.csv"
         QCdf = pd.read_csv(QCmetFile, sep=",", header=0)
         muxdf = pd.read_csv(DemuxmetFile, sep=",", header=0)
-        QCmetDic = {}
-        for _index, row in QCdf.iterrows():
-            sampleID = row["SampleID"]
-            readnum = str(row["ReadNumber"])
-            if sampleID not in QCmetDic:
-                QCmetDic[sampleID] = {}
-            if readnum not in QCmetDic[sampleID]:
-                QCmetDic[sampleID][readnum] = [
-                    float(row["Mean Quality Score (PF)"]),
-                    int(float(row["% Q30"]) * 100),
-                ]
-            else:
-                new_QS = (
-                    QCmetDic[sampleID][readnum][0]
-                    + float(row["Mean Quality Score (PF)"])
-                ) / 2
-                new_Q30 = (
-                    QCmetDic[sampleID][readnum][1] + float(row["% Q30"]) * 100
-                ) / 2
-                QCmetDic[sampleID][readnum] = [new_QS, new_Q30]
-        muxDic = {}
-        for _index, row in muxdf.iterrows():
-            sampleID = row["SampleID"]
-            if sampleID not in muxDic:
-                muxDic[sampleID] = int(row["# Reads"])
-            else:
-                muxDic[sampleID] += int(row["# Reads"])
-        MetrixDic = {}
-        for ID in QCmetDic:
-            QCstr = ""
-            Perc30str = ""
-            for read in QCmetDic[ID]:
-                QCstr += f"{read}:{round(QCmetDic[ID][read][0], 2)},"
-                Perc30str += f"{read}:{round(QCmetDic[ID][read][1], 2)},"
-            QCstr = QCstr[:-1]
-            Perc30str = Perc30str[:-1]
-            MetrixDic[ID] = {
-                "meanQ": QCstr,
-                "percQ30": Perc30str,
-                "gotDepth": int(muxDic[ID]),
-            }
-        MetrixDF = pd.DataFrame(MetrixDic).T
-        MetrixDF["Sample_ID"] = MetrixDF.index
-        # left join to only get samples already present
-        newDF = pd.merge(ssdf, MetrixDF, on="Sample_ID", how="left")
-        newDF = newDF[newDF["Sample_ID"] != "Undetermined"]
-        return newDF
+        QCdf["ReadNumber"] = QCdf["ReadNumber"].astype(str)
+        QCdf["Q30"] = QCdf["% Q30"].astype(float) * 100
+        # One row per sample & read, in the order they're reported.
+        QCdf = (
+            QCdf.groupby(["SampleID", "ReadNumber"], sort=False)
+            .agg(
+                meanQ=("Mean Quality Score (PF)", "mean"),
+                percQ30=("Q30", "mean"),
+            )
+            .round(2)
+            .reset_index()
+        )
+        for col in ("meanQ", "percQ30"):
+            QCdf[col] = QCdf["ReadNumber"] + ":" + QCdf[col].astype(str)
+        MetrixDF = QCdf.groupby("SampleID", sort=False).agg(
+            {"meanQ": ",".join, "percQ30": ",".join}
+        )
+        # Keep depths python ints (and NaN for samples without reads).
+        MetrixDF["gotDepth"] = (
+            muxdf.groupby("SampleID")["# Reads"].sum().astype(int).astype(object)
+        )
+        MetrixDF = MetrixDF.rename_axis("Sample_ID").reset_index()
     elif mode == "aviti":
         # After bases2fq, samples are organized under Samples/project/sampleID
         # In that directory is a stats.json file we can use to get statistics.
-        for samplestat in (outputFolder).rglob("*_stats.json"):
-            with open(samplestat) as f:
-                stats = json.load(f)
-            sampleID = samplestat.name.replace("_stats.json", "")
-
-            if sampleID not in ssdf["Sample_ID"].values:
-                logging.warning(f"Sample {sampleID} not found in sampleSheet.")
-                continue
-            _qsm = stats["QualityScoreMean"]
-            _q30 = stats["PercentQ30"]
-            _depth = stats["NumPolonies"]
-            match len(stats["Reads"]):
-                case 1:
-                    # Single-end
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "meanQ"] = f"1:{_qsm}"
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "percQ30"] = f"1:{_q30}"
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "gotDepth"] = int(_depth)
-                case 2:
-                    # paired-end
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "meanQ"] = (
-                        f"1:{_qsm},2:{_qsm}"
-                    )
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "percQ30"] = (
-                        f"1:{_q30},2:{_q30}"
-                    )
-                    ssdf.loc[ssdf["Sample_ID"] == sampleID, "gotDepth"] = int(_depth)
-        return ssdf
+        samples = ssdf[["Project", "SampleName"]].dropna().drop_duplicates()
+        statsFiles = [
+            outputFolder / "Samples" / project / sample / f"{sample}_stats.json"
+            for project, sample in samples.itertuples(index=False)
+        ]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            stats = list(pool.map(_readAvitiStats, statsFiles))
+        for statsFile, stat in zip(statsFiles, stats, strict=True):
+            if stat is None:
+                logging.warning(f"parseStats - {statsFile} not found.")
+        MetrixDF = pd.DataFrame(
+            [s for s in stats if s],
+            columns=["Sample_ID", "meanQ", "percQ30", "gotDepth"],
+        )
+        MetrixDF["gotDepth"] = MetrixDF["gotDepth"].astype(object)
     else:
         logging.error(f"parseStats - mode not supported: {mode}")
+        return None
+    # left join to only get samples already present
+    newDF = pd.merge(
+        ssdf.drop(columns=["meanQ", "percQ30", "gotDepth"], errors="ignore"),
+        MetrixDF,
+        on="Sample_ID",
+        how="left",
+    )
+    return newDF[newDF["Sample_ID"] != "Undetermined"]
 
 
 def compareDemuxSheet(ssDic, demuxSheet):
@@ -593,40 +584,45 @@ def matchingSheets(autodf, mandf):
         logging.warning("Demux - number of samples changed in overwritten demuxSheet !")
 
     dualIx = "index2" in list(mandf.columns)
+    ixCols = ["index", "index2"] if dualIx else ["index"]
 
-    for index, row in mandf.iterrows():
-        sample_ID = row["Sample_ID"]
-        index = row["index"]
-        if dualIx:
-            index2 = row["index2"]
-        # grab the index in the autodf.
-        pdIx = autodf[autodf["Sample_ID"] == sample_ID].index
-        if dualIx:
-            if autodf.loc[pdIx, "index"].values != index:
-                oriP7 = autodf.loc[pdIx, "index"].values[0]
-                logging.debug(f"Demux - Changing P7 {oriP7} to {index} for {sample_ID}")
-                autodf.loc[pdIx, "index"] = index
-                autodf.loc[pdIx, "I7_Index_ID"] = np.nan
-            if autodf.loc[pdIx, "index2"].values != index2:
-                oriP5 = autodf.loc[pdIx, "index2"].values[0]
-                logging.debug(
-                    f"Demux - Changing P5 {oriP5} to {index2} for {sample_ID}"
-                )
-                autodf.loc[pdIx, "index2"] = index2
-                autodf.loc[pdIx, "I5_Index_ID"] = np.nan
-        else:
-            # check index1, set index2 to na
-            if autodf.loc[pdIx, "index"].values != index:
-                oriP7 = autodf.loc[pdIx, "index"].values[0]
-                logging.debug(f"Demux - Changing P7 {oriP7} to {index} for {sample_ID}")
-                autodf.loc[pdIx, "index"] = index
-                # change type as well!
-                autodf.loc[pdIx, "I7_Index_ID"] = np.nan
-                # it's not dualIx, so set index2/I5_Index_ID to nan.
-                if "index2" in list(autodf.columns):
-                    autodf.loc[pdIx, "index2"] = np.nan
-                if "I5_Index_ID" in list(autodf.columns):
-                    autodf.loc[pdIx, "I5_Index_ID"] = np.nan
+    # Samples only in the manual sheet are ignored, for duplicates the last
+    # entry wins.
+    man = mandf[["Sample_ID"] + ixCols].drop_duplicates("Sample_ID", keep="last")
+    merged = autodf[["Sample_ID"]].merge(
+        man, on="Sample_ID", how="left", indicator=True, validate="many_to_one"
+    )
+    merged.index = autodf.index
+    matched = merged["_merge"] == "both"
+
+    changes = pd.DataFrame({"Sample_ID": autodf["Sample_ID"]})
+    changed = pd.Series(False, index=autodf.index)
+    for ix, ixID in (("index", "I7_Index_ID"), ("index2", "I5_Index_ID")):
+        if ix not in ixCols:
+            continue
+        old = autodf[ix] if ix in autodf.columns else pd.Series(np.nan, autodf.index)
+        new = merged[ix]
+        diff = matched & ~((old == new) | (old.isna() & new.isna()))
+        changes[ix] = old.fillna("").astype(str) + " -> " + new.fillna("").astype(str)
+        changes.loc[~diff, ix] = ""
+        changed |= diff
+        autodf.loc[diff, ix] = new[diff]
+        autodf.loc[diff, ixID] = np.nan
+        if not dualIx:
+            # it's not dualIx, so set index2/I5_Index_ID to nan.
+            for col in ("index2", "I5_Index_ID"):
+                if col in autodf.columns:
+                    autodf.loc[diff, col] = np.nan
+
+    if changed.any():
+        logging.info(
+            f"Demux - indices changed for {int(changed.sum())} sample(s) from the overwritten demuxSheet:\n"
+            + tabulate(
+                changes[changed].values.tolist(),
+                ["Sample_ID"] + [f"{ix} (old -> new)" for ix in ixCols],
+                disable_numparse=True,
+            )
+        )
     return autodf
 
 
@@ -650,9 +646,18 @@ def evalMiSeqP5(outPath, dualIx):
     )
     if not dualIx:  # Only RC P5 operations for now.
         return False
+    rcP5DemuxSheet(Path(outPath, "demuxSheet.csv"))
+    return True
+
+
+def rcP5DemuxSheet(demuxSheetPath):
+    """
+    Reverse complement all P5s (index2) in a demuxSheet. The original is
+    kept as demuxSheet.bak, which marks the outLane as P5RC'ed on reruns.
+    """
+    from Bio.Seq import Seq
 
     # Read demuxSheet
-    demuxSheetPath = Path(outPath, "demuxSheet.csv")
     demuxSheet = []
     with open(demuxSheetPath) as f:
         headStatus = True
@@ -675,4 +680,386 @@ def evalMiSeqP5(outPath, dualIx):
     with open(demuxSheetPath, "w") as f:
         for _l in demuxSheet:
             f.write(",".join(_l) + "\n")
-    return True
+
+
+def scoreP5Orientation(reportsDir, demuxdf):
+    """
+    Score the P5s of a demuxSheet in both orientations from the Reports of a
+    (quick, first tile only) bcl-convert run with that sheet.
+    Forward: reads assigned to samples (Demultiplex_Stats.csv).
+    Reverse complement: unknown barcodes (Top_Unknown_Barcodes.csv) that
+    are a sample's P7 combined with its RC'ed P5.
+    Returns (forward reads, RC reads).
+    """
+    from Bio.Seq import Seq
+
+    kbcDF = pd.read_csv(reportsDir / "Demultiplex_Stats.csv")
+    fwd = int(kbcDF.loc[kbcDF["SampleID"] != "Undetermined", "# Reads"].sum())
+    unknownFile = reportsDir / "Top_Unknown_Barcodes.csv"
+    if not unknownFile.exists():
+        return fwd, 0
+    ubcDF = pd.read_csv(unknownFile).dropna(subset=["index", "index2"])
+    pairs = demuxdf[["index", "index2"]].replace("", np.nan).dropna()
+    if pairs.empty:
+        return fwd, 0
+    p7len = int(pairs["index"].str.len().min())
+    p5len = int(pairs["index2"].str.len().min())
+    rcPairs = {
+        (p7[:p7len], str(Seq(p5).reverse_complement())[:p5len])
+        for p7, p5 in pairs.itertuples(index=False)
+    }
+    hits = [
+        (p7[:p7len], p5[:p5len]) in rcPairs
+        for p7, p5 in ubcDF[["index", "index2"]].itertuples(index=False)
+    ]
+    rc = int(ubcDF.loc[hits, "# Reads"].sum())
+    return fwd, rc
+
+
+def previewSummary(reportsDir, demuxdf, minAssigned=0.5, maxEmpty=0.1, topN=5):
+    """
+    Go / no-go for a preview (a bcl-convert run on a tile subset) from its
+    Demultiplex_Stats.csv and Top_Unknown_Barcodes.csv.
+    No-go if less than minAssigned of the reads are assigned to a sample,
+    or more than maxEmpty of the samples in the demuxSheet got no reads.
+    The topN unknown barcodes are listed with their share of all reads,
+    a missing sample or swapped index usually shows up there.
+    """
+    kbcDF = pd.read_csv(reportsDir / "Demultiplex_Stats.csv")
+    total = int(kbcDF["# Reads"].sum())
+    samples = list(demuxdf["Sample_ID"].unique())
+    perSample = (
+        kbcDF[kbcDF["SampleID"] != "Undetermined"]
+        .groupby("SampleID")["# Reads"]
+        .sum()
+        .reindex(samples, fill_value=0)
+    )
+    assigned = int(perSample.sum())
+    rate = assigned / total if total else 0.0
+    empty = list(perSample[perSample == 0].index)
+    topUnknown = []
+    unknownFile = reportsDir / "Top_Unknown_Barcodes.csv"
+    if unknownFile.exists() and total:
+        ubcDF = pd.read_csv(unknownFile).sort_values("# Reads", ascending=False)
+        ixCols = [c for c in ("index", "index2") if c in ubcDF.columns]
+        topUnknown = [
+            (
+                "+".join(str(ix) for ix in row[:-1] if pd.notna(ix)),
+                int(row[-1]),
+                round(row[-1] / total, 4),
+            )
+            for row in ubcDF[ixCols + ["# Reads"]].head(topN).itertuples(index=False)
+        ]
+    reasons = []
+    if total == 0:
+        reasons.append("no reads in the preview")
+    elif rate < minAssigned:
+        reasons.append(f"{rate:.0%} of reads assigned (minimum {minAssigned:.0%})")
+    if samples and len(empty) / len(samples) > maxEmpty:
+        reasons.append(
+            f"{len(empty)} of {len(samples)} samples without reads (maximum {maxEmpty:.0%})"
+        )
+    return {
+        "reads": total,
+        "assigned": assigned,
+        "assignmentRate": round(rate, 4),
+        "emptySamples": empty,
+        "topUnknown": topUnknown,
+        "go": not reasons,
+        "reasons": reasons,
+    }
+
+
+UNKNOWNVARIANTS = ("P5 RC", "P7 RC", "P7 and P5 RC", "P7/P5 swapped")
+_COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def _rc(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _barcodeVariants(p7, p5):
+    """
+    The sample sheet mistakes an unknown barcode could stem from.
+    Single index samples can only have their P7 RC'ed.
+    """
+    if not p5:
+        return {"P7 RC": (_rc(p7), "")}
+    return {
+        "P5 RC": (p7, _rc(p5)),
+        "P7 RC": (_rc(p7), p5),
+        "P7 and P5 RC": (_rc(p7), _rc(p5)),
+        "P7/P5 swapped": (p5, p7),
+    }
+
+
+def _sheetBarcodes(sampleDF):
+    """
+    (Sample_ID, P7, P5) of the indexed samples in a sample sheet. Samples
+    without a P7 are skipped, a missing P5 (single index sheets don't have
+    an index2 column) is "".
+    """
+    cols = sampleDF.reindex(columns=["Sample_ID", "index", "index2"])
+    for sample, p7, p5 in cols.itertuples(index=False):
+        if not isinstance(p7, str) or not p7:
+            continue
+        yield sample, p7, p5 if isinstance(p5, str) else ""
+
+
+def barcodeNeighbours(barcode, maxMismatch):
+    """
+    All sequences within maxMismatch substitutions of barcode, with their
+    distance: {sequence: mismatches}.
+    """
+    found = {barcode: 0}
+    frontier = [barcode]
+    for mm in range(1, maxMismatch + 1):
+        nextFrontier = []
+        for seq in frontier:
+            for pos, base in enumerate(seq):
+                for alt in "ACGTN":
+                    if alt == base:
+                        continue
+                    variant = seq[:pos] + alt + seq[pos + 1 :]
+                    if variant not in found:
+                        found[variant] = mm
+                        nextFrontier.append(variant)
+        frontier = nextFrontier
+    return found
+
+
+def diagnoseUnknownBarcodes(
+    unknownDF, sampleDF, undetermined, otherLanes=None, maxMismatch=1
+):
+    """
+    Look up every unknown barcode in all variants of the sample sheet:
+    P5 RC, P7 RC, both RC, P7/P5 swapped, and the samples of the other
+    outLanes as they are.
+    unknownDF: index, index2 (optional) and '# Reads' columns.
+    sampleDF: Sample_ID, index, index2 of this outLane.
+    otherLanes: {outLane: sampleDF} for the other outLanes of the flowcell.
+    The variants are indexed together with all their neighbours up to
+    maxMismatch substitutions, so every unknown barcode is a single
+    lookup. Barcodes that hit different samples at their lowest distance
+    are ambiguous and left alone.
+    Per sample, the variant that recovers the most reads is suggested.
+    Returns a dictionary with the hits, the suggested corrections, the
+    recovered reads and the fraction of undetermined reads recovered.
+    """
+    candidates = []
+    for sample, p7, p5 in _sheetBarcodes(sampleDF):
+        for variant, (v7, v5) in _barcodeVariants(p7, p5).items():
+            candidates.append((sample, variant, v7, v5))
+    for outLane, laneDF in (otherLanes or {}).items():
+        for sample, p7, p5 in _sheetBarcodes(laneDF):
+            candidates.append((sample, f"from {outLane}", p7, p5))
+
+    # Index per (P7 length, P5 length), unknown barcodes are truncated to
+    # the lengths in the sheet before the lookup.
+    lookup = {}
+    for ci, (_sample, _variant, v7, v5) in enumerate(candidates):
+        table = lookup.setdefault((len(v7), len(v5)), {})
+        for seq, mm in barcodeNeighbours(v7 + v5, maxMismatch).items():
+            table.setdefault(seq, {}).setdefault(mm, []).append(ci)
+
+    ixCols = [c for c in ("index", "index2") if c in unknownDF.columns]
+    hits = []
+    for row in unknownDF[ixCols + ["# Reads"]].itertuples(index=False):
+        u7 = row[0] if isinstance(row[0], str) else ""
+        u5 = row[1] if len(ixCols) == 2 and isinstance(row[1], str) else ""
+        best = None
+        for (l7, l5), table in lookup.items():
+            if len(u7) < l7 or len(u5) < l5:
+                continue
+            found = table.get(u7[:l7] + u5[:l5])
+            if not found:
+                continue
+            mm = min(found)
+            if best is None or mm < best[0]:
+                best = (mm, list(found[mm]))
+            elif mm == best[0]:
+                best[1].extend(found[mm])
+        if best is None:
+            continue
+        mm, cis = best
+        if len({candidates[ci][0] for ci in cis}) > 1:
+            continue
+        sample, variant, v7, v5 = candidates[cis[0]]
+        hits.append(
+            (
+                joinLis([u7, u5] if u5 else [u7], joinStr="+"),
+                int(row[-1]),
+                sample,
+                variant,
+                mm,
+                v7,
+                v5,
+            )
+        )
+
+    hitDF = pd.DataFrame(
+        hits,
+        columns=[
+            "barcode",
+            "reads",
+            "Sample_ID",
+            "variant",
+            "mismatches",
+            "index",
+            "index2",
+        ],
+    )
+    perVariant = (
+        hitDF.groupby(["Sample_ID", "variant", "index", "index2"], sort=False)["reads"]
+        .sum()
+        .reset_index()
+        .sort_values("reads", ascending=False, kind="stable")
+    )
+    corrections = perVariant.drop_duplicates("Sample_ID").reset_index(drop=True)
+    recovered = int(corrections["reads"].sum())
+    return {
+        "hits": hitDF,
+        "corrections": corrections,
+        "recovered": recovered,
+        "fraction": round(recovered / undetermined, 4) if undetermined else 0.0,
+    }
+
+
+def suggestDemuxSheet(demuxOut, ssDic, corrections, otherLanes, laneSplitStatus):
+    """
+    Write the demuxSheet with the corrections from diagnoseUnknownBarcodes
+    applied: the suggested indices for this outLane's samples, and samples
+    from other outLanes added (with this outLane's Lane). Mismatches are
+    recomputed for the new set of indices.
+    """
+    ssdf = ssDic["sampleSheet"].copy()
+    moved = corrections["variant"].str.startswith("from ")
+    fix = corrections[~moved].set_index("Sample_ID")
+    toFix = ssdf["Sample_ID"].isin(fix.index)
+    ixCols = ["index", "index2"] if ssDic["dualIx"] else ["index"]
+    for ix in ixCols:
+        ssdf.loc[toFix, ix] = ssdf.loc[toFix, "Sample_ID"].map(fix[ix])
+    added = []
+    for row in corrections[moved].itertuples(index=False):
+        laneDF = otherLanes[row.variant.removeprefix("from ")]
+        add = laneDF[laneDF["Sample_ID"] == row.Sample_ID].copy()
+        if "Lane" in ssdf.columns and not ssdf.empty:
+            add["Lane"] = ssdf["Lane"].iloc[0]
+        added.append(add)
+    if added:
+        ssdf = pd.concat([ssdf] + added, ignore_index=True)
+    suggested = dict(ssDic)
+    suggested["sampleSheet"] = ssdf
+    suggested["mismatch"] = misMatcher(
+        ssdf["index"],
+        ssdf["index2"] if ssDic["dualIx"] else pd.Series(dtype=str),
+        "illumina",
+    )
+    writeDemuxSheet(demuxOut, suggested, laneSplitStatus)
+    return suggested
+
+
+# The outLane a thread is working for, so its log entries (and those of the
+# threads it starts, see laneThread) can go to that outLane's demux.log.
+LANE = contextvars.ContextVar("lane", default=None)
+
+
+def laneThread(target, args=()):
+    """
+    A daemon thread that runs target in a copy of the current context,
+    so it logs for the same outLane (LANE) as the thread that started it.
+    """
+    return threading.Thread(
+        target=contextvars.copy_context().run, args=(target, *args), daemon=True
+    )
+
+
+class converterProgressClass:
+    """
+    Logs the progress of a running converter every interval seconds: bytes
+    written to its output folder (Logs/ excluded), throughput since the
+    last report, and that as a fraction of the input size. Output and
+    input size aren't the same thing, but the fraction grows steadily and
+    gives an idea of how far along a run is. The number of files in Logs/
+    shows when bcl-convert moves from conversion to writing reports.
+    """
+
+    def report(self):
+        from dissectBCL.scheduler import estimateFlowcellSize
+
+        now = time.monotonic()
+        written = estimateFlowcellSize(self.outputFolder)
+        rate = (written - self.lastWritten) / max(now - self.lastTime, 1e-6)
+        self.lastWritten, self.lastTime = written, now
+        logsDir = Path(self.outputFolder, "Logs")
+        nLogs = len(list(logsDir.iterdir())) if logsDir.is_dir() else 0
+        msg = (
+            f"Demux - {self.label} - progress: {written / 1e9:.1f} GB written in "
+            f"{(now - self.startTime) / 60:.0f} min, {rate / 1e6:.1f} MB/s"
+        )
+        if self.inputBytes:
+            msg += f", {100 * written / self.inputBytes:.0f}% of the {self.inputBytes / 1e9:.1f} GB input"
+        logging.info(msg + f", {nLogs} file(s) in Logs/")
+        return written, rate
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __init__(self, outputFolder, label, inputBytes=0, interval=300):
+        self.outputFolder = outputFolder
+        self.label = label
+        self.inputBytes = inputBytes
+        self.interval = interval
+        self.startTime = self.lastTime = time.monotonic()
+        self.lastWritten = 0
+        self.stopped = threading.Event()
+        self.thread = laneThread(self._run)
+
+
+def _streamLines(pipe, label, streamName, tail):
+    # readline with a limit: a tool printing without newlines can't make
+    # us buffer more than 64 KB per line.
+    for line in iter(lambda: pipe.readline(1 << 16), b""):
+        line = line.decode("utf-8", errors="replace").rstrip()
+        if line:
+            logging.info(f"Demux - {label} - {streamName}: {line}")
+            if tail is not None:
+                tail.append(line)
+    pipe.close()
+
+
+def runConverter(cmd, outputFolder, label, inputBytes=0, interval=300, tailLines=200):
+    """
+    Run a converter (bcl-convert, bases2fastq), streaming its stdout and
+    stderr into the log line by line while it runs, with a progress report
+    every interval seconds (see converterProgressClass, inputBytes is the
+    size of the input, if known).
+    Only the last tailLines lines of stderr are kept, for the crash mail.
+    Returns (exitcode, stderr tail).
+    """
+    tail = deque(maxlen=tailLines)
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    readers = [
+        laneThread(_streamLines, (proc.stdout, label, "stdout", None)),
+        laneThread(_streamLines, (proc.stderr, label, "stderr", tail)),
+    ]
+    for reader in readers:
+        reader.start()
+    progress = converterProgressClass(outputFolder, label, inputBytes, interval).start()
+    try:
+        exitcode = proc.wait()
+        for reader in readers:
+            reader.join()
+    finally:
+        progress.stop()
+    progress.report()
+    return exitcode, "\n".join(tail)
@@ -2,13 +2,14 @@ import logging
 import sys
 from importlib.metadata import version
 from pathlib import Path
-from time import sleep
 
 import rich_click as click
 from rich import print
 
-from dissectBCL.flowcell import flowCellClass
-from dissectBCL.misc import getConf, getNewFlowCell
+from dissectBCL.flowcellIndex import flowcellIndexClass, markFlowcell, settleFlowcell
+from dissectBCL.misc import getConf, getNewFlowCell, listNewFlowCells
+from dissectBCL.scheduler import flowcellSchedulerClass
+from dissectBCL.watcher import flowcellWatcherClass
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
@@ -44,25 +45,58 @@ from dissectBCL.misc import getConf, getNewFlowCell
     default=False,
     help="Force lane splitting even if specified in the sample sheet.",
 )
-def dissect(configfile, flowcellpath, sequencer, forcelanesplit):
+@click.option(
+    "-P",
+    "--preview",
+    is_flag=True,
+    default=False,
+    help="Before converting a flowcell, convert only its first tile (or [misc] previewTiles) "
+    "with the computed demuxSheets and check assignment rate, empty samples and unknown "
+    "barcodes. The full run only starts if that passes, otherwise the summary is mailed.",
+)
+@click.option(
+    "-R",
+    "--reconcile",
+    is_flag=True,
+    default=False,
+    help="Rebuild the flowcell state index from the .done/run.failed flags in the "
+    "output directories and exit. Run this after removing flags by hand to get a "
+    "flowcell picked up again.",
+)
+def dissect(configfile, flowcellpath, sequencer, forcelanesplit, preview, reconcile):
     """
     define config file and start main dissect function.
     """
     print(f"This is dissectBCL version {version('dissectBCL')}")
     print(f"Loading conf from {configfile}")
+    if reconcile:
+        config = getConf(configfile, quickload=True, sequencer=sequencer)
+        reconcileIndex(config, sequencer)
+        return
     config = getConf(configfile, sequencer=sequencer)
-    main(config, flowcellpath, sequencer, forcelanesplit)
+    main(config, flowcellpath, sequencer, forcelanesplit, preview)
+
+
+def reconcileIndex(config, platformFilter):
+    for platform in ("illumina", "aviti"):
+        if platformFilter not in (None, platform):
+            continue
+        index = flowcellIndexClass(config, platform)
+        try:
+            counts = index.reconcile()
+        finally:
+            index.close()
+        print(f"Reconciled {platform} flowcell index: {counts}")
 
 
-def main(config, flowcellpath, platformFilter, forcelanesplit):
+def main(config, flowcellpath, platformFilter, forcelanesplit, preview=False):
     """
-    every hour checks for a new flow cell.
-    if new flowcell:
-        - initiate log
-        - create flowcellClass
-        - create sampleSheetClass
-        - prepconvert, demux, postmux
-        - QC & communication.
+    checks for new flow cells whenever the watcher says something changed.
+    if new flowcells:
+        - start them (smallest first) in the scheduler, which runs up to
+          [misc] maxConcurrent of them at once, each in its own process
+        - every run initiates its own log, creates its flowcellClass,
+          and goes through prepconvert, demux, postmux, QC & communication.
 
     platformFilter, when set, restricts every poll to that one platform's
     config keys ('illumina' or 'aviti'). It must stay fixed across loop
@@ -70,77 +104,124 @@ def main(config, flowcellpath, platformFilter, forcelanesplit):
     return value, which is None on a no-match poll.
     """
 
+    if flowcellpath:
+        # A single, explicitly given flowcell runs in this process.
+        while True:
+            flowcellName, flowcellDir, sequencer = getNewFlowCell(
+                config, flowcellpath, platformFilter
+            )
+            runFlowcell(
+                config, flowcellName, flowcellDir, sequencer, forcelanesplit, preview
+            )
+            settleFlowcell(config, sequencer, flowcellName, flowcellDir)
+
     # Set pipeline.
+    watcher = flowcellWatcherClass(config, platformFilter)
+    scheduler = flowcellSchedulerClass(config, runFlowcell, (forcelanesplit, preview))
     while True:
-        # Reload setlog
-        flowcellName, flowcellDir, sequencer = getNewFlowCell(
-            config, flowcellpath, platformFilter
+        if scheduler.reap():
+            watcher.reset()
+        if scheduler.slots() > 0:
+            scheduler.submit(listNewFlowCells(config, platformFilter))
+        if scheduler.running:
+            # Wake up when a run finishes, or poll again for new flowcells
+            # that could take a free slot.
+            scheduler.reap(timeout=watcher.pollMin if scheduler.slots() > 0 else None)
+        else:
+            watcher.wait()
+
+
+def initLog(config, flowcellName, flowcellDir, sequencer):
+    """
+    Point the root logger of this process to the flowcell's log file.
+    """
+    # Define a logfile. Aviti logs nest under the same serial-ID
+    # (e.g. AV251009) subdir as their output, mirroring baseDir_aviti.
+    logDirParts = [config["Dirs"][f"flowLogDir_{sequencer}"]]
+    if sequencer == "aviti":
+        logDirParts.append(Path(flowcellDir).parent.name)
+    logFile = Path(*logDirParts, flowcellName + ".log")
+    logFile.parent.mkdir(parents=True, exist_ok=True)
+
+    # initiate log
+    logging.basicConfig(
+        filename=logFile,
+        level="DEBUG",
+        format="%(levelname)s    %(asctime)s    %(message)s",
+        filemode="a",
+        force=True,
+    )
+
+    # Include log to stdout if debug mode is on
+    if config["communication"]["debug_mode"]:
+        # Add console handler
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(logging.DEBUG)
+        console.setFormatter(
+            logging.Formatter("%(levelname)s    %(asctime)s    %(message)s")
         )
+        logging.getLogger().addHandler(console)
 
-        if flowcellName:
-            # Define a logfile. Aviti logs nest under the same serial-ID
-            # (e.g. AV251009) subdir as their output, mirroring baseDir_aviti.
-            logDirParts = [config["Dirs"][f"flowLogDir_{sequencer}"]]
-            if sequencer == "aviti":
-                logDirParts.append(Path(flowcellDir).parent.name)
-            logFile = Path(*logDirParts, flowcellName + ".log")
-            logFile.parent.mkdir(parents=True, exist_ok=True)
-
-            # initiate log
-            logging.basicConfig(
-                filename=logFile,
-                level="DEBUG",
-                format="%(levelname)s    %(asctime)s    %(message)s",
-                filemode="a",
-                force=True,
-            )
+    # Set flowcellname in log.
+    logging.info(
+        f"Log Initiated - flowcell:{flowcellName}, filename:{logFile}, sequencer:{sequencer}"
+    )
 
-            # Include log to stdout if debug mode is on
-            if config["communication"]["debug_mode"]:
-                # Add console handler
-                console = logging.StreamHandler(sys.stdout)
-                console.setLevel(logging.DEBUG)
-                console.setFormatter(
-                    logging.Formatter("%(levelname)s    %(asctime)s    %(message)s")
-                )
-                logging.getLogger().addHandler(console)
-
-            # Set flowcellname in log.
-            logging.info(
-                f"Log Initiated - flowcell:{flowcellName}, filename:{logFile}, sequencer:{sequencer}"
-            )
+    print(f"Logfile set as {logFile}")
+    # Include dissectBCL version in log
+    logging.info(f"dissectBCL - version {version('dissectBCL')}")
+    # Include software versions in log
+    for lib in config["softwareVers"]:
+        logging.debug(f"{lib} = {config['softwareVers'][lib]}")
+    return logFile
 
-            print(f"Logfile set as {logFile}")
-            # Include dissectBCL version in log
-            logging.info(f"dissectBCL - version {version('dissectBCL')}")
-            # Include software versions in log
-            for lib in config["softwareVers"]:
-                logging.debug(f"{lib} = {config['softwareVers'][lib]}")
-
-            # Create class.
-            flowcell = flowCellClass(
-                name=flowcellName,
-                bclPath=flowcellDir,
-                logFile=logFile,
-                config=config,
-                sequencer=sequencer,
-                forceLaneSplit=forcelanesplit,
-            )
-            flowcell.prepConvert()
-            if sequencer == "illumina":
-                # flowcell.prepConvert()
-                flowcell.demux()
-            else:
-                flowcell.demux_aviti()
-            flowcell.postmux()
-            flowcell.fakenews()
-            flowcell.organiseLogs()
-        else:
-            print("Going back to sleep for 60 minutes.")
-            sleep(60 * 60)
+
+def runFlowcell(
+    config, flowcellName, flowcellDir, sequencer, forcelanesplit, preview=False
+):
+    """
+    The full pipeline for one flowcell.
+    With preview, a tile subset is converted first, and the run stops
+    (exit 1) if that doesn't pass, see flowCellClass.preview.
+    """
+    logFile = initLog(config, flowcellName, flowcellDir, sequencer)
+    logging.info(
+        f"Resources - threads: {config['misc']['threads']}, memory: {config['misc'].get('memory', '650G')}"
+    )
+
+    # Imported here: pandas & co. are only needed once there's a flowcell.
+    from dissectBCL.flowcell import flowCellClass
+    from dissectBCL.parkour import logParkourMetrics
+
+    # Create class.
+    flowcell = flowCellClass(
+        name=flowcellName,
+        bclPath=flowcellDir,
+        logFile=logFile,
+        config=config,
+        sequencer=sequencer,
+        forceLaneSplit=forcelanesplit,
+    )
+    markFlowcell(config, sequencer, flowcellName, "demuxing", flowcellDir)
+    flowcell.prepConvert()
+    if preview and not flowcell.preview():
+        logging.critical("Preview - no-go, the full run is not started.")
+        sys.exit(1)
+    if sequencer == "illumina":
+        # flowcell.prepConvert()
+        flowcell.demux()
+    else:
+        flowcell.demux_aviti()
+    markFlowcell(config, sequencer, flowcellName, "postmux", flowcellDir)
+    flowcell.postmux()
+    flowcell.fakenews()
+    flowcell.organiseLogs()
+    logParkourMetrics()
 
 
 def createFlowcell(config, fpath, sequencer, logFile=None, forceLaneSplit=False):
+    from dissectBCL.flowcell import flowCellClass
+
     config = getConf(config, sequencer=sequencer)
     flowcellName, flowcellDir, sequencer = getNewFlowCell(config, fpath, sequencer)
     if not logFile:
@@ -9,12 +9,12 @@ from email.mime.text import MIMEText
 from importlib.metadata import version
 from pathlib import Path
 
-import interop
 import numpy as np
 import pandas as pd
-import requests
 import ruamel.yaml
+from tabulate import tabulate
 
+from dissectBCL.demux import diagnoseUnknownBarcodes, suggestDemuxSheet
 from dissectBCL.misc import (
     fetchLatestSeqDir,
     fexUpload,
@@ -26,6 +26,7 @@ from dissectBCL.misc import (
     stripRights,
     umlautDestroyer,
 )
+from dissectBCL.parkour import parkourClient
 
 
 def pullParkour(flowcellID, config, aviti):
@@ -49,12 +50,7 @@ def pullParkour(flowcellID, config, aviti):
             FID = FID.split("-")[1]
     logging.info(f"Pulling parkour for with flowcell {flowcellID} using FID {FID}")
     d = {"flowcell_id": FID}
-    res = requests.get(
-        config["parkour"]["URL"] + "/api/analysis_list/analysis_list/",
-        auth=(config["parkour"]["user"], config["parkour"]["password"]),
-        params=d,
-        verify=config["parkour"]["cert"],
-    )
+    res = parkourClient(config).get("/api/analysis_list/analysis_list/", params=d)
     if res.status_code == 200:
         logging.info("parkour API code 200")
         """
@@ -74,11 +70,10 @@ def pullParkour(flowcellID, config, aviti):
         We flatten it and return.
         """
         flatLis = []
-        for project in res.json():
-            for sample in res.json()[project]:
-                flatLis.append(
-                    [umlautDestroyer(project), sample] + res.json()[project][sample]
-                )
+        analysisList = res.json()
+        for project, samples in analysisList.items():
+            for sample, sampleInfo in samples.items():
+                flatLis.append([umlautDestroyer(project), sample] + sampleInfo)
         parkourDF = pd.DataFrame(flatLis)
         parkourDF.columns = [
             "Sample_Project",
@@ -98,7 +93,7 @@ def pullParkour(flowcellID, config, aviti):
         parkourDF["reqDepth"] = parkourDF["reqDepth"] * 1000000
         # Some exceptions where there is a ' in the description..
         parkourDF["Description"] = parkourDF["Description"].str.replace(
-            r"[\’,]", "", regex=True
+            r"[’,]", "", regex=True
         )
         return parkourDF
     logging.warning("parkour API not 200!")
@@ -134,6 +129,8 @@ def pushParkour(
     "name": "Lane 2"}
     """
     if sequencer != "aviti":
+        import interop
+
         # Parse interop.
         iop_df = pd.DataFrame(interop.summary(interop.read(str(flowcellBase)), "Lane"))
 
@@ -219,12 +216,7 @@ def pushParkour(
 
     d["matrix"] = json.dumps(list(laneDict.values()))
     logging.info(f"fakenews - pushParkour - Pushing FID with dic {FID} {d}")
-    pushParkStat = requests.post(
-        config.get("parkour", "URL") + "/api/run_statistics/upload/",
-        auth=(config.get("parkour", "user"), config.get("parkour", "password")),
-        data=d,
-        verify=config["parkour"]["cert"],
-    )
+    pushParkStat = parkourClient(config).post("/api/run_statistics/upload/", data=d)
     logging.info(f"fakenews - ParkourPush - return {pushParkStat}")
     return pushParkStat
 
@@ -374,6 +366,49 @@ def organiseLogs(flowcell, sampleSheet):
             yaml1.dump(dic1, f)
 
 
+def diagnoseBarcodes(outLane, flowcell, unknownDF, undetermined):
+    """
+    Match all unknown barcodes of an outLane against the variants of its
+    sample sheet (and the samples of the other outLanes), see
+    diagnoseUnknownBarcodes. For Illumina runs the suggested correction is
+    written as demuxSheet.suggested.csv in the outLane, ready to be used
+    for a rerun.
+    """
+    aviti = {"Index1": "index", "Index2": "index2"}
+    ssDics = flowcell.sampleSheet.ssDic
+    sampleDF = ssDics[outLane]["sampleSheet"].rename(columns=aviti)
+    otherLanes = {
+        _outLane: _ssDic["sampleSheet"].rename(columns=aviti)
+        for _outLane, _ssDic in ssDics.items()
+        if _outLane != outLane
+    }
+    diagnosis = diagnoseUnknownBarcodes(unknownDF, sampleDF, undetermined, otherLanes)
+    diagnosis["suggestedSheet"] = None
+    if diagnosis["corrections"].empty:
+        logging.info(f"fakenews - {outLane} - no unknown barcodes explained.")
+        return diagnosis
+    logging.info(
+        f"fakenews - {outLane} - {diagnosis['fraction']:.1%} of undetermined reads "
+        "explained by:\n"
+        + tabulate(
+            diagnosis["corrections"].values.tolist(),
+            list(diagnosis["corrections"].columns),
+            disable_numparse=True,
+        )
+    )
+    if flowcell.sequencer != "aviti":
+        suggestedSheet = flowcell.outBaseDir / outLane / "demuxSheet.suggested.csv"
+        suggestDemuxSheet(
+            suggestedSheet,
+            ssDics[outLane],
+            diagnosis["corrections"],
+            otherLanes,
+            flowcell.sampleSheet.laneSplitStatus,
+        )
+        diagnosis["suggestedSheet"] = suggestedSheet
+    return diagnosis
+
+
 # outPath, initTime, flowcellID, ssDic, transferTime, exitStats, solPath
 def gatherFinalMetrics(outLane, flowcell):
     logging.info(f"fakenews - gatherFinalMetrics - {outLane}")
@@ -400,6 +435,8 @@ def gatherFinalMetrics(outLane, flowcell):
                 undReads = undStr[:-2]
         # topBarcodes
         bcDF = pd.read_csv(outPath / "Reports" / "Top_Unknown_Barcodes.csv")
+        unknownDF = bcDF
+        undTotal = int(muxDF.loc[muxDF["SampleID"] == "Undetermined", "# Reads"].sum())
         bcDF = bcDF.head(5)
         BCs = [
             joinLis(list(x), joinStr="+")
@@ -422,6 +459,10 @@ def gatherFinalMetrics(outLane, flowcell):
         )
         # topBarcodes
         bcDF = pd.read_csv(outPath / "UnassignedSequences.csv")
+        unknownDF = bcDF.rename(
+            columns={"I1": "index", "I2": "index2", "Count": "# Reads"}
+        )
+        undTotal = undReads
         tot_und = bcDF["Count"].sum()
         bcDF["% of Unknown Barcodes"] = round((bcDF["Count"] / tot_und), 2)
         bcDF = bcDF.head(5)
@@ -434,6 +475,13 @@ def gatherFinalMetrics(outLane, flowcell):
         for entry in list(zip(BCs, BCReads, BCReadsPerc, strict=True)):
             BCDic[entry[0]] = [round(float(entry[1]) / 1000000, 2), entry[2]]
 
+    # The diagnosis is a courtesy, it shouldn't keep the run from finishing.
+    try:
+        barcodeDiagnosis = diagnoseBarcodes(outLane, flowcell, unknownDF, undTotal)
+    except Exception as e:
+        logging.warning(f"fakenews - {outLane} - barcode diagnosis failed: {e!r}")
+        barcodeDiagnosis = None
+
     # runTime
     runTime = datetime.datetime.now() - flowcell.startTime
     # optDups
@@ -494,6 +542,7 @@ def gatherFinalMetrics(outLane, flowcell):
         "undetermined": undReads,
         "totalReads": totalReads,
         "topBarcodes": BCDic,
+        "barcodeDiagnosis": barcodeDiagnosis,
         "spaceFree_rap": getDiskSpace(outPath),
         "spaceFree_sol": getDiskSpace(flowcell.bclPath),
         "runTime": runTime,
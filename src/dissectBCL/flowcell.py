@@ -3,10 +3,12 @@ import json
 import logging
 import shutil
 import sys
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from random import randint
-from subprocess import PIPE, Popen
 
 import numpy as np
 import pandas as pd
@@ -15,15 +17,19 @@ from dominate.tags import br, div, html
 from tabulate import tabulate
 
 from dissectBCL.demux import (
+    LANE,
     compareDemuxSheet,
     detMask,
     evalMiSeqP5,
     matchingSheets,
     misMatcher,
     parseStats,
+    previewSummary,
+    rcP5DemuxSheet,
     readDemuxSheet,
+    runConverter,
+    scoreP5Orientation,
     writeDemuxSheet,
-    writeDemuxSheetAviti,
 )
 from dissectBCL.fakeNews import (
     gatherFinalMetrics,
@@ -34,14 +40,22 @@ from dissectBCL.fakeNews import (
 )
 from dissectBCL.misc import P5Seriesret, umlautDestroyer
 from dissectBCL.postmux import (
-    clumper,
-    kraken,
+    clumpSample,
+    clumpThreads,
+    demuxReadCounts,
+    fanoutSample,
+    fastqcSample,
+    krakenSample,
+    krakenThreads,
+    largestFirst,
     md5_multiqc,
+    md5Threads,
     moveOptDup,
-    qcs,
     renameProject,
+    taskGraphClass,
     validateFqEnds,
 )
+from dissectBCL.scheduler import estimateFlowcellSize
 
 
 class flowCellClass:
@@ -191,15 +205,263 @@ class flowCellClass:
                     ss[ix_str] = ss[ix_str].str[:min_ix]
 
             # determine mismatch
-            ss_dict["mismatch"] = misMatcher(
+            ss_dict["mismatch"], collisions = misMatcher(
                 ss[index1_colname],
                 P5Seriesret(ss, aviti=(self.sequencer == "aviti")),
                 self.sequencer,
+                returnCollisions=True,
+            )
+            for mmKey, pairs in collisions.items():
+                logging.debug(
+                    f"Demux - prepConvert - {outputFolder} {mmKey} set by {len(pairs)} pair(s), e.g. {pairs[:5]}"
+                )
+            logging.info(
+                f"Demux - prepConvert - {outputFolder} mismatches: {ss_dict['mismatch']}"
             )
         logging.info("Demux - prepConvert - mask in sampleSheet updated.")
         self.exitStats["premux"] = 0
 
     # demux - demux
+    def perLane(self, laneFunc):
+        """
+        Run laneFunc(outLane, threads) for every outLane.
+        [misc] concurrentLanes (default 1) outLanes are converted at the same
+        time, each with an equal share of the threads. A crash in one of them
+        (sys.exit after mailHome) is re-raised here once the running ones
+        are done, lanes that haven't started yet are skipped.
+        """
+        outLanes = list(self.sampleSheet.ssDic)
+        concurrent = max(
+            1, min(int(self.config["misc"].get("concurrentLanes", 1)), len(outLanes))
+        )
+        threads = max(1, int(self.config["misc"]["threads"]) // concurrent)
+        if concurrent == 1:
+            for outLane in outLanes:
+                laneFunc(outLane, threads)
+            return
+        logging.info(
+            f"Demux - converting {concurrent} of {len(outLanes)} outLanes at a time, {threads} threads each."
+        )
+        with ThreadPoolExecutor(max_workers=concurrent) as pool:
+            futures = [
+                pool.submit(self.laneLogged, laneFunc, outLane, threads)
+                for outLane in outLanes
+            ]
+            for future in futures:
+                if future.exception() is not None:
+                    for f in futures:
+                        f.cancel()
+                    raise future.exception()
+
+    def laneLogged(self, laneFunc, outLane, threads):
+        """
+        laneFunc in a worker thread. Its log entries still go to the
+        flowcell log, and also to outLane/demux.log, so a lane can be read
+        without the other lanes' entries interleaved.
+        """
+        outputFolder = Path(self.outBaseDir, outLane)
+        outputFolder.mkdir(exist_ok=True)
+        handler = logging.FileHandler(outputFolder / "demux.log")
+        handler.setFormatter(
+            logging.Formatter("%(levelname)s    %(asctime)s    %(message)s")
+        )
+        # Filter on the lane, not the thread: the converter's output and
+        # progress are logged from threads of their own (see laneThread).
+        handler.addFilter(lambda record: LANE.get() == outLane)
+        token = LANE.set(outLane)
+        logging.getLogger().addHandler(handler)
+        try:
+            laneFunc(outLane, threads)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+            LANE.reset(token)
+
+    def inputSize(self):
+        """
+        Bytes of base calls in bclPath, scanned once for all outLanes (and
+        the preview), for the converter progress reports.
+        """
+        with self.inputSizeLock:
+            if self._inputSize is None:
+                self._inputSize = estimateFlowcellSize(self.bclPath)
+        return self._inputSize
+
+    def runConverter(self, cmd, outLane):
+        """
+        runConverter for an outLane: output streamed into the log, progress
+        reported every [misc] progressInterval seconds (default 300).
+        """
+        return runConverter(
+            cmd,
+            Path(self.outBaseDir, outLane),
+            outLane,
+            inputBytes=self.inputSize(),
+            interval=int(self.config["misc"].get("progressInterval", 300)),
+        )
+
+    def preview(self):
+        """
+        Convert a tile subset per outLane with the demuxSheet that the full
+        run would use: the first tile, or [misc] previewTiles (a bcl-convert
+        --tiles regex) if set. Every outLane gets a go / no-go from
+        previewSummary, with [misc] previewMinAssigned (default 0.5) and
+        previewMaxEmpty (default 0.1). On a no-go the summary is mailed to
+        the core, and False is returned: the full run shouldn't start.
+        The demuxSheets stay in place, so they can be fixed before a rerun.
+        """
+        if self.sequencer == "aviti":
+            logging.warning("Preview - not available for Aviti runs, skipped.")
+            return True
+        threads = int(self.config["misc"]["threads"])
+        summaries = {}
+        for outLane in self.sampleSheet.ssDic:
+            outputFolder = Path(self.outBaseDir, outLane)
+            if Path(outputFolder, "bclconvert.done").exists():
+                logging.info(f"Preview - {outLane} already demultiplexed, skipped.")
+                continue
+            demuxOut = self.laneDemuxSheet(outLane)
+            previewFolder = outputFolder / "preview"
+            shutil.rmtree(previewFolder, ignore_errors=True)
+            opts = self.bclConvertOpts(previewFolder, demuxOut, threads)
+            if self.config["misc"].get("previewTiles"):
+                opts += ["--tiles", self.config["misc"]["previewTiles"]]
+            else:
+                opts += ["--first-tile-only", "true"]
+            logging.info(f"Preview - {outLane} - {opts}")
+            exitcode, _stderr = self.runConverter(opts, outLane)
+            # The full run would RC MiSeq P5s first (predictP5), so the
+            # preview has to score the sheet in that orientation as well.
+            if exitcode == 0 and self.checksP5(outLane, demuxOut):
+                fwd, rc = scoreP5Orientation(
+                    previewFolder / "Reports", readDemuxSheet(demuxOut, what="df")
+                )
+                logging.info(
+                    f"Preview - {outLane} - P5 orientation: {fwd} reads as is, {rc} RC'ed."
+                )
+                if rc > fwd:
+                    self.applyP5RC(outLane, demuxOut)
+                    shutil.rmtree(previewFolder, ignore_errors=True)
+                    exitcode, _stderr = self.runConverter(opts, outLane)
+            if exitcode != 0:
+                summaries[outLane] = {
+                    "go": False,
+                    "reasons": [f"bcl-convert exit {exitcode}: {_stderr[-2000:]}"],
+                }
+            else:
+                summaries[outLane] = previewSummary(
+                    previewFolder / "Reports",
+                    readDemuxSheet(demuxOut, what="df"),
+                    minAssigned=float(
+                        self.config["misc"].get("previewMinAssigned", 0.5)
+                    ),
+                    maxEmpty=float(self.config["misc"].get("previewMaxEmpty", 0.1)),
+                )
+            shutil.rmtree(previewFolder, ignore_errors=True)
+        self.previewSummaries = summaries
+        if not summaries:
+            return True
+
+        tableHead = [
+            "outLane",
+            "go",
+            "reads",
+            "assigned",
+            "empty samples",
+            "top unknown barcodes",
+            "reasons",
+        ]
+        tableCont = [
+            [
+                outLane,
+                "go" if summary["go"] else "NO-GO",
+                summary.get("reads", ""),
+                f"{summary['assignmentRate']:.1%}"
+                if "assignmentRate" in summary
+                else "",
+                ", ".join(summary.get("emptySamples", [])[:10]),
+                ", ".join(
+                    f"{bc} ({share:.1%})"
+                    for bc, _reads, share in summary.get("topUnknown", [])
+                ),
+                "; ".join(summary["reasons"]),
+            ]
+            for outLane, summary in summaries.items()
+        ]
+        go = all(summary["go"] for summary in summaries.values())
+        logging.info(
+            "Preview - summary:\n"
+            + tabulate(tableCont, tableHead, disable_numparse=True)
+        )
+        if not go:
+            mailHome(
+                f"{self.name} preview: no-go",
+                "The preview didn't pass, the full run was not started. "
+                + "Fix the demuxSheet(s) in "
+                + f"{self.outBaseDir} and rerun.<br><br>"
+                + tabulate(
+                    tableCont, tableHead, tablefmt="html", disable_numparse=True
+                ),
+                self.config,
+                toCore=True,
+            )
+        return go
+
+    def predictP5(self, outLane, bclOpts, demuxOut):
+        """
+        Convert the first tile only with the demuxSheet as is, and score its
+        P5s against both orientations (scoreP5Orientation). If the RC'ed
+        P5s explain more reads, the demuxSheet is RC'ed (keeping the .bak)
+        before the full run, instead of rerunning bcl-convert afterwards.
+        Returns False if the check was inconclusive, evalMiSeqP5 then
+        still looks at the full run.
+        """
+        checkFolder = Path(self.outBaseDir, outLane, "P5check")
+        checkOpts = list(bclOpts)
+        checkOpts[checkOpts.index("--output-directory") + 1] = checkFolder
+        checkOpts += ["--first-tile-only", "true"]
+        logging.info(f"Demux - {outLane} - P5 orientation check on the first tile")
+        exitcode, _stderr = self.runConverter(checkOpts, outLane)
+        if exitcode != 0:
+            logging.warning(
+                f"Demux - {outLane} - P5 orientation check exit {exitcode}, skipped."
+            )
+            shutil.rmtree(checkFolder, ignore_errors=True)
+            return False
+        fwd, rc = scoreP5Orientation(
+            checkFolder / "Reports", readDemuxSheet(demuxOut, what="df")
+        )
+        shutil.rmtree(checkFolder, ignore_errors=True)
+        logging.info(
+            f"Demux - {outLane} - P5 orientation check: {fwd} reads as is, {rc} RC'ed."
+        )
+        if fwd == 0 and rc == 0:
+            return False
+        if rc > fwd:
+            self.applyP5RC(outLane, demuxOut)
+        return True
+
+    def checksP5(self, outLane, demuxOut):
+        """
+        MiSeq dual index outLanes get their P5 orientation checked, unless
+        the demuxSheet was RC'ed already (the .bak exists).
+        """
+        return (
+            self.sequencer == "MiSeq"
+            and self.sampleSheet.ssDic[outLane]["dualIx"]
+            and not demuxOut.with_suffix(".bak").exists()
+        )
+
+    def applyP5RC(self, outLane, demuxOut):
+        _ssDic = self.sampleSheet.ssDic[outLane]
+        logging.info(f"Demux - {outLane} - P5 RC triggered.")
+        rcP5DemuxSheet(demuxOut)
+        # Update the sampleSheet with proper RC'ed indices.
+        _ssDic["sampleSheet"] = matchingSheets(
+            _ssDic["sampleSheet"],
+            readDemuxSheet(demuxOut, what="df"),
+        )
+
     def demux(self):
         # Double check for run failure
         if self.successfulrun != "SuccessfullyCompleted":
@@ -218,98 +480,116 @@ class flowCellClass:
             )
         else:
             logging.info("Demux - Illumina - Run is successful, starting demux")
-            for outLane in self.sampleSheet.ssDic:
-                logging.info(f"Demux - {outLane}")
-                _ssDic = self.sampleSheet.ssDic[outLane]
-                # Set outputDirectory
-                outputFolder = Path(self.outBaseDir, outLane)
-                outputFolder.mkdir(exist_ok=True)
-                demuxOut = outputFolder / "demuxSheet.csv"
-                # Don't remake if demuxSheet exist
-                if not demuxOut.exists():
-                    logging.info(f"Demux - Writing demuxSheet for {outLane}")
-                    writeDemuxSheet(demuxOut, _ssDic, self.sampleSheet.laneSplitStatus)
-                else:
-                    logging.warning(
-                        f"Demux - demuxSheet for {outLane} already exists, not changing it."
-                    )
-                    compareDemuxSheet(_ssDic, demuxOut)
+            self.perLane(self.demuxLane)
+            self.exitStats["demux"] = 0
 
-                # Don't run bcl-convert if we have the touched flag.
-                if not Path(outputFolder, "bclconvert.done").exists():
-                    # Purge pre-existing reports / log folders
-                    if Path(outputFolder, "Reports").exists():
+    def laneDemuxSheet(self, outLane):
+        """
+        Write the demuxSheet for an outLane, or pick up the changes made to
+        an existing one. Returns its path.
+        """
+        _ssDic = self.sampleSheet.ssDic[outLane]
+        # Set outputDirectory
+        outputFolder = Path(self.outBaseDir, outLane)
+        outputFolder.mkdir(exist_ok=True)
+        demuxOut = outputFolder / "demuxSheet.csv"
+        # Don't remake if demuxSheet exist
+        if not demuxOut.exists():
+            logging.info(f"Demux - Writing demuxSheet for {outLane}")
+            writeDemuxSheet(demuxOut, _ssDic, self.sampleSheet.laneSplitStatus)
+        else:
+            logging.warning(
+                f"Demux - demuxSheet for {outLane} already exists, not changing it."
+            )
+            compareDemuxSheet(_ssDic, demuxOut)
+        return demuxOut
+
+    def bclConvertOpts(self, outputFolder, demuxOut, threads):
+        bclOpts = [
+            self.config["software"]["bclconvert"],
+            "--output-directory",
+            outputFolder,
+            "--force",
+            "--bcl-input-directory",
+            self.bclPath,
+            "--sample-sheet",
+            demuxOut,
+            "--bcl-num-conversion-threads",
+            f"{max(1, threads // 2)}",
+            "--bcl-num-compression-threads",
+            f"{max(1, threads // 2)}",
+            "--bcl-sampleproject-subdirectories",
+            "true",
+        ]
+        if not self.sampleSheet.laneSplitStatus:
+            bclOpts.append("--no-lane-splitting")
+            bclOpts.append("true")
+        return bclOpts
+
+    def demuxLane(self, outLane, threads):
+        logging.info(f"Demux - {outLane}")
+        _ssDic = self.sampleSheet.ssDic[outLane]
+        outputFolder = Path(self.outBaseDir, outLane)
+        demuxOut = self.laneDemuxSheet(outLane)
+
+        # Don't run bcl-convert if we have the touched flag.
+        if not Path(outputFolder, "bclconvert.done").exists():
+            # Purge pre-existing reports / log folders
+            if Path(outputFolder, "Reports").exists():
+                shutil.rmtree(Path(outputFolder, "Reports"))
+            if Path(outputFolder, "Logs").exists():
+                shutil.rmtree(Path(outputFolder, "Logs"))
+            # Run bcl-convert
+            bclOpts = self.bclConvertOpts(outputFolder, demuxOut, threads)
+            # MiSeq P5s can need an RC, find out before the full run. An RC'ed
+            # sheet (e.g. by the preview) has been checked already.
+            p5Checked = demuxOut.with_suffix(".bak").exists()
+            if self.checksP5(outLane, demuxOut):
+                p5Checked = self.predictP5(outLane, bclOpts, demuxOut)
+            logging.info(f"Demux - {outLane} - Starting BCLConvert")
+            logging.info(f"Demux - {outLane} - {bclOpts}")
+            exitcode, _stderr = self.runConverter(bclOpts, outLane)
+            if exitcode == 0:
+                logging.info(f"Demux - {outLane} - bclConvert exit 0")
+                Path(outputFolder, "bclconvert.done").touch()
+                if p5Checked:
+                    _ssDic["P5RC"] = demuxOut.with_suffix(".bak").exists()
+                elif self.sequencer == "MiSeq":
+                    if evalMiSeqP5(
+                        outputFolder,
+                        _ssDic["dualIx"],
+                    ):
+                        logging.info("Demux - P5 RC triggered.")
+                        # Purge existing reports.
+                        logging.info("Demux - Purge existing Reports folder")
                         shutil.rmtree(Path(outputFolder, "Reports"))
-                    if Path(outputFolder, "Logs").exists():
                         shutil.rmtree(Path(outputFolder, "Logs"))
-                    # Run bcl-convert
-                    bclOpts = [
-                        self.config["software"]["bclconvert"],
-                        "--output-directory",
-                        outputFolder,
-                        "--force",
-                        "--bcl-input-directory",
-                        self.bclPath,
-                        "--sample-sheet",
-                        demuxOut,
-                        "--bcl-num-conversion-threads",
-                        f"{int(self.config['misc']['threads']) // 2}",
-                        "--bcl-num-compression-threads",
-                        f"{int(self.config['misc']['threads']) // 2}",
-                        "--bcl-sampleproject-subdirectories",
-                        "true",
-                    ]
-                    if not self.sampleSheet.laneSplitStatus:
-                        bclOpts.append("--no-lane-splitting")
-                        bclOpts.append("true")
-                    logging.info("Demux - Starting BCLConvert")
-                    logging.info(f"Demux - {bclOpts}")
-                    bclRunner = Popen(bclOpts, stdout=PIPE, stderr=PIPE)
-                    _stdout, _stderr = bclRunner.communicate()
-                    exitcode = bclRunner.returncode
-                    if exitcode == 0:
-                        logging.info("Demux - bclConvert exit 0")
-                        Path(outputFolder, "bclconvert.done").touch()
-                        if self.sequencer == "MiSeq":
-                            if evalMiSeqP5(
-                                outputFolder,
-                                _ssDic["dualIx"],
-                            ):
-                                logging.info("Demux - P5 RC triggered.")
-                                # Purge existing reports.
-                                logging.info("Demux - Purge existing Reports folder")
-                                shutil.rmtree(Path(outputFolder, "Reports"))
-                                shutil.rmtree(Path(outputFolder, "Logs"))
-                                # Rerun BCLConvert
-                                logging.info("Demux - Rerun BCLConvert")
-                                bclRunner = Popen(bclOpts, stdout=PIPE, stderr=PIPE)
-                                _stdout, _stderr = bclRunner.communicate()
-                                logging.info(
-                                    f"Demux - bclConvert P5fix exit {exitcode}"
-                                )
-                                # Update the sampleSheet with proper RC'ed indices.
-                                _ssDic["sampleSheet"] = matchingSheets(
-                                    _ssDic["sampleSheet"],
-                                    readDemuxSheet(demuxOut, what="df"),
-                                )
-                                _ssDic["P5RC"] = True
-                            else:
-                                _ssDic["P5RC"] = False
-                        else:
-                            _ssDic["P5RC"] = False
-                    else:
-                        logging.critical(f"Demux - BCLConvert exit {exitcode}")
-                        mailHome(
-                            outLane,
-                            f"BCL-convert exit {exitcode}. Pipeline crashed. {_stderr.decode('utf-8')}",
-                            self.config,
-                            toCore=True,
+                        # Rerun BCLConvert
+                        logging.info("Demux - Rerun BCLConvert")
+                        exitcode, _stderr = self.runConverter(bclOpts, outLane)
+                        logging.info(f"Demux - bclConvert P5fix exit {exitcode}")
+                        # Update the sampleSheet with proper RC'ed indices.
+                        _ssDic["sampleSheet"] = matchingSheets(
+                            _ssDic["sampleSheet"],
+                            readDemuxSheet(demuxOut, what="df"),
                         )
-                        sys.exit(1)
+                        _ssDic["P5RC"] = True
+                    else:
+                        _ssDic["P5RC"] = False
+                else:
+                    _ssDic["P5RC"] = False
+            else:
+                logging.critical(f"Demux - {outLane} - BCLConvert exit {exitcode}")
+                mailHome(
+                    outLane,
+                    f"BCL-convert exit {exitcode}. Pipeline crashed. {_stderr}",
+                    self.config,
+                    toCore=True,
+                )
+                sys.exit(1)
 
-                logging.info(f"Demux - Parsing stats for {outLane}")
-                _ssDic["sampleSheet"] = parseStats(outputFolder, _ssDic["sampleSheet"])
-            self.exitStats["demux"] = 0
+        logging.info(f"Demux - Parsing stats for {outLane}")
+        _ssDic["sampleSheet"] = parseStats(outputFolder, _ssDic["sampleSheet"])
 
     def demux_aviti(self):
         logging.info("Demux - Aviti system.")
@@ -327,72 +607,80 @@ class flowCellClass:
             )
         else:
             logging.info("Demux - Aviti - Run is successful, starting demux")
-            for outLane in self.sampleSheet.ssDic:
-                logging.info(f"Demux - {outLane}")
-                _ssDic = self.sampleSheet.ssDic[outLane]
-                # P5RC is some legacy leftover from MiSeq illumina (needed to RC).
-                # To keep data structures consistent, we set it to False.
-                _ssDic["P5RC"] = False
-                # Set outputDirectory
-                outputFolder = Path(self.outBaseDir, outLane)
-                outputFolder.mkdir(exist_ok=True)
-                (outputFolder / "manifest").mkdir(exist_ok=True)
-                # Ship over RunManifest.csv, only if it doesn't exist yet.
-                demuxOut = Path(outputFolder, "manifest", "RunManifest.csv")
-                if not demuxOut.exists():
-                    logging.info(f"Demux - Copying RunManifest.csv to {outputFolder}")
-                    # shutil.copy(self.origSS, outputFolder / 'manifest' / 'RunManifest.csv')
-                    writeDemuxSheetAviti(
-                        demuxOut, _ssDic, self.sampleSheet.laneSplitStatus
-                    )
-                else:
-                    logging.warning(
-                        f"Demux - RunManifest.csv for {outLane} already exists, not changing it."
-                    )
-                # Run bases2fastq
-                b2fOpts = [
-                    self.config["software"]["bases2fastq"],
-                    "--run-manifest",
-                    Path(outputFolder, "manifest", "RunManifest.csv"),
-                    "--num-threads",
-                    f"{self.config['misc']['threads']}",
-                    "--group-fastq",
-                    self.bclPath,
-                    Path(outputFolder),
-                ]
+            self.perLane(self.demuxLane_aviti)
+            self.exitStats["demux"] = 0
 
-                if not Path(outputFolder, "bases2fastq.done").exists():
-                    logging.info("Demux - Starting bases2fastq")
-                    logging.info(f"Demux - {b2fOpts}")
-                    b2fRunner = Popen(b2fOpts, stdout=PIPE, stderr=PIPE)
-                    _stdout, _stderr = b2fRunner.communicate()
-                    exitcode = b2fRunner.returncode
+    def demuxLane_aviti(self, outLane, threads):
+        logging.info(f"Demux - {outLane}")
+        _ssDic = self.sampleSheet.ssDic[outLane]
+        # P5RC is some legacy leftover from MiSeq illumina (needed to RC).
+        # To keep data structures consistent, we set it to False.
+        _ssDic["P5RC"] = False
+        # Set outputDirectory
+        outputFolder = Path(self.outBaseDir, outLane)
+        outputFolder.mkdir(exist_ok=True)
+        (outputFolder / "manifest").mkdir(exist_ok=True)
+        # Ship over RunManifest.csv, only if it doesn't exist yet.
+        demuxOut = Path(outputFolder, "manifest", "RunManifest.csv")
+        if not demuxOut.exists():
+            logging.info(f"Demux - Copying RunManifest.csv to {outputFolder}")
+            # shutil.copy(self.origSS, outputFolder / 'manifest' / 'RunManifest.csv')
+            writeDemuxSheet(
+                demuxOut,
+                _ssDic,
+                self.sampleSheet.laneSplitStatus,
+                sequencer="aviti",
+            )
+        else:
+            logging.warning(
+                f"Demux - RunManifest.csv for {outLane} already exists, not changing it."
+            )
+        # Run bases2fastq
+        b2fOpts = [
+            self.config["software"]["bases2fastq"],
+            "--run-manifest",
+            Path(outputFolder, "manifest", "RunManifest.csv"),
+            "--num-threads",
+            f"{threads}",
+            "--group-fastq",
+            self.bclPath,
+            Path(outputFolder),
+        ]
 
-                    if exitcode == 0:
-                        logging.info("Demux - bases2fastq exit 0")
-                        Path(outputFolder, "bases2fastq.done").touch()
-                    else:
-                        logging.critical(f"Demux - bases2fastq exit {exitcode}")
-                        mailHome(
-                            outLane,
-                            f"Bases2fastq exit {exitcode}. Pipeline crashed. {_stderr.decode('utf-8')}",
-                            self.config,
-                            toCore=True,
-                        )
-                        sys.exit(1)
-                else:
-                    logging.info("Bases2fastq.done already exists. Moving forward.")
+        if not Path(outputFolder, "bases2fastq.done").exists():
+            logging.info(f"Demux - {outLane} - Starting bases2fastq")
+            logging.info(f"Demux - {outLane} - {b2fOpts}")
+            exitcode, _stderr = self.runConverter(b2fOpts, outLane)
 
-                logging.info(f"Demux - Parsing stats for {outLane}")
-                _ssDic["sampleSheet"] = parseStats(
-                    outputFolder, _ssDic["sampleSheet"], mode="aviti"
+            if exitcode == 0:
+                logging.info(f"Demux - {outLane} - bases2fastq exit 0")
+                Path(outputFolder, "bases2fastq.done").touch()
+            else:
+                logging.critical(f"Demux - {outLane} - bases2fastq exit {exitcode}")
+                mailHome(
+                    outLane,
+                    f"Bases2fastq exit {exitcode}. Pipeline crashed. {_stderr}",
+                    self.config,
+                    toCore=True,
                 )
+                sys.exit(1)
+        else:
+            logging.info("Bases2fastq.done already exists. Moving forward.")
 
-            self.exitStats["demux"] = 0
+        logging.info(f"Demux - Parsing stats for {outLane}")
+        _ssDic["sampleSheet"] = parseStats(
+            outputFolder, _ssDic["sampleSheet"], mode="aviti"
+        )
 
     # postmux - postmux
     def postmux(self):
+        """
+        Rename every project, then run FastQC -> clumpify -> kraken & fanout
+        per sample and md5sums/multiqc per project (once its samples are done)
+        as one task graph over all outLanes, within [misc] threads.
+        """
         logging.info("Postmux - Demux complete, starting postmux")
+        graph = taskGraphClass(self.config["misc"]["threads"])
         for outLane in self.sampleSheet.ssDic:
             _ssDic = self.sampleSheet.ssDic[outLane]
             laneFolder = Path(self.outBaseDir, outLane)
@@ -421,34 +709,124 @@ class flowCellClass:
                         )
                     validateFqEnds(laneFolder / project, self)
                     renameFlag.touch()
+            demuxReads = demuxReadCounts(laneFolder)
             for project in projects:
                 postmuxFlag = laneFolder / f".{project}.postmux.done"
-                if not postmuxFlag.exists():
-                    _sIDs = set(df[df["Sample_Project"] == project]["Sample_ID"])
-                    # FQC
-                    logging.info(f"Postmux - FastQC {outLane} - {project}")
-                    qcs(project, laneFolder, _sIDs, self.config)
-                    # Clump
-                    logging.info(f"Postmux - Clumping {outLane} - {project}")
-                    clumper(
+                if postmuxFlag.exists():
+                    continue
+                _sIDs = set(df[df["Sample_Project"] == project]["Sample_ID"])
+                # After a rescue, only the rescued samples need a rerun.
+                rescuedFlag = laneFolder / f".{project}.rescued"
+                if rescuedFlag.exists():
+                    _sIDs &= set(rescuedFlag.read_text().split())
+                    logging.info(
+                        f"Postmux - {outLane} - {project} - rescued samples only: {sorted(_sIDs)}"
+                    )
+                (laneFolder / f"FASTQC_Project_{project}").mkdir(exist_ok=True)
+                sampleTasks = []
+                sizes = largestFirst(laneFolder, project, _sIDs)
+                for ID, size in sizes:
+                    clumpT = clumpThreads(self.config, size)
+                    krakenT = krakenThreads(self.config, size)
+                    fqc = graph.add(
+                        (outLane, project, ID, "fastqc"),
+                        partial(fastqcSample, project, laneFolder, ID, self.config),
+                        cost=2,
+                        priority=size,
+                        onFail=(
+                            laneFolder,
+                            f"FastQC runs failed for project {project}.",
+                        ),
+                    )
+                    # FastQC reads the fastqs clumpify rewrites.
+                    clump = graph.add(
+                        (outLane, project, ID, "clumpify"),
+                        partial(
+                            clumpSample,
+                            project,
+                            laneFolder,
+                            ID,
+                            self.config,
+                            _ssDic["PE"],
+                            self.sequencer,
+                            clumpT,
+                        ),
+                        cost=clumpT,
+                        priority=size,
+                        after=[fqc],
+                        onFail=(laneFolder, f"Clump runs failed for {project}."),
+                    )
+                    sampleTasks.append(
+                        graph.add(
+                            (outLane, project, ID, "kraken"),
+                            partial(
+                                krakenSample,
+                                project,
+                                laneFolder,
+                                ID,
+                                self.config,
+                                krakenT,
+                            ),
+                            cost=krakenT,
+                            priority=size,
+                            after=[clump],
+                            onFail=(laneFolder, f"Kraken runs failed for {project}."),
+                        )
+                    )
+                    # One read of the final fastqs, for md5sums & the RO-Crate.
+                    sampleTasks.append(
+                        graph.add(
+                            (outLane, project, ID, "fanout"),
+                            partial(
+                                fanoutSample,
+                                project,
+                                laneFolder,
+                                ID,
+                                self.config,
+                                demuxReads,
+                            ),
+                            priority=size,
+                            after=[clump],
+                            onFail=(
+                                laneFolder,
+                                f"Fastq checks (gzip, read counts) failed for {project}.",
+                            ),
+                        )
+                    )
+                fqFiles = list((laneFolder / f"Project_{project}").glob("*/*fastq.gz"))
+                graph.add(
+                    (outLane, project, None, "md5/multiqc"),
+                    partial(
+                        self.postmuxProject,
                         project,
                         laneFolder,
-                        _sIDs,
-                        self.config,
-                        _ssDic["PE"],
-                        self.sequencer,
-                    )
-                    # kraken
-                    logging.info(f"Postmux - kraken {outLane} - {project}")
-                    kraken(project, laneFolder, _sIDs, self.config)
-                    # multiQC
-                    logging.info(f"Postmux - md5/multiqc {outLane} - {project}")
-                    md5_multiqc(project, laneFolder, self)
-                    # Move optical duplicates
-                    moveOptDup(laneFolder)
-                    postmuxFlag.touch()
+                        postmuxFlag,
+                        rescuedFlag,
+                    ),
+                    # md5sums are hashed on its threads, multiqc is marginal.
+                    cost=md5Threads(self.config, len(fqFiles)),
+                    priority=sum(size for _ID, size in sizes),
+                    after=sampleTasks,
+                )
+        logging.info(f"Postmux - {len(graph.tasks)} tasks, {graph.budget} threads")
+        failed = graph.run()
+        if failed:
+            (outLane, project, ID, step), (laneFolder, msg) = failed
+            logging.critical(
+                f"Postmux - {step} failed for {outLane} - {project} - {ID}"
+            )
+            mailHome(laneFolder, msg, self.config, toCore=True)
+            sys.exit(1)
         self.exitStats["postmux"] = 0
 
+    def postmuxProject(self, project, laneFolder, postmuxFlag, rescuedFlag):
+        logging.info(f"Postmux - md5/multiqc {laneFolder.name} - {project}")
+        md5_multiqc(project, laneFolder, self)
+        # Move optical duplicates
+        moveOptDup(laneFolder, project)
+        postmuxFlag.touch()
+        rescuedFlag.unlink(missing_ok=True)
+
     # fakenews
     def fakenews(self):
         logging.info("fakenews - Postmux complete, starting fakenews.")
@@ -530,6 +908,8 @@ class flowCellClass:
         self.logFile = logFile
         self.config = config
         self.forceLaneSplit = forceLaneSplit
+        self._inputSize = None
+        self.inputSizeLock = threading.Lock()
 
         if sequencer == "illumina":
             # Illumina mode.
@@ -612,6 +992,8 @@ class sampleSheetClass:
          - 1 project is loaded on multiple lanes
          or
          - there are more then 1 lanes, but only 1 is specified in sampleSheet
+        unless that would make samples clash.
+        What blocked (or forced) splitting ends up in self.splitExplanation.
         """
 
         # it would actually be nicer to handle the column names on the class level
@@ -634,79 +1016,76 @@ class sampleSheetClass:
         else:
             logging.info("Deciding lanesplit using Illumina colnames.")
 
+        ss = self.fullSS
         laneSplitStatus = True
         # Do we need lane splitting or not ?
         # If there is at least one sample in more then 1 lane, we cannot split:
-        samples = list(self.fullSS[sample_colname].unique())
-        if "PhiX" in samples:
-            samples.remove("PhiX")
-        for _s in samples:
-            if (
-                len(
-                    list(
-                        self.fullSS[self.fullSS[sample_colname] == _s][
-                            lane_colname
-                        ].unique()
-                    )
-                )
-                > 1
-            ):
-                logging.info("No lane splitting: >= 1 sample in multiple lanes.")
-                laneSplitStatus = False
+        lanesPer = ss.groupby(sample_colname)[lane_colname].nunique(dropna=False)
+        samples = sorted(lanesPer[(lanesPer > 1) & (lanesPer.index != "PhiX")].index)
+        if samples:
+            logging.info(
+                f"No lane splitting: {len(samples)} sample(s) in multiple lanes, e.g. {samples[:5]}"
+            )
+            laneSplitStatus = False
         # If one project is split over multiple lanes, we also don't split:
-        projects = list(self.fullSS[project_colname].unique())
-        if "0000_PhiX_DeepSeq" in projects:
-            projects.remove("0000_PhiX_DeepSeq")
-        for project in projects:
-            if (
-                len(
-                    list(
-                        self.fullSS[self.fullSS[project_colname] == project][
-                            lane_colname
-                        ].unique()
-                    )
-                )
-                > 1
-            ):
-                logging.info("No lane splitting: >= 1 project in multiple lanes.")
-                laneSplitStatus = False
+        lanesPer = ss.groupby(project_colname)[lane_colname].nunique(dropna=False)
+        projects = sorted(
+            lanesPer[(lanesPer > 1) & (lanesPer.index != "0000_PhiX_DeepSeq")].index
+        )
+        if projects:
+            logging.info(
+                f"No lane splitting: {len(projects)} project(s) in multiple lanes, e.g. {projects[:5]}"
+            )
+            laneSplitStatus = False
         # Don't split if 1 lane in ss, multiple in runInfo
-        if len(list(self.fullSS[lane_colname].unique())) < self.runInfoLanes:
+        lanesListed = ss[lane_colname].nunique(dropna=False)
+        if lanesListed < self.runInfoLanes:
             logging.info(
-                f"No lane splitting: 1 lane listed, {self.runInfoLanes} found."
+                f"No lane splitting: {lanesListed} lane(s) listed, {self.runInfoLanes} found."
             )
             laneSplitStatus = False
         # Make sure:
         # if laneSplitStatus = False:
         # No samples can clash at all!
-        if lane_colname in list(self.fullSS.columns) and not laneSplitStatus:
-            if index1_colname in list(self.fullSS.columns) and index2_colname in list(
-                self.fullSS.columns
-            ):
-                tmpSheet = self.fullSS[[sample_colname, index1_colname, index2_colname]]
-                # A sample can sit in multiple lanes
-                # Deduplicate id - ix, ix2
-                tmpSheet = tmpSheet.drop_duplicates()
-                # combine index1 and index2
-                testSer = tmpSheet[index1_colname] + tmpSheet[index2_colname]
-            elif index1_colname in list(self.fullSS.columns):
-                tmpSheet = self.fullSS[[sample_colname, index1_colname]]
-                # same logic as above.
-                tmpSheet = tmpSheet.drop_duplicates()
-                testSer = tmpSheet[index1_colname]
-            for count in testSer.value_counts().to_dict().values():
-                if count > 1:
-                    logging.warning(
-                        "Found a sample clash even though laneSplit == False."
-                    )
-                    logging.info("Overriding laneSplitStatus to True!")
-                    laneSplitStatus = True
+        # A sample can sit in multiple lanes, so deduplicate id - ix (- ix2)
+        # first. Samples without (all) indices can't clash.
+        clashes = []
+        ixCols = []
+        if index1_colname in ss.columns:
+            ixCols = [c for c in (index1_colname, index2_colname) if c in ss.columns]
+        if lane_colname in ss.columns and not laneSplitStatus and ixCols:
+            tmpSheet = (
+                ss[[sample_colname] + ixCols].drop_duplicates().dropna(subset=ixCols)
+            )
+            clashing = tmpSheet[tmpSheet.duplicated(subset=ixCols, keep=False)]
+            clashes = [
+                {
+                    "indices": list(ix) if isinstance(ix, tuple) else [ix],
+                    "samples": list(grp[sample_colname]),
+                }
+                for ix, grp in clashing.groupby(ixCols, sort=False)
+            ]
+            if clashes:
+                logging.warning(
+                    f"Found {len(clashes)} sample clash(es) even though laneSplit == False, e.g. {clashes[:5]}"
+                )
+                logging.info("Overriding laneSplitStatus to True!")
+                laneSplitStatus = True
 
         # Force lane split if requested
         if self.forceLaneSplit:
             logging.info("Forcing lane split as per user request.")
             laneSplitStatus = True
 
+        self.splitExplanation = {
+            "laneSplit": laneSplitStatus,
+            "samplesInMultipleLanes": samples,
+            "projectsInMultipleLanes": projects,
+            "lanesListed": int(lanesListed),
+            "lanesFound": self.runInfoLanes,
+            "indexClashes": clashes,
+            "forced": bool(self.forceLaneSplit),
+        }
         logging.info(f"decide_lanesplit returns {laneSplitStatus}")
         return laneSplitStatus
 
@@ -1127,11 +1506,32 @@ class drHouseClass:
             P5RCstr += "the index sequences "
             P5RCstr += "as they are used for demultiplexing."
 
+        diagStr = ""
+        if self.barcodeDiagnosis and not self.barcodeDiagnosis["corrections"].empty:
+            diagStr = "<h3>Undetermined diagnosis</h3>"
+            diagStr += f"{self.barcodeDiagnosis['fraction']:.1%} of the undetermined "
+            diagStr += "reads match a sample with the correction below."
+            if self.barcodeDiagnosis["suggestedSheet"]:
+                diagStr += " The corrected demuxSheet is "
+                diagStr += f"{self.barcodeDiagnosis['suggestedSheet']}."
+            diagStr += tabulate(
+                [
+                    [sample, variant, p7, p5, round(reads / 1000000, 2)]
+                    for sample, variant, p7, p5, reads in self.barcodeDiagnosis[
+                        "corrections"
+                    ].itertuples(index=False, name=None)
+                ],
+                ["SampleID", "correction", "P7", "P5", "# reads (M)"],
+                tablefmt="html",
+                disable_numparse=True,
+            )
+
         msg = (
             _html.render()
             + P5RCstr
             + "<h3>Top unknown barcodes</h3>"
             + tabulate(undtableCont, undtableHead, tablefmt="html")
+            + diagStr
             + "<h3>Samples</h3>"
             + tabulate(tableCont, tableHead, tablefmt="html", disable_numparse=True)
         )
@@ -1141,6 +1541,7 @@ class drHouseClass:
         self.undetermined = qcdic["undetermined"]
         self.totalReads = qcdic["totalReads"]
         self.topBarcodes = qcdic["topBarcodes"]
+        self.barcodeDiagnosis = qcdic["barcodeDiagnosis"]
         self.spaceFree_rap = qcdic["spaceFree_rap"]
         self.spaceFree_sol = qcdic["spaceFree_sol"]
         self.runTime = qcdic["runTime"]
@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+# Lifecycle states a flowcell moves through. 'seen' flowcells are still being
+# written by the sequencer, 'ready' ones can be picked up. 'communicated' and
+# 'failed' are terminal: discovery never looks at those again, so their output
+# folders are never globbed on a poll. Use reconcile() after manually removing
+# flags to get a flowcell picked up again.
+STATES = ("seen", "ready", "demuxing", "postmux", "communicated", "failed")
+TERMINAL = ("communicated", "failed")
+# Output flags that mark an outLane as done. A flowcell is done once all of
+# its outLanes are (or failed once any of them failed): rescue re-opens a
+# single outLane of a lane-split flowcell.
+DONEFLAGS = {
+    "communication.done": "communicated",
+    "fastq.made": "communicated",
+    "run.failed": "failed",
+}
+
+AVITIPATTERN = re.compile(r"^\d{8}_[\w-]+_[\w-]+$")
+
+
+def indexPath(config, platform):
+    """
+    The index lives under the platform's flowLogDir. Configs without one
+    (e.g. the bare dicts used in tests) get an in-memory index, which behaves
+    exactly like the old full scan on every call.
+    """
+    logDir = config["Dirs"].get(f"flowLogDir_{platform}")
+    if not logDir:
+        return ":memory:"
+    Path(logDir).mkdir(parents=True, exist_ok=True)
+    return str(Path(logDir) / "flowcellIndex.sqlite")
+
+
+def outLaneState(outLane):
+    """
+    The state the flags in an outLane folder mark it as, or None.
+    """
+    for flag, state in DONEFLAGS.items():
+        if (outLane / flag).exists():
+            return state
+    return None
+
+
+def flowcellState(laneStates):
+    """
+    Combine the states of a flowcell's outLanes: failed if any of them
+    failed, communicated if all of them are, else None (still needs work).
+    """
+    if "failed" in laneStates:
+        return "failed"
+    if laneStates and all(state == "communicated" for state in laneStates):
+        return "communicated"
+    return None
+
+
+def outputState(outDir, name):
+    """
+    The done state of flowcell name from its outLanes in outDir, or None.
+    """
+    return flowcellState(
+        [outLaneState(d) for d in Path(outDir).glob(f"{name}*") if d.is_dir()]
+    )
+
+
+def flowcellNameFromOutLane(outLane):
+    """
+    210608_A00931_0309_BHCCMWDRXY_lanes_1_2 -> 210608_A00931_0309_BHCCMWDRXY
+    """
+    return outLane.split("_lanes_")[0]
+
+
+class flowcellIndexClass:
+    """
+    Persistent state index of flowcells for one platform.
+    Keeps discovery cheap on large output volumes: a poll only lists the
+    input base directory and checks the handful of non-terminal flowcells,
+    instead of globbing the output directory for every flowcell ever seen.
+    """
+
+    def connect(self):
+        con = sqlite3.connect(self.dbPath, timeout=30)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS flowcells ("
+            "name TEXT PRIMARY KEY, "
+            "path TEXT NOT NULL, "
+            "state TEXT NOT NULL, "
+            "firstSeen REAL NOT NULL, "
+            "updated REAL NOT NULL)"
+        )
+        return con
+
+    def get(self, name):
+        row = self.con.execute(
+            "SELECT name, path, state FROM flowcells WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "path": Path(row[1]), "state": row[2]}
+
+    def known(self):
+        return {
+            row[0]: row[1]
+            for row in self.con.execute("SELECT name, state FROM flowcells")
+        }
+
+    def add(self, name, path, state="seen"):
+        now = time.time()
+        with self.con:
+            self.con.execute(
+                "INSERT OR IGNORE INTO flowcells VALUES (?, ?, ?, ?, ?)",
+                (name, str(path), state, now, now),
+            )
+
+    def setState(self, name, state, path=None):
+        assert state in STATES, f"Unknown flowcell state {state}"
+        now = time.time()
+        with self.con:
+            if path is not None:
+                self.con.execute(
+                    "INSERT INTO flowcells VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET state = ?, path = ?, updated = ?",
+                    (name, str(path), state, now, now, state, str(path), now),
+                )
+            else:
+                self.con.execute(
+                    "UPDATE flowcells SET state = ?, updated = ? WHERE name = ?",
+                    (state, now, name),
+                )
+        logging.debug(f"flowcellIndex - {self.platform} - {name} -> {state}")
+
+    def pending(self):
+        """
+        Non-terminal flowcells, oldest first - the glob order of the old
+        discovery was arbitrary, first-come first-served is at least stable.
+        """
+        return [
+            (row[0], Path(row[1]), row[2])
+            for row in self.con.execute(
+                "SELECT name, path, state FROM flowcells "
+                "WHERE state NOT IN (?, ?) ORDER BY firstSeen, name",
+                TERMINAL,
+            )
+        ]
+
+    def inputDirs(self):
+        """
+        Flowcell directories currently present under the input base dir.
+        Illumina nests flowcells directly under baseDir_illumina, Aviti one
+        level deeper under a serial-ID subdir (e.g. AV251009).
+        """
+        if not self.inBaseDir.exists():
+            return []
+        if self.platform == "illumina":
+            parents = [self.inBaseDir]
+        else:
+            parents = _listDirs(self.inBaseDir)
+        return [d for parent in parents for d in _listDirs(parent)]
+
+    def scan(self):
+        """
+        Incremental scan: register input directories the index hasn't seen
+        yet. Existing entries are left untouched.
+        """
+        known = self.known()
+        new = [d for d in self.inputDirs() if d.name not in known]
+        for d in new:
+            self.add(d.name, d)
+        if new:
+            logging.info(
+                f"flowcellIndex - {self.platform} - registered {len(new)} new flowcell(s)"
+            )
+        return new
+
+    def outDir(self, flowcellDir):
+        if self.platform == "aviti":
+            # Output mirrors the serial-ID nesting of baseDir_aviti.
+            return self.outBaseDir / flowcellDir.parent.name
+        return self.outBaseDir
+
+    def doneState(self, name, flowcellDir):
+        """
+        Look for done flags in this flowcell's output folders. Returns the
+        matching terminal state, or None if the flowcell still needs work.
+        """
+        return outputState(self.outDir(flowcellDir), name)
+
+    def reconcile(self):
+        """
+        Rebuild the index from the flags on disk: every input flowcell is
+        re-registered, and its state derived from the .done/run.failed flags
+        in the output directory. The output directory is listed once and
+        globbed once per flag, not once per flowcell.
+        """
+        laneStates = {}
+        outDirs = [self.outBaseDir]
+        if self.platform == "aviti" and self.outBaseDir.exists():
+            outDirs = _listDirs(self.outBaseDir)
+        for outDir in outDirs:
+            if not outDir.exists():
+                continue
+            outLanes = dict.fromkeys(_listDirs(outDir))
+            for flag, state in DONEFLAGS.items():
+                for f in outDir.glob(f"*/{flag}"):
+                    # run.failed wins, the pipeline never ran for those.
+                    if outLanes.get(f.parent) != "failed":
+                        outLanes[f.parent] = state
+            for outLane, state in outLanes.items():
+                key = (outDir, flowcellNameFromOutLane(outLane.name))
+                laneStates.setdefault(key, []).append(state)
+        flagged = {key: flowcellState(states) for key, states in laneStates.items()}
+        with self.con:
+            self.con.execute("DELETE FROM flowcells")
+        counts = dict.fromkeys(STATES, 0)
+        for d in self.inputDirs():
+            state = flagged.get((self.outDir(d), d.name)) or self.inputState(d)
+            self.setState(d.name, state, path=d)
+            counts[state] += 1
+        logging.info(f"flowcellIndex - {self.platform} - reconciled: {counts}")
+        return counts
+
+    def inputState(self, flowcellDir):
+        """
+        State judged from the input directory only:
+         - illumina: ready once both RTAComplete.txt and CopyComplete.txt exist
+         - aviti: ready once RunUploaded.json exists, failed on OutcomeFailed
+        """
+        if self.platform == "illumina":
+            if (flowcellDir / "RTAComplete.txt").exists() and (
+                flowcellDir / "CopyComplete.txt"
+            ).exists():
+                return "ready"
+            return "seen"
+        runUploaded = flowcellDir / "RunUploaded.json"
+        if not runUploaded.exists():
+            return "seen"
+        assert AVITIPATTERN.match(flowcellDir.name), (
+            f"Aviti flow cells need to match the pattern 'YYYYMMDD_sequencer_runID'. Instead received: {flowcellDir.name}"
+        )
+        with open(runUploaded) as fh:
+            runinfo = json.load(fh)
+        if runinfo.get("outcome") == "OutcomeFailed":
+            logging.critical(
+                f"Aviti run {flowcellDir.name} has OutcomeFailed — pipeline will not start."
+            )
+            return "failed"
+        return "ready"
+
+    def candidates(self):
+        """
+        Scan for new input directories and return all flowcells that are ready
+        to be processed, as (name, path) tuples. Flowcells found to be done on
+        disk are moved into their terminal state along the way.
+        """
+        self.scan()
+        ready = []
+        for name, flowcellDir, state in self.pending():
+            if state == "seen":
+                state = self.inputState(flowcellDir)
+                if state == "seen":
+                    continue
+                self.setState(name, state)
+                if state in TERMINAL:
+                    continue
+            # Only non-terminal flowcells ever have their output checked.
+            doneState = self.doneState(name, flowcellDir)
+            if doneState:
+                self.setState(name, doneState)
+                continue
+            ready.append((name, flowcellDir))
+        return ready
+
+    def close(self):
+        self.con.close()
+
+    def __init__(self, config, platform):
+        self.platform = platform
+        self.inBaseDir = Path(config["Dirs"][f"baseDir_{platform}"])
+        self.outBaseDir = Path(config["Dirs"][f"outputDir_{platform}"])
+        self.dbPath = indexPath(config, platform)
+        self.con = self.connect()
+        if self.dbPath != ":memory:" and not self.known():
+            # First use on an existing installation: seed from the flags on
+            # disk, rather than treating years of flowcells as new.
+            self.reconcile()
+
+
+def _listDirs(path):
+    with os.scandir(path) as it:
+        return sorted(Path(e.path) for e in it if e.is_dir())
+
+
+def markFlowcell(config, platform, name, state, path=None):
+    """
+    Record a lifecycle transition for one flowcell.
+    """
+    index = flowcellIndexClass(config, platform)
+    try:
+        index.setState(name, state, path=path)
+    finally:
+        index.close()
+
+
+def settleFlowcell(config, platform, name, path):
+    """
+    After a pipeline pass, move the flowcell into the terminal state its
+    output flags say it's in. Without flags (e.g. a project failed to ship)
+    it stays non-terminal and gets picked up again on the next poll, as before.
+    """
+    index = flowcellIndexClass(config, platform)
+    try:
+        state = index.doneState(name, Path(path))
+        if state:
+            index.setState(name, state, path=path)
+        return state
+    finally:
+        index.close()
@@ -3,22 +3,23 @@ import json
 import logging
 import mimetypes
 import os
-import re
 import shutil
 import subprocess as sp
 import sys
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from importlib.metadata import version
 from pathlib import Path
 from typing import Literal
 from zipfile import ZIP_STORED, ZipFile
 
-import numpy as np
-import pandas as pd
-import requests
 from rich import print
 
+from dissectBCL.flowcellIndex import flowcellIndexClass, outputState
+
 
 def projectPI(project):
     """
@@ -37,13 +38,13 @@ def projectPI(project):
 
 
 def _resolve_internal_pis(config):
+    from dissectBCL.parkour import parkourClient
+
     url = config["parkour"]["URL"].rstrip("/") + "/api/internal_pis/"
     try:
-        response = requests.get(
-            url,
+        response = parkourClient(config).get(
+            "/api/internal_pis/",
             params={"organizations": config["Internals"]["Organizations"]},
-            auth=(config["parkour"]["user"], config["parkour"]["password"]),
-            verify=config["parkour"]["cert"],
         )
         if response.status_code != 200:
             raise RuntimeError(
@@ -77,52 +78,227 @@ def _resolve_internal_pis(config):
     return ",".join(sorted(name.lower() for name in pi_names))
 
 
+def cacheDir():
+    """
+    Per-user cache directory for dissectBCL, following the XDG spec.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path("~/.cache").expanduser()
+    return Path(base, "dissectBCL")
+
+
+def _internal_pis(config):
+    """
+    _resolve_internal_pis behind an on-disk cache (cacheDir()/internalPIs.json),
+    keyed by Parkour URL and Organizations. Governed by two [parkour] keys:
+     - piCacheTTL (seconds, default 3600): a younger list is used as is.
+     - piCacheMaxStale (seconds, default 86400): an older list, but younger
+       than this, is still used, while a background thread refreshes it.
+    Anything older, or no cache at all, means a blocking call to Parkour that
+    fails loudly exactly like _resolve_internal_pis. Empty lists are never
+    cached (they raise), so the cache can't route internal PIs to FEX either.
+    """
+    ttl = int(config["parkour"].get("piCacheTTL", 3600))
+    maxStale = max(ttl, int(config["parkour"].get("piCacheMaxStale", 86400)))
+    cacheFile = cacheDir() / "internalPIs.json"
+    key = (
+        f"{config['parkour']['URL'].rstrip('/')}|{config['Internals']['Organizations']}"
+    )
+
+    cached = None
+    try:
+        with open(cacheFile) as f:
+            cached = json.load(f).get(key)
+    except (OSError, ValueError):
+        pass
+    if cached and cached.get("pis"):
+        age = time.time() - cached["fetched"]
+        if age < ttl:
+            logging.info(f"Internal PIs - using cached list, {age:.0f}s old.")
+            return cached["pis"]
+        if age < maxStale:
+            logging.info(
+                f"Internal PIs - using stale cached list, {age:.0f}s old, refreshing in the background."
+            )
+            threading.Thread(
+                target=_refresh_internal_pis,
+                args=(config, cacheFile, key),
+                daemon=True,
+            ).start()
+            return cached["pis"]
+        logging.info(f"Internal PIs - cached list too old ({age:.0f}s), refetching.")
+    return _refresh_internal_pis(config, cacheFile, key, background=False)
+
+
+def _refresh_internal_pis(config, cacheFile, key, background=True):
+    """
+    Fetch the internal PI list and store it in the cache. In the background a
+    failure only gets logged (the stale list keeps being used until
+    piCacheMaxStale), in the foreground it's raised.
+    """
+    try:
+        pis = _resolve_internal_pis(config)
+    except RuntimeError as e:
+        if not background:
+            raise
+        logging.warning(f"Internal PIs - background refresh failed: {e}")
+        return None
+    try:
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[key] = {"pis": pis, "fetched": time.time()}
+        cacheFile.parent.mkdir(parents=True, exist_ok=True)
+        tmpFile = cacheFile.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmpFile, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmpFile, cacheFile)
+    except OSError as e:
+        logging.warning(f"Internal PIs - couldn't write cache {cacheFile}: {e}")
+    logging.info("Internal PIs - fetched fresh list from Parkour.")
+    return pis
+
+
+def _binaryKey(binary):
+    """
+    Identify a binary by its resolved path, mtime and size, so an upgraded or
+    shadowed binary never reuses the version that was cached for another one.
+    Returns None if the binary can't be found (it's probed, not cached).
+    """
+    resolved = shutil.which(binary)
+    if resolved is None:
+        return None
+    resolved = os.path.realpath(resolved)
+    try:
+        st = os.stat(resolved)
+    except OSError:
+        return None
+    return f"{resolved}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _parseBclconvert(p):
+    return p.stderr.decode().splitlines()[0].split(" ")[2]
+
+
+def _parseBases2fastq(p):
+    return (p.stdout or p.stderr).strip().split()[2].rstrip(",")
+
+
+def _parseFastqc(p):
+    return p.stdout.decode().splitlines()[0].split(" ")[1]
+
+
+def _parseKraken2(p):
+    return p.stdout.decode().splitlines()[0].split(" ")[2]
+
+
+def _parseClumpify(p):
+    for line in p.stderr.decode().splitlines():
+        if "BBTools version" in line:
+            return line.split(" ")[2]
+    return "Not found"
+
+
+def _probeVersion(binary, parser, text=False):
+    start = time.perf_counter()
+    p = sp.run([binary, "--version"], capture_output=True, text=text)
+    return parser(p), time.perf_counter() - start
+
+
+def getSoftwareVersions(config, sequencer=None):
+    """
+    Versions of the external tools, as {name: version}, plus the time spent
+    per tool. Versions are cached in cacheDir()/toolVersions.json keyed by
+    _binaryKey, so a tool is only probed again when its binary changes. All
+    cache misses are probed at the same time.
+    """
+    probes = {}
+    if sequencer in (None, "illumina"):
+        # bcl-convertVer -> Illumina demultiplexer
+        probes["bclconvert"] = (config["software"]["bclconvert"], _parseBclconvert)
+    if sequencer in (None, "aviti"):
+        # bases2fastq -> Aviti demultiplexer
+        probes["bases2fastq"] = (config["software"]["bases2fastq"], _parseBases2fastq)
+    probes["fastqc"] = ("fastqc", _parseFastqc)
+    probes["kraken2"] = ("kraken2", _parseKraken2)
+    probes["bbmap"] = ("clumpify.sh", _parseClumpify)
+
+    cacheFile = cacheDir() / "toolVersions.json"
+    try:
+        with open(cacheFile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    vers = {}
+    timings = {}
+    misses = {}
+    for soft, (binary, _parser) in probes.items():
+        key = _binaryKey(binary)
+        if key is not None and key in cache:
+            vers[soft] = cache[key]
+            timings[soft] = "cached"
+        else:
+            misses[soft] = key
+
+    if misses:
+        with ThreadPoolExecutor(max_workers=len(misses)) as executor:
+            futures = {
+                soft: executor.submit(
+                    _probeVersion,
+                    probes[soft][0],
+                    probes[soft][1],
+                    text=(soft == "bases2fastq"),
+                )
+                for soft in misses
+            }
+            for soft, future in futures.items():
+                try:
+                    vers[soft], took = future.result()
+                except Exception as e:
+                    if soft != "bases2fastq":
+                        raise
+                    vers[soft] = f"Error fetching version: {e}"
+                    timings[soft] = "failed"
+                    continue
+                timings[soft] = f"{took:.2f}s"
+                # Only real versions are cached, a failed probe is retried.
+                if misses[soft] is not None and vers[soft] != "Not found":
+                    cache[misses[soft]] = vers[soft]
+        try:
+            cacheFile.parent.mkdir(parents=True, exist_ok=True)
+            tmpFile = cacheFile.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmpFile, "w") as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmpFile, cacheFile)
+        except OSError as e:
+            logging.warning(f"Couldn't write version cache {cacheFile}: {e}")
+    # Keep the order of the probes.
+    return {soft: vers[soft] for soft in probes}, timings
+
+
 def getConf(
     configfile,
     quickload=False,
     sequencer: Literal["aviti", "illumina"] | None = None,
 ):
+    timings = {}
+    start = time.perf_counter()
     config = configparser.ConfigParser()
     logging.info(f"Reading configfile from {configfile}")
     config.read(configfile)
-    config["Internals"]["PIs"] = _resolve_internal_pis(config)
+    timings["config"] = f"{time.perf_counter() - start:.2f}s"
+    start = time.perf_counter()
+    config["Internals"]["PIs"] = _internal_pis(config)
+    timings["internal PIs"] = f"{time.perf_counter() - start:.2f}s"
     if not quickload:
+        start = time.perf_counter()
         config["softwareVers"] = {}
-        # bcl-convertVer -> Illumina demultiplexer
-        if sequencer in (None, "illumina"):
-            p = sp.run(
-                [config["software"]["bclconvert"], "--version"],
-                capture_output=True,
-            )
-            config["softwareVers"]["bclconvert"] = (
-                p.stderr.decode().splitlines()[0].split(" ")[2]
-            )
-        # bases2fastq -> Aviti demultiplexer
-        if sequencer in (None, "aviti"):
-            try:
-                p = sp.run(
-                    [config["software"]["bases2fastq"], "--version"],
-                    capture_output=True,
-                    text=True,
-                )
-                config["softwareVers"]["bases2fastq"] = (
-                    (p.stdout or p.stderr).strip().split()[2].rstrip(",")
-                )
-            except Exception as e:
-                config["softwareVers"]["bases2fastq"] = f"Error fetching version: {e}"
-        # fastqcVer
-        p = sp.run(["fastqc", "--version"], capture_output=True)
-        fastqc = p.stdout.decode().splitlines()[0].split(" ")[1]
-        # kraken2 version
-        p = sp.run(["kraken2", "--version"], capture_output=True)
-        kraken2 = p.stdout.decode().splitlines()[0].split(" ")[2]
-        # clumpifyVer
-        p = sp.run(["clumpify.sh", "--version"], capture_output=True)
-        clumpify = "Not found"
-        lines = p.stderr.decode().splitlines()
-        for line in lines:
-            if "BBTools version" in line:
-                clumpify = line.split(" ")[2]
+        vers, probeTimings = getSoftwareVersions(config, sequencer)
+        for soft in ("bclconvert", "bases2fastq"):
+            if soft in vers:
+                config["softwareVers"][soft] = vers[soft]
         # splitFastq -> bespoke internal binary, has no --version flag, so
         # report the resolved path and its build date instead. This is the
         # exact information that would have caught a stale/shadowed binary
@@ -137,9 +313,12 @@ def getConf(
             config["softwareVers"]["splitFastq"] = f"Error fetching version: {e}"
         # Set the remaining, sequencer-independent versions.
         config["softwareVers"]["multiqc"] = version("multiqc")
-        config["softwareVers"]["kraken2"] = kraken2
-        config["softwareVers"]["bbmap"] = clumpify
-        config["softwareVers"]["fastqc"] = fastqc
+        config["softwareVers"]["kraken2"] = vers["kraken2"]
+        config["softwareVers"]["bbmap"] = vers["bbmap"]
+        config["softwareVers"]["fastqc"] = vers["fastqc"]
+        for soft, took in probeTimings.items():
+            timings[f"  {soft}"] = took
+        timings["software versions"] = f"{time.perf_counter() - start:.2f}s"
         print("Detected software versions:")
         for soft, ver in config["softwareVers"].items():
             print(f"  {soft} = {ver}")
@@ -148,6 +327,16 @@ def getConf(
             sys.exit(
                 f"Fastqc adapters file under {config['software']['fastqc_adapters']} not found. Please check your config file."
             )
+    # Quickloads are for wd40, email & co., which print their own output.
+    if not quickload:
+        print("Startup timing:")
+    for step, took in timings.items():
+        if not quickload:
+            print(f"  {step} = {took}")
+        logging.log(
+            logging.DEBUG if quickload else logging.INFO,
+            f"Startup - {step.strip()} = {took}",
+        )
     return config
 
 
@@ -168,78 +357,50 @@ def getNewFlowCell(
         if sequencer == "aviti":
             # Output mirrors the serial-ID nesting of baseDir_aviti.
             outBaseDir = outBaseDir / fPath.parent.name
-        if not any(outBaseDir.glob(f"{flowcellName}*/communication.done")):
+        if outputState(outBaseDir, flowcellName) != "communicated":
             return (flowcellName, flowcellDir, sequencer)
         else:
             print(
-                f"[red]{flowcellName} exists with a communication.done flag already.[/red]"
+                f"[red]{flowcellName} has a communication.done flag in every outLane already.[/red]"
             )
             sys.exit()
 
-    _patterns = ["communication.done", "fastq.made", "run.failed"]
+    candidates = listNewFlowCells(config, sequencer, firstOnly=True)
+    if candidates:
+        return candidates[0]
+    return (None, None, None)
 
-    print("Checking for new flowcells...")
 
-    # Illumina
-    if sequencer in (None, "illumina"):
-        outBaseDir = Path(config["Dirs"]["outputDir_illumina"])
-        baseDir_illumina = config["Dirs"]["baseDir_illumina"]
-        # Glob over the baseDir to get all flowcells.
-        flowCells = list(Path(baseDir_illumina).glob("*/RTAComplete.txt"))
-        # Check if the flowcell exists in the output directory.
-        for flowcell in flowCells:
-            flowcellName = flowcell.parent.name
-            flowcellDir = flowcell.parent
-            # Make sure copycomplete exists.
-            # Look for a folder containing the flowcellname.
-            # no folder with name -> start the pipeline.
-            if (Path(flowcellDir) / "CopyComplete.txt").exists() and (
-                not any(outBaseDir.glob(f"{flowcellName}*"))
-                or not any(
-                    any(outBaseDir.glob(f"{flowcellName}*/{pattern}"))
-                    for pattern in _patterns
-                )
-            ):
-                return (flowcellName, flowcellDir, "illumina")
-        print("  No new illumina flowcells found.")
-
-    # Aviti
-    if sequencer in (None, "aviti"):
-        outBaseDir = Path(config["Dirs"]["outputDir_aviti"])
-        baseDir_aviti = config["Dirs"]["baseDir_aviti"]
-        # baseDir_aviti holds one subdir per sequencer serial ID (e.g.
-        # AV251009, AV261103, ...), each holding its own flowcells - hence
-        # the extra "*/" level versus the Illumina glob above. New machines
-        # just show up as another serial-ID subdir, no config change needed.
-        flowCells = list(Path(baseDir_aviti).glob("*/*/RunUploaded.json"))
-        _flowcellpattern = re.compile(r"^\d{8}_[\w-]+_[\w-]+$")
-        for flowcell in flowCells:
-            flowcellName = flowcell.parent.name
-
-            assert _flowcellpattern.match(flowcellName), (
-                f"Aviti flow cells need to match the pattern 'YYYYMMDD_sequencer_runID'. Instead received: {flowcellName}"
-            )
-            flowcellDir = flowcell.parent
-            # Output mirrors the serial-ID nesting of baseDir_aviti.
-            serialOutDir = outBaseDir / flowcellDir.parent.name
-            # check if the run completed successfully or failed
-            with open(flowcell) as fh:
-                runinfo = json.load(fh)
-                if runinfo.get("outcome") == "OutcomeFailed":
-                    logging.critical(
-                        f"Aviti run {flowcellName} has OutcomeFailed — pipeline will not start."
-                    )
-                    continue
-            # Look for a folder containing the flowcellname.
-            # no folder with name -> start the pipeline.
-            if not any(serialOutDir.glob(f"{flowcellName}*")) or not any(
-                any(serialOutDir.glob(f"{flowcellName}*/{pattern}"))
-                for pattern in _patterns
-            ):
-                return (flowcellName, flowcellDir, "aviti")
-        print("  No new aviti flowcells found.")
+def listNewFlowCells(
+    config,
+    sequencer: Literal["aviti", "illumina"] | None = None,
+    firstOnly: bool = False,
+) -> list[tuple[str, Path, str]]:
+    """
+    All flowcells that are ready to be processed, as
+    (flowcellName, flowcellDir, platform) tuples.
+    """
+    print("Checking for new flowcells...")
 
-    return (None, None, None)
+    # Discovery goes through the flowcell index: only input directories that
+    # weren't seen on an earlier poll are registered, and only flowcells that
+    # aren't communicated/failed yet get their output folders checked.
+    found = []
+    for platform in ("illumina", "aviti"):
+        if sequencer not in (None, platform):
+            continue
+        index = flowcellIndexClass(config, platform)
+        try:
+            candidates = index.candidates()
+        finally:
+            index.close()
+        if candidates:
+            found += [(name, path, platform) for name, path in candidates]
+            if firstOnly:
+                return found
+        else:
+            print(f"  No new {platform} flowcells found.")
+    return found
 
 
 def parseRunInfo(runInfo):
@@ -282,6 +443,47 @@ def hamming(s1, s2):
     return dist
 
 
+def hammingMatrix(barcodes, blockBytes=1 << 24):
+    """
+    All pairwise hamming distances between barcodes, as an n x n int matrix.
+    Same semantics as hamming: only the first min(len(a), len(b)) positions
+    are compared, and anything that isn't a string (NaN, None) is at
+    distance 0 of everything. Barcodes are encoded as uint8 arrays, and the
+    comparison runs in row blocks of about blockBytes to bound memory.
+    """
+    import numpy as np
+
+    barcodes = list(barcodes)
+    n = len(barcodes)
+    valid = np.array([isinstance(b, str) for b in barcodes], dtype=bool)
+    lengths = np.array([len(b) if isinstance(b, str) else 0 for b in barcodes])
+    maxLen = int(lengths.max()) if n else 0
+    dist = np.zeros((n, n), dtype=np.int32)
+    if n == 0 or maxLen == 0:
+        return dist
+    encoded = np.frombuffer(
+        b"".join(
+            b.encode("latin-1", errors="replace").ljust(maxLen, b"\0")
+            if isinstance(b, str)
+            else bytes(maxLen)
+            for b in barcodes
+        ),
+        dtype=np.uint8,
+    ).reshape(n, maxLen)
+    positions = np.arange(maxLen)
+    step = max(1, blockBytes // (n * maxLen))
+    for start in range(0, n, step):
+        block = encoded[start : start + step]
+        minLen = np.minimum(lengths[start : start + step, None], lengths[None, :])
+        mismatch = (block[:, None, :] != encoded[None, :, :]) & (
+            positions[None, None, :] < minLen[:, :, None]
+        )
+        dist[start : start + step] = mismatch.sum(axis=2)
+    dist[~valid, :] = 0
+    dist[:, ~valid] = 0
+    return dist
+
+
 def joinLis(lis, joinStr=""):
     """
     join a list into a string (without spaces).
@@ -315,6 +517,8 @@ def P5Seriesret(df, aviti=False):
     always "not found", so misMatcher silently never computes an
     I2MismatchThreshold for that platform.
     """
+    import pandas as pd
+
     index2_colname = "Index2" if aviti else "index2"
     if index2_colname in list(df.columns):
         return df[index2_colname]
@@ -346,6 +550,62 @@ def krakenfqs(IDdir):
         return (krakRep, ["--paired", str(fqFiles[0]), str(fqFiles[1])])
 
 
+def fanoutFile(sampleDir):
+    """
+    Project_x/Sample_y -> FASTQC_Project_x/Sample_y/fanout.json, where
+    postmux keeps what it learned from a single pass over the sample's fastqs.
+    """
+    sampleDir = Path(sampleDir)
+    projectDir = sampleDir.parent
+    return (
+        projectDir.parent / f"FASTQC_{projectDir.name}" / sampleDir.name / "fanout.json"
+    )
+
+
+def subsampleDir(sampleDir):
+    """
+    Project_x/Sample_y -> Subsamples/Project_x/Sample_y in the outLane, where
+    postmux writes the read subsamples of a sample. Outside of the
+    Project_x and FASTQC_Project_x folders, so they aren't shipped.
+    """
+    sampleDir = Path(sampleDir)
+    projectDir = sampleDir.parent
+    return projectDir.parent / "Subsamples" / projectDir.name / sampleDir.name
+
+
+def fanoutRecords(sampleDir):
+    """
+    All fan-out records of a sample folder as {fastq name: record}, empty
+    if there's no (readable) fanout.json. Check them with fanoutRecord.
+    """
+    try:
+        with open(fanoutFile(sampleDir)) as f:
+            return json.load(f)["files"]
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def fanoutRecord(fqFile, records=None):
+    """
+    The fan-out record (md5, crc32, reads, ...) of a fastq, None if there
+    is none or the file changed since (size or mtime differ). records are
+    the fanoutRecords of the fastq's folder, read from disk if not given.
+    """
+    fqFile = Path(fqFile)
+    if records is None:
+        records = fanoutRecords(fqFile.parent)
+    rec = records.get(fqFile.name)
+    if rec is None:
+        return None
+    try:
+        st = fqFile.stat()
+    except OSError:
+        return None
+    if rec["error"] or (rec["size"], rec["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        return None
+    return rec
+
+
 def retBCstr(ser, returnHeader=False):
     if returnHeader:
         if "index2" in list(ser.index):
@@ -380,6 +640,8 @@ def retMean_perc_Q(ser, returnHeader=False, qtype="meanQ"):
             return ("meanQ", "NA")
         else:
             return "NA"
+    import pandas as pd
+
     if pd.isna(ser[qtype]):
         return "NA"
     meanQstr = str(ser[qtype])
@@ -518,6 +780,8 @@ def multiQC_yaml(flowcell, project, laneFolder):
      - data string containing our old seqreport statistics.
     Keep in mind we delete these after running mqc
     """
+    import numpy as np
+
     logging.info("Postmux - multiqc yaml creation")
     ssDic = flowcell.sampleSheet.ssDic[laneFolder.name]
     ssdf = ssDic["sampleSheet"][ssDic["sampleSheet"]["Sample_Project"] == project]
@@ -651,13 +915,12 @@ def getDiskSpace(outputDir):
 
 
 def _fetch_ro_crate_metadata(request_id, config):
-    url = config["parkour"]["URL"].rstrip("/") + "/api/generate_ro_crate/"
+    from dissectBCL.parkour import parkourClient
+
     try:
-        response = requests.get(
-            url,
+        response = parkourClient(config).get(
+            "/api/generate_ro_crate/",
             params={"requests": request_id, "preview": "true"},
-            auth=(config["parkour"]["user"], config["parkour"]["password"]),
-            verify=config["parkour"]["cert"],
         )
         response.raise_for_status()
         return response.json()["ro_crate"]
@@ -747,14 +1010,26 @@ def _build_ro_crate_archive(outLane, project, opas, ro_crate_metadata, fileobj=N
         archive_name = f"{outLane}_{project}_ro_crate.zip"
         target = Path(opas[0]).parent / archive_name
 
+    # fanout.json is read once per sample folder, not once per file.
+    records = {}
     with ZipFile(target, "w", compression=ZIP_STORED) as zip_file:
         for folder in opas:
             folder = Path(folder)
             for file_path in folder.rglob("*"):
                 if file_path.is_file():
-                    zip_file.write(
-                        file_path, arcname=file_path.relative_to(folder.parent)
-                    )
+                    arcname = file_path.relative_to(folder.parent)
+                    if file_path.parent not in records:
+                        records[file_path.parent] = fanoutRecords(file_path.parent)
+                    rec = fanoutRecord(file_path, records[file_path.parent])
+                    zip_file.write(file_path, arcname=arcname)
+                    # The CRC zipfile computed while writing has to match the
+                    # one from postmux, or the fastq got corrupted on the way.
+                    crc = zip_file.getinfo(str(arcname)).CRC
+                    if rec is not None and crc != rec["crc32"]:
+                        raise ValueError(
+                            f"CRC32 of {file_path} changed since postmux "
+                            f"({crc:08x} != {rec['crc32']:08x})."
+                        )
         if ro_crate_metadata is not None:
             zip_file.writestr(
                 "ro-crate-metadata.json",
@@ -856,6 +1131,9 @@ def matchOptdupsReqs(optDups, ssdf):
     returns a nested list including req/got & got
     this list is sorted by sampleID.
     """
+    import numpy as np
+    import pandas as pd
+
     _optDups = []
     for lis in optDups:
         sampleID = lis[1]
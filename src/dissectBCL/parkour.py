@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+import threading
+import time
+
+# Responses worth another try: rate limiting, and Parkour (or its proxy)
+# being restarted/overloaded.
+RETRYSTATUS = (429, 500, 502, 503, 504)
+CONNECTTIMEOUT = 10
+
+
+def endpointName(path):
+    """
+    /api/requests/1234/put_filepaths/ -> /api/requests/<id>/put_filepaths/
+    so metrics are per endpoint, not per request ID.
+    """
+    return re.sub(r"/\d+(?=/|$)", "/<id>", path.split("?")[0])
+
+
+class parkourClientClass:
+    """
+    One pooled, keep-alive session for all traffic to Parkour.
+    Authentication and certificate are set on the session once. Every call
+    gets a (connect, read) timeout, and connection errors and 429/5xx answers
+    are retried with exponential backoff. The endpoints we POST to
+    (run_statistics/upload, put_filepaths) overwrite what's there, so they
+    are retried too. After the last retry the final response is returned, so
+    callers keep checking status codes as before.
+    Latencies are recorded per endpoint, see metrics().
+    """
+
+    def request(self, method, path, **kwargs):
+        url = self.url + "/" + path.lstrip("/")
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = f"{method} {endpointName(path)}"
+        start = time.perf_counter()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except Exception:
+            self._record(endpoint, time.perf_counter() - start, error=True)
+            raise
+        took = time.perf_counter() - start
+        self._record(endpoint, took, error=res.status_code >= 400)
+        logging.debug(f"parkour - {endpoint} - {res.status_code} in {took:.2f}s")
+        return res
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def _record(self, endpoint, took, error=False):
+        with self.lock:
+            m = self.latencies.setdefault(
+                endpoint, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0}
+            )
+            m["calls"] += 1
+            m["errors"] += int(error)
+            m["total"] += took
+            m["max"] = max(m["max"], took)
+
+    def metrics(self):
+        """
+        {endpoint: {calls, errors, mean, max}}, latencies in seconds.
+        """
+        with self.lock:
+            return {
+                endpoint: {
+                    "calls": m["calls"],
+                    "errors": m["errors"],
+                    "mean": round(m["total"] / m["calls"], 3),
+                    "max": round(m["max"], 3),
+                }
+                for endpoint, m in self.latencies.items()
+            }
+
+    def __init__(self, url, auth, cert, timeout=60, retries=3, backoff=0.5):
+        # Only once Parkour is talked to, the console scripts don't pay for
+        # importing requests at startup.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.url = url.rstrip("/")
+        self.timeout = (CONNECTTIMEOUT, timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRYSTATUS,
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = cert
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+
+_clients = {}
+
+
+def getParkourClient(url, auth, cert, timeout=60, retries=3):
+    """
+    The shared client for this Parkour instance. Keyed on the pid as well:
+    a forked flowcell process must not reuse its parent's sockets.
+    """
+    key = (os.getpid(), url.rstrip("/"), tuple(auth), cert)
+    if key not in _clients:
+        _clients[key] = parkourClientClass(
+            url, auth, cert, timeout=timeout, retries=retries
+        )
+    return _clients[key]
+
+
+def parkourClient(config):
+    """
+    getParkourClient from the [parkour] block of the config.
+    Optional keys: timeout (read timeout in seconds, default 60) and
+    retries (default 3).
+    """
+    return getParkourClient(
+        config["parkour"]["URL"],
+        (config["parkour"]["user"], config["parkour"]["password"]),
+        config["parkour"]["cert"],
+        timeout=int(config["parkour"].get("timeout", 60)),
+        retries=int(config["parkour"].get("retries", 3)),
+    )
+
+
+def logParkourMetrics():
+    """
+    Log the per-endpoint latencies of all clients used in this process.
+    """
+    for (pid, url, _auth, _cert), client in _clients.items():
+        if pid != os.getpid():
+            continue
+        for endpoint, m in client.metrics().items():
+            logging.info(
+                f"parkour - {url} {endpoint} - calls: {m['calls']}, errors: {m['errors']}, "
+                f"mean: {m['mean']}s, max: {m['max']}s"
+            )
@@ -1,18 +1,32 @@
+import gzip
 import hashlib
+import json
 import logging
+import math
 import os
+import random
 import re
 import shutil
 import sys
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from multiprocessing import Pool
 from pathlib import Path
 from subprocess import DEVNULL, Popen
 
 import ruamel.yaml
-from pandas import isna
+from pandas import isna, read_csv
 
 from dissectBCL.fakeNews import mailHome
-from dissectBCL.misc import krakenfqs, multiQC_yaml
+from dissectBCL.misc import (
+    fanoutFile,
+    fanoutRecord,
+    fanoutRecords,
+    krakenfqs,
+    multiQC_yaml,
+    subsampleDir,
+)
 
 
 def matchIDtoName(ID, ssdf):
@@ -121,6 +135,39 @@ def validateFqEnds(pdir, flowcell):
         sys.exit(1)
 
 
+# Bytes of fastq.gz per clumpify / kraken2 thread. Small samples get fewer
+# threads, so more of them run side by side.
+CLUMPBYTESPERTHREAD = 1 << 29
+KRAKENBYTESPERTHREAD = 1 << 30
+MD5BUFFER = 1 << 20
+# Reads kept per fastq by the fan-out pass, for screens that don't need all.
+SUBSAMPLEREADS = 100000
+
+
+def sampleSize(laneFolder, project, ID):
+    """
+    Bytes of fastq.gz in a sample folder, 0 if it doesn't exist.
+    """
+    sampleDir = laneFolder / f"Project_{project}" / f"Sample_{ID}"
+    return sum(f.stat().st_size for f in sampleDir.glob("*fastq.gz"))
+
+
+def largestFirst(laneFolder, project, sampleIDs):
+    """
+    [(ID, bytes), ...], largest sample first. Started first, the largest
+    sample doesn't end up last, with every other worker idling.
+    """
+    sizes = [(ID, sampleSize(laneFolder, project, ID)) for ID in sampleIDs]
+    return sorted(sizes, key=lambda x: (-x[1], x[0]))
+
+
+def sizeThreads(size, maxThreads, bytesPerThread):
+    """
+    Threads for a sample of size bytes: one per bytesPerThread, 1 to maxThreads.
+    """
+    return max(1, min(maxThreads, -(-size // bytesPerThread)))
+
+
 def fqcRunner(cmd):
     cmds = cmd.split(" ")
     qcRun = Popen(cmds, stdout=DEVNULL, stderr=DEVNULL)
@@ -128,42 +175,50 @@ def fqcRunner(cmd):
     return exitcode
 
 
+def fastqcCmd(project, laneFolder, ID, config):
+    """
+    The FastQC command for one sample, or None if there's nothing (left) to do.
+    """
+    # Colliding samples are omitted, and don't have a folder.
+    fqFolder = laneFolder / f"Project_{project}" / f"Sample_{ID}"
+    if not fqFolder.exists():
+        return None
+    IDFolder = laneFolder / f"FASTQC_Project_{project}" / f"Sample_{ID}"
+    IDFolder.mkdir(parents=True, exist_ok=True)
+    # Don't do double work.
+    if len(list(IDFolder.glob("*zip"))) > 0:
+        return None
+    fqFiles = [str(i) for i in fqFolder.glob("*fastq.gz")]
+    return " ".join(
+        [
+            "fastqc",
+            "-a",
+            config["software"]["fastqc_adapters"],
+            "-q",
+            "-t",
+            "2",
+            "-o",
+            IDFolder._str,
+        ]
+        + fqFiles
+    )
+
+
 def qcs(project, laneFolder, sampleIDs, config):
     # make fastqc folder.
     fqcFolder = laneFolder / f"FASTQC_Project_{project}"
     fqcFolder.mkdir(exist_ok=True)
-    fastqcCmds = []
     # Decide threading setup - aim to have 2 threads per fastqc instance.
     num_pool_runners = max(1, int(config["misc"]["threads"]) // 2)
-    for ID in sampleIDs:
-        # Colliding samples are omitted, and don't have a folder.
-        fqFolder = laneFolder / f"Project_{project}" / f"Sample_{ID}"
-        if not fqFolder.exists():
-            continue
-        IDFolder = fqcFolder / f"Sample_{ID}"
-        IDFolder.mkdir(exist_ok=True)
-        fqFiles = [str(i) for i in fqFolder.glob("*fastq.gz")]
-        # Don't do double work.
-        if len(list(IDFolder.glob("*zip"))) == 0:
-            fastqcCmds.append(
-                " ".join(
-                    [
-                        "fastqc",
-                        "-a",
-                        config["software"]["fastqc_adapters"],
-                        "-q",
-                        "-t",
-                        "2",
-                        "-o",
-                        IDFolder._str,
-                    ]
-                    + fqFiles
-                )
-            )
+    fastqcCmds = [
+        fastqcCmd(project, laneFolder, ID, config)
+        for ID, _size in largestFirst(laneFolder, project, sampleIDs)
+    ]
+    fastqcCmds = [cmd for cmd in fastqcCmds if cmd]
     if fastqcCmds:
         logging.info(f"Postmux - FastQC - command example: {project} - {fastqcCmds[0]}")
         with Pool(num_pool_runners) as p:
-            fqcReturns = p.map(fqcRunner, fastqcCmds)
+            fqcReturns = p.map(fqcRunner, fastqcCmds, chunksize=1)
             if fqcReturns.count(0) == len(fqcReturns):
                 logging.info(f"Postmux - FastQC done for {project}.")
             else:
@@ -179,33 +234,113 @@ def qcs(project, laneFolder, sampleIDs, config):
         logging.info(f"Postmux - Seems all FastQCs already done for {project}")
 
 
+def waitPipeline(procs, grace=60):
+    """
+    Wait for processes that talk through a FIFO (procs in pipeline order,
+    the writer first) and return their exit codes.
+    Once one of them fails, the rest is killed: opening a FIFO blocks
+    until the other end is opened too, so they could wait forever.
+    The same goes for a writer whose reader exited cleanly without having
+    read (all of) it: it's killed after grace seconds. A reader that is
+    still busy after its writer exited cleanly is left alone, however
+    long it takes.
+    """
+    orphanedSince = None
+    while None in (codes := [p.poll() for p in procs]):
+        failed = any(code not in (None, 0) for code in codes)
+        orphaned = any(code == 0 and None in codes[:i] for i, code in enumerate(codes))
+        if orphaned and orphanedSince is None:
+            orphanedSince = time.monotonic()
+        if failed or (orphaned and time.monotonic() - orphanedSince > grace):
+            for p in procs:
+                if p.poll() is None:
+                    p.kill()
+        time.sleep(0.1)
+    return tuple(codes)
+
+
 def clmpRunner(cmd):
     cmds = cmd.split(" ")
     splitFastqBin = cmds.pop(-1)
+    stream = cmds.pop(-1) == "1"
     effthreads = cmds.pop(-1)
     baseName = cmds.pop(-1)
     PE = str(cmds.pop(-1))
     samplePath = cmds.pop(-1)
-    os.chdir(samplePath)
-    logging.info(f"Clumpify - {baseName}")
-    clumpRun = Popen(cmds, stdout=DEVNULL, stderr=DEVNULL)
-    exitcode = clumpRun.wait()
-    logging.info(f"Clumpify - {baseName} - splitfq")
+    # Run in the sample folder without chdir'ing: clumpify runs in threads
+    # next to other postmux steps, which share the process' cwd.
+    tmpFq = Path(samplePath, "tmp.fq.gz")
     splitCmd = [splitFastqBin]
     if PE == "0":
         splitCmd.append("--SE")
-    splitCmd += ["--pigzThreads", str(effthreads), "tmp.fq.gz", baseName]
-    splitFq = Popen(splitCmd, stdout=DEVNULL, stderr=DEVNULL)
+    splitCmd += ["--pigzThreads", str(effthreads), tmpFq.name]
+    if stream:
+        # clumpify writes into a FIFO splitFastq reads from, the interleaved
+        # reads never hit the disk. splitFastq runs while clumpify still reads
+        # the fastqs it would overwrite, so it writes next to them and the
+        # results replace them once both are done.
+        logging.info(f"Clumpify - {baseName} - streaming into splitfq")
+        splitBase = f"{baseName}.clumped"
+        tmpFq.unlink(missing_ok=True)
+        os.mkfifo(tmpFq)
+        try:
+            clumpRun = Popen(cmds, stdout=DEVNULL, stderr=DEVNULL, cwd=samplePath)
+            try:
+                splitFq = Popen(
+                    splitCmd + [splitBase],
+                    stdout=DEVNULL,
+                    stderr=DEVNULL,
+                    cwd=samplePath,
+                )
+            except OSError:
+                clumpRun.kill()
+                clumpRun.wait()
+                raise
+            exitcode, exitcode_split = waitPipeline([clumpRun, splitFq])
+        finally:
+            tmpFq.unlink(missing_ok=True)
+        ok = (exitcode, exitcode_split) == (0, 0)
+        # The fastqs as well as the .duplicate.txt splitFastq writes.
+        for out in Path(samplePath).glob(f"{splitBase}*"):
+            if ok:
+                os.replace(out, out.with_name(baseName + out.name[len(splitBase) :]))
+            else:
+                out.unlink()
+        if not ok:
+            logging.critical(
+                f"Clumpify - {baseName} - clumpify exited with {exitcode}, "
+                f"splitFastq with {exitcode_split}"
+            )
+        return (exitcode, exitcode_split)
+    logging.info(f"Clumpify - {baseName}")
+    clumpRun = Popen(cmds, stdout=DEVNULL, stderr=DEVNULL, cwd=samplePath)
+    exitcode = clumpRun.wait()
+    logging.info(f"Clumpify - {baseName} - splitfq")
+    splitFq = Popen(
+        splitCmd + [baseName], stdout=DEVNULL, stderr=DEVNULL, cwd=samplePath
+    )
     exitcode_split = splitFq.wait()
-    os.remove("tmp.fq.gz")
+    os.remove(tmpFq)
     return (exitcode, exitcode_split)
 
 
-def clumper(project, laneFolder, sampleIDs, config, PE, sequencer):
-    # Decide threading setup - aim to have 2 threads per fastqc instance.
-    configthreads = int(config["misc"]["threads"])
-    num_pool_runners = max(1, configthreads // 10)
-    effthreads = 10 if configthreads >= 10 else configthreads
+def clumpThreads(config, size=None):
+    """
+    Threads per clumpify run, at most 10, scaled down for small samples.
+    """
+    maxThreads = min(10, int(config["misc"]["threads"]))
+    if size is None:
+        return maxThreads
+    return sizeThreads(size, maxThreads, CLUMPBYTESPERTHREAD)
+
+
+def clumpCmd(project, laneFolder, ID, config, PE, sequencer, threads=None):
+    """
+    The clumpify (+ splitFastq) command for one sample, as clmpRunner takes
+    it, or None if the sample isn't (or is already) clumped.
+    """
+    effthreads = threads or clumpThreads(config)
+    stream = str(config["misc"].get("clumpStreaming", "True")).lower() == "true"
     clmpOpts = {
         "general": [
             "out=tmp.fq.gz",
@@ -213,7 +348,7 @@ def clumper(project, laneFolder, sampleIDs, config, PE, sequencer):
             "qin=33",
             "markduplicates=t",
             "optical=t",
-            "-Xmx650G",
+            "-Xmx{}".format(config["misc"].get("memory", "650G")),
             f"threads={effthreads}",
             "tmpdir={}".format(config["Dirs"]["tempDir"]),
         ],
@@ -221,93 +356,79 @@ def clumper(project, laneFolder, sampleIDs, config, PE, sequencer):
         "NovaSeq": ["dupedist=12000"],
     }
     clmpOpts["aviti"] = clmpOpts["NextSeq"].copy()
-
-    clmpCmds = []
-    if sequencer != "MiSeq":
-        for ID in sampleIDs:
-            sampleDir = laneFolder / f"Project_{project}" / f"Sample_{ID}"
-            if (
-                sampleDir.exists()
-                and len(list(sampleDir.glob("*optical_duplicates*"))) == 0
-            ):
-                fqFiles = list(sampleDir.glob("*fastq.gz"))
-                if len(fqFiles) < 3:
-                    if PE and len(fqFiles) == 2:
-                        for i in fqFiles:
-                            if "_R1.fastq.gz" in str(i):
-                                in1 = "in=" + str(i)
-                                baseName = i.name.replace("_R1.fastq.gz", "")
-                            elif "_R2.fastq.gz" in str(i):
-                                in2 = "in2=" + str(i)
-                        clmpCmds.append(
-                            "clumpify.sh"
-                            + " "
-                            + in1
-                            + " "
-                            + in2
-                            + " "
-                            + " ".join(clmpOpts["general"])
-                            + " "
-                            + " ".join(clmpOpts[sequencer])
-                            + " "
-                            + str(sampleDir)
-                            + " "
-                            + "1"
-                            + " "
-                            + baseName
-                            + " "
-                            + f"{effthreads}"
-                            + " "
-                            + config["software"]["splitFastq"]
-                        )
-                    elif not PE and len(fqFiles) == 1:
-                        if "_R1.fastq.gz" in str(fqFiles[0]):
-                            in1 = "in=" + str(fqFiles[0])
-                            baseName = fqFiles[0].name.replace("_R1.fastq.gz", "")
-                            clmpCmds.append(
-                                "clumpify.sh"
-                                + " "
-                                + in1
-                                + " "
-                                + " ".join(clmpOpts["general"])
-                                + " "
-                                + " ".join(clmpOpts[sequencer])
-                                + " "
-                                + str(sampleDir)
-                                + " "
-                                + "0"
-                                + " "
-                                + baseName
-                                + " "
-                                + f"{effthreads}"
-                                + " "
-                                + config["software"]["splitFastq"]
-                            )
-                        else:
-                            logging.info(f"Not clumping {ID}")
-        if clmpCmds:
-            logging.info(
-                f"Postmux - Clump - command example: {project} - {clmpCmds[0]}"
-            )
-            with Pool(num_pool_runners) as p:
-                clmpReturns = p.map(clmpRunner, clmpCmds)
-                if clmpReturns.count((0, 0)) == len(clmpReturns):
-                    logging.info(f"Postmux - Clumping done for {project}.")
-                else:
-                    logging.critical(
-                        f"Postmux - Clumping failed for {project}. Exiting."
-                    )
-                    mailHome(
-                        laneFolder,
-                        f"Clump runs failed for {project}.",
-                        config,
-                        toCore=True,
-                    )
-                    sys.exit(1)
-        else:
-            logging.info(f"Postmux - Clump - No clump run for {project}")
+    if stream:
+        # Only splitFastq ever sees the interleaved output.
+        clmpOpts["general"].append("ziplevel=1")
+
+    if sequencer == "MiSeq":
+        return None
+    sampleDir = laneFolder / f"Project_{project}" / f"Sample_{ID}"
+    if not sampleDir.exists() or len(list(sampleDir.glob("*optical_duplicates*"))) > 0:
+        return None
+    fqFiles = list(sampleDir.glob("*fastq.gz"))
+    if len(fqFiles) >= 3:
+        return None
+    if PE and len(fqFiles) == 2:
+        for i in fqFiles:
+            if "_R1.fastq.gz" in str(i):
+                in1 = "in=" + str(i)
+                baseName = i.name.replace("_R1.fastq.gz", "")
+            elif "_R2.fastq.gz" in str(i):
+                in2 = "in2=" + str(i)
+        ins = [in1, in2]
+        PEstr = "1"
+    elif not PE and len(fqFiles) == 1 and "_R1.fastq.gz" in str(fqFiles[0]):
+        ins = ["in=" + str(fqFiles[0])]
+        baseName = fqFiles[0].name.replace("_R1.fastq.gz", "")
+        PEstr = "0"
     else:
+        logging.info(f"Not clumping {ID}")
+        return None
+    return " ".join(
+        ["clumpify.sh"]
+        + ins
+        + clmpOpts["general"]
+        + clmpOpts[sequencer]
+        + [
+            str(sampleDir),
+            PEstr,
+            baseName,
+            f"{effthreads}",
+            "1" if stream else "0",
+            config["software"]["splitFastq"],
+        ]
+    )
+
+
+def clumper(project, laneFolder, sampleIDs, config, PE, sequencer):
+    # Decide threading setup - aim to have 10 threads per clumpify instance.
+    configthreads = int(config["misc"]["threads"])
+    num_pool_runners = max(1, configthreads // 10)
+    if sequencer == "MiSeq":
         logging.info("Postmux - Clump - no clumping for MiSeq.")
+        return
+    clmpCmds = [
+        clumpCmd(project, laneFolder, ID, config, PE, sequencer)
+        for ID, _size in largestFirst(laneFolder, project, sampleIDs)
+    ]
+    clmpCmds = [cmd for cmd in clmpCmds if cmd]
+    if clmpCmds:
+        logging.info(f"Postmux - Clump - command example: {project} - {clmpCmds[0]}")
+        with Pool(num_pool_runners) as p:
+            clmpReturns = p.map(clmpRunner, clmpCmds, chunksize=1)
+            if clmpReturns.count((0, 0)) == len(clmpReturns):
+                logging.info(f"Postmux - Clumping done for {project}.")
+            else:
+                logging.critical(f"Postmux - Clumping failed for {project}. Exiting.")
+                mailHome(
+                    laneFolder,
+                    f"Clump runs failed for {project}.",
+                    config,
+                    toCore=True,
+                )
+                sys.exit(1)
+    else:
+        logging.info(f"Postmux - Clump - No clump run for {project}")
 
 
 def krakRunner(cmd):
@@ -317,36 +438,53 @@ def krakRunner(cmd):
     return exitcode
 
 
+def krakenThreads(config, size=None):
+    """
+    Threads per kraken2 run, at most 5, scaled down for small samples.
+    """
+    maxThreads = min(5, int(config["misc"]["threads"]))
+    if size is None:
+        return maxThreads
+    return sizeThreads(size, maxThreads, KRAKENBYTESPERTHREAD)
+
+
+def krakenCmd(project, laneFolder, ID, config, threads=None):
+    """
+    The kraken2 command for one sample, or None if there's nothing (left) to do.
+    """
+    IDfolder = laneFolder / f"FASTQC_Project_{project}" / f"Sample_{ID}"
+    if not IDfolder.exists() or len(list(IDfolder.glob("*.rep"))) > 0:
+        return None
+    sampleFolder = laneFolder / f"Project_{project}" / f"Sample_{ID}"
+    reportname, fqs = krakenfqs(sampleFolder)
+    return " ".join(
+        [
+            "kraken2",
+            "--db",
+            config["software"]["kraken2db"],
+            "--out",
+            "-",
+            "--threads",
+            f"{threads or krakenThreads(config)}",
+            "--report",
+            reportname,
+        ]
+        + fqs
+    )
+
+
 def kraken(project, laneFolder, sampleIDs, config):
     configthreads = int(config["misc"]["threads"])
     num_pool_runners = max(1, configthreads // 5)
-    effthreads = 5 if configthreads >= 5 else configthreads
-    krakenCmds = []
-    for ID in sampleIDs:
-        IDfolder = laneFolder / f"FASTQC_Project_{project}" / f"Sample_{ID}"
-        if IDfolder.exists() and len(list(IDfolder.glob("*.rep"))) == 0:
-            sampleFolder = laneFolder / f"Project_{project}" / f"Sample_{ID}"
-            reportname, fqs = krakenfqs(sampleFolder)
-            krakenCmds.append(
-                " ".join(
-                    [
-                        "kraken2",
-                        "--db",
-                        config["software"]["kraken2db"],
-                        "--out",
-                        "-",
-                        "--threads",
-                        f"{effthreads}",
-                        "--report",
-                        reportname,
-                    ]
-                    + fqs
-                )
-            )
+    krakenCmds = [
+        krakenCmd(project, laneFolder, ID, config)
+        for ID, _size in largestFirst(laneFolder, project, sampleIDs)
+    ]
+    krakenCmds = [cmd for cmd in krakenCmds if cmd]
     if krakenCmds:
         logging.info(f"Postmux - Kraken - command example: {project} - {krakenCmds[0]}")
         with Pool(num_pool_runners) as p:
-            screenReturns = p.map(krakRunner, krakenCmds)
+            screenReturns = p.map(krakRunner, krakenCmds, chunksize=1)
             if screenReturns.count(0) == len(screenReturns):
                 logging.info(f"Postmux - Kraken done for {project}.")
             else:
@@ -362,12 +500,301 @@ def kraken(project, laneFolder, sampleIDs, config):
         logging.info(f"Postmux - Kraken - No kraken run for {project}")
 
 
-def md5Runner(fqfile):
-    return (fqfile.name, hashlib.md5(open(fqfile, "rb").read()).hexdigest())
+def fastqcSample(project, laneFolder, ID, config):
+    cmd = fastqcCmd(project, laneFolder, ID, config)
+    return cmd is None or fqcRunner(cmd) == 0
+
+
+def clumpSample(project, laneFolder, ID, config, PE, sequencer, threads=None):
+    cmd = clumpCmd(project, laneFolder, ID, config, PE, sequencer, threads)
+    return cmd is None or clmpRunner(cmd) == (0, 0)
+
+
+def krakenSample(project, laneFolder, ID, config, threads=None):
+    cmd = krakenCmd(project, laneFolder, ID, config, threads)
+    return cmd is None or krakRunner(cmd) == 0
+
 
+def demuxReadCounts(laneFolder):
+    """
+    {Sample_ID: reads} from Reports/Demultiplex_Stats.csv (summed over
+    lanes), None if there is no such file (aviti).
+    """
+    statsFile = laneFolder / "Reports" / "Demultiplex_Stats.csv"
+    if not statsFile.exists():
+        return None
+    muxdf = read_csv(statsFile)
+    return {
+        str(ID): int(reads)
+        for ID, reads in muxdf.groupby("SampleID")["# Reads"].sum().items()
+    }
+
+
+class fastqScanClass:
+    """
+    Everything postmux wants to know about a fastq.gz, from one read of it:
+    md5 and crc32 of the compressed bytes, whether the (multi-member) gzip
+    stream is complete, the number of reads and a uniform subsample of them.
+    The subsample is a reservoir (algorithm L) with a fixed seed, so R1 and
+    R2 of a sample keep the same reads.
+    """
 
-def moveOptDup(laneFolder):
-    for txt in laneFolder.glob("*/*/*duplicate.txt"):
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        while chunk:
+            if self.gz is None:
+                self.gz = zlib.decompressobj(wbits=31)
+                self.members += 1
+            self._records(self.gz.decompress(chunk))
+            if self.gz.eof:
+                chunk = self.gz.unused_data
+                self.gz = None
+            else:
+                chunk = b""
+
+    def finish(self):
+        if self.members == 0:
+            raise ValueError("no gzip stream")
+        if self.gz is not None:
+            raise ValueError("gzip stream is truncated")
+        if self.tail.strip():
+            raise ValueError(f"incomplete record after read {self.reads}")
+        return {
+            "md5": self.md5.hexdigest(),
+            "crc32": self.crc32,
+            "reads": self.reads,
+        }
+
+    def subsample(self):
+        return [rec for _i, rec in sorted(self.reservoir)]
+
+    def _records(self, data):
+        # Only whole records are counted, the rest waits for the next chunk.
+        data = self.tail + data
+        nl = data.count(b"\n")
+        if nl < 4:
+            self.tail = data
+            return
+        cut = len(data)
+        for _ in range(nl % 4 + 1):
+            cut = data.rfind(b"\n", 0, cut)
+        complete, self.tail = data[: cut + 1], data[cut + 1 :]
+        nReads = nl // 4
+        if self.nextPick < self.reads + nReads:
+            lines = complete.split(b"\n")
+            while self.nextPick < self.reads + nReads:
+                j = 4 * (self.nextPick - self.reads)
+                self._pick(b"\n".join(lines[j : j + 4]) + b"\n")
+        self.reads += nReads
+
+    def _pick(self, record):
+        i = self.nextPick
+        if len(self.reservoir) < self.size:
+            self.reservoir.append((i, record))
+            if len(self.reservoir) < self.size:
+                self.nextPick = i + 1
+                return
+        else:
+            self.reservoir[self.rng.randrange(self.size)] = (i, record)
+        self.w *= math.exp(math.log(self.rng.random() or 0.5) / self.size)
+        skip = math.log(1.0 - self.rng.random()) / math.log(1.0 - self.w)
+        self.nextPick = i + 1 + math.floor(skip)
+
+    def __init__(self, subsampleReads=0, seed=0):
+        self.md5 = hashlib.md5()
+        self.crc32 = 0
+        self.gz = None
+        self.members = 0
+        self.tail = b""
+        self.reads = 0
+        self.size = subsampleReads
+        self.reservoir = []
+        self.rng = random.Random(seed)
+        self.w = 1.0
+        self.nextPick = 0 if subsampleReads > 0 else math.inf
+
+
+def scanFastq(fqFile, subsampleReads=0, bufSize=MD5BUFFER):
+    """
+    Read a fastq.gz once through a fixed buffer.
+    Returns (record, subsample), record has the fastqScanClass results plus
+    size, mtime_ns and error (None if the file is fine).
+    """
+    st = fqFile.stat()
+    scan = fastqScanClass(subsampleReads)
+    rec = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "error": None}
+    buf = bytearray(bufSize)
+    view = memoryview(buf)
+    try:
+        with open(fqFile, "rb", buffering=0) as f:
+            while n := f.readinto(buf):
+                scan.update(view[:n])
+        rec.update(scan.finish())
+    except (zlib.error, ValueError) as e:
+        rec["error"] = str(e)
+        return rec, []
+    return rec, scan.subsample()
+
+
+def fanoutProblems(ID, files, demuxReads=None):
+    """
+    Broken gzip streams, fastqs of one sample with different read counts,
+    or read counts that don't match Demultiplex_Stats.csv.
+    """
+    problems = [
+        f"{name}: {rec['error']}" for name, rec in files.items() if rec["error"]
+    ]
+    counts = {name: rec["reads"] for name, rec in files.items() if not rec["error"]}
+    if len(set(counts.values())) > 1:
+        problems.append(f"read counts differ between fastqs: {counts}")
+    if demuxReads is not None and ID in demuxReads:
+        for name, reads in counts.items():
+            if reads != demuxReads[ID]:
+                problems.append(
+                    f"{name}: {reads} reads, Demultiplex_Stats.csv has {demuxReads[ID]}"
+                )
+    return problems
+
+
+def fanoutSample(project, laneFolder, ID, config, demuxReads=None):
+    """
+    The single pass over a sample's final fastqs. Everything ends up in
+    FASTQC_Project_x/Sample_y/fanout.json, md5sums and the RO-Crate archive
+    use that instead of reading the fastqs again. The subsamples go to
+    Subsamples/Project_x/Sample_y (see subsampleDir), they aren't shipped.
+    False if the fastqs are broken or their reads don't add up.
+    """
+    sampleDir = laneFolder / f"Project_{project}" / f"Sample_{ID}"
+    if not sampleDir.exists():
+        return True
+    outFile = fanoutFile(sampleDir)
+    outFile.parent.mkdir(parents=True, exist_ok=True)
+    fqFiles = sorted(sampleDir.glob("*fastq.gz"))
+    records = fanoutRecords(sampleDir)
+    if records and all(fanoutRecord(fq, records) for fq in fqFiles):
+        logging.info(f"Postmux - fanout - {project} - {ID} - up to date")
+        return True
+    subsampleReads = int(config["misc"].get("subsampleReads", SUBSAMPLEREADS))
+    subDir = subsampleDir(sampleDir)
+    files = {}
+    for fq in fqFiles:
+        files[fq.name], subsample = scanFastq(fq, subsampleReads)
+        if subsample:
+            subDir.mkdir(parents=True, exist_ok=True)
+            subFile = subDir / fq.name.replace(".fastq.gz", ".subsample.fastq.gz")
+            with gzip.open(f"{subFile}.tmp", "wb", compresslevel=1) as f:
+                f.writelines(subsample)
+            os.replace(f"{subFile}.tmp", subFile)
+            files[fq.name]["subsample"] = subFile.name
+    problems = fanoutProblems(ID, files, demuxReads)
+    with open(outFile, "w") as f:
+        json.dump({"files": files, "problems": problems}, f, indent=2)
+    for problem in problems:
+        logging.critical(f"Postmux - fanout - {project} - {ID} - {problem}")
+    return not problems
+
+
+class taskGraphClass:
+    """
+    Run tasks as soon as the tasks they depend on are done, within one
+    thread budget. Every task claims a number of threads (its cost) while
+    it runs. Ready tasks are started highest priority first (e.g. the
+    largest sample, so it doesn't end up as the tail of the run), then in
+    the order they were added, as long as they fit in what's left of the
+    budget. A task that doesn't fit blocks the ones ranked below it until
+    enough threads are free, so it isn't starved by smaller tasks.
+    A task returns False (or raises) on failure. Nothing new is started
+    after a failure, the running tasks are waited for. run() then re-raises
+    the exception, or returns (name, onFail) of the failed task.
+    """
+
+    def add(self, name, func, cost=1, after=(), onFail=None, priority=0):
+        self.tasks[name] = {
+            "func": func,
+            "cost": max(1, min(int(cost), self.budget)),
+            "after": set(after),
+            "onFail": onFail,
+            "rank": (-priority, len(self.tasks)),
+        }
+        return name
+
+    def run(self):
+        waiting = {name: set(task["after"]) for name, task in self.tasks.items()}
+        dependents = {name: [] for name in self.tasks}
+        for name, after in waiting.items():
+            for dep in after:
+                dependents[dep].append(name)
+        ready = [name for name, after in waiting.items() if not after]
+        free = self.budget
+        running = {}
+        failed = None
+        error = None
+        with ThreadPoolExecutor(max_workers=self.budget) as pool:
+            while running or (ready and failed is None and error is None):
+                if failed is None and error is None:
+                    ready.sort(key=lambda name: self.tasks[name]["rank"])
+                    for name in list(ready):
+                        cost = self.tasks[name]["cost"]
+                        if cost > free:
+                            # Threads freed up are kept for this one, rather
+                            # than handed to tasks of a lower rank.
+                            break
+                        ready.remove(name)
+                        free -= cost
+                        running[pool.submit(self.tasks[name]["func"])] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    free += self.tasks[name]["cost"]
+                    try:
+                        ok = future.result()
+                    except BaseException as e:
+                        error = error or e
+                        continue
+                    if ok is False:
+                        failed = failed or (name, self.tasks[name]["onFail"])
+                        continue
+                    self.done.append(name)
+                    for dep in dependents[name]:
+                        waiting[dep].discard(name)
+                        if not waiting[dep]:
+                            ready.append(dep)
+        if error is not None:
+            raise error
+        return failed
+
+    def __init__(self, budget):
+        self.budget = max(1, int(budget))
+        self.tasks = {}
+        self.done = []
+
+
+def md5Runner(fqfile, bufSize=MD5BUFFER):
+    """
+    md5 of a fastq file, read in chunks of bufSize into one buffer.
+    Memory use doesn't depend on the file size.
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(bufSize)
+    view = memoryview(buf)
+    with open(fqfile, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            md5.update(view[:n])
+    return (fqfile.name, md5.hexdigest())
+
+
+def md5Threads(config, nFiles):
+    """
+    Hashing is I/O bound, so it gets at most half of the threads and
+    leaves the rest to the samples still running.
+    """
+    return max(1, min(nFiles, int(config["misc"]["threads"]) // 2))
+
+
+def moveOptDup(laneFolder, project=None):
+    pattern = f"Project_{project}/*/*duplicate.txt" if project else "*/*/*duplicate.txt"
+    for txt in laneFolder.glob(pattern):
         # Field -3 == project folder
         # escape those already in a fastqc folder (reruns)
         if "FASTQC" not in str(txt):
@@ -386,8 +813,30 @@ def md5_multiqc(project, laneFolder, flowcell):
     md5out = projectFolder / "md5sums.txt"
 
     if not md5out.exists():
-        with Pool(20) as p:
-            _m5sums = p.map(md5Runner, list(projectFolder.glob("*/*fastq.gz")))
+        fqFiles = sorted(
+            projectFolder.glob("*/*fastq.gz"), key=lambda x: -x.stat().st_size
+        )
+        # The fan-out pass has hashed most fastqs already.
+        _m5sums = []
+        toHash = []
+        records = {}
+        for fq in fqFiles:
+            if fq.parent not in records:
+                records[fq.parent] = fanoutRecords(fq.parent)
+            rec = fanoutRecord(fq, records[fq.parent])
+            if rec:
+                _m5sums.append((fq.name, rec["md5"]))
+            else:
+                toHash.append(fq)
+        logging.info(
+            f"Postmux - md5sums - {project} - {len(_m5sums)} from fanout, "
+            f"{len(toHash)} to hash"
+        )
+        # Threads, not processes: this runs inside the postmux task graph.
+        with ThreadPoolExecutor(
+            max_workers=md5Threads(flowcell.config, len(toHash))
+        ) as p:
+            _m5sums += list(p.map(md5Runner, toHash))
         with open(md5out, "w") as f:
             for _m5sum in sorted(_m5sums, key=lambda x: x[0]):
                 f.write(f"{_m5sum[0]}\t{_m5sum[1]}\n")
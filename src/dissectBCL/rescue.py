@@ -0,0 +1,467 @@
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+import pandas as pd
+import rich_click as click
+from rich import print
+
+from dissectBCL.demux import barcodeNeighbours, readDemuxSheet
+from dissectBCL.flowcellIndex import flowcellNameFromOutLane
+
+# Undetermined_S0_L001_R1_001.fastq.gz, or without the lane when bcl-convert
+# ran with --no-lane-splitting.
+UNDETERMINED = re.compile(r"^Undetermined_S0_(?:L(\d{3})_)?([RI][12])_001\.fastq\.gz$")
+# Rescued reads are recompressed by clumpify anyway, keep this pass cheap.
+COMPRESSLEVEL = 1
+
+
+def undeterminedFastqs(outLane):
+    """
+    The Undetermined fastqs of an outLane, per lane:
+    {'L001': {'R1': path, 'R2': path, 'I1': path, ...}}
+    """
+    sets = {}
+    for fq in sorted(Path(outLane).glob("Undetermined_S0_*fastq.gz")):
+        m = UNDETERMINED.match(fq.name)
+        if m:
+            lane = f"L{m.group(1)}" if m.group(1) else "all"
+            sets.setdefault(lane, {})[m.group(2)] = fq
+    return sets
+
+
+def headerBarcode(header):
+    """
+    @A00931:309:HCCMWDRXY:1:1101:1000:1000 1:N:0:ACGTACGT+TTGGCCAA
+    -> ('1', 'ACGTACGT', 'TTGGCCAA')
+    """
+    name, _, comment = header.decode().rstrip().partition(" ")
+    barcode = comment.rsplit(":", 1)[-1]
+    p7, _, p5 = barcode.partition("+")
+    return name.split(":")[3], p7, p5
+
+
+class barcodeLookupClass:
+    """
+    Exact and mismatch tolerant lookup of (P7, P5) in a set of samples.
+    Every index is stored with its neighbours up to mm7 / mm5 mismatches,
+    so a barcode is two dictionary lookups. A barcode within reach of two
+    samples at the same (lowest) distance isn't assigned.
+    Results are cached per barcode, Undetermined barcodes repeat a lot.
+    """
+
+    def _table(self, indices, mm):
+        table = {}
+        for sample, ix in indices.items():
+            for seq, dist in barcodeNeighbours(ix, mm).items():
+                table.setdefault(seq, {})[sample] = dist
+        return table
+
+    def match(self, p7, p5):
+        """
+        (Sample_ID, mismatches) or None.
+        """
+        key = (p7, p5)
+        if key in self.cache:
+            return self.cache[key]
+        hit7 = self.table7.get(p7[: self.len7], {})
+        hit5 = self.table5.get(p5[: self.len5], {}) if self.len5 else None
+        if hit5 is None:
+            hits = hit7
+        else:
+            hits = {s: d + hit5[s] for s, d in hit7.items() if s in hit5}
+        hit = None
+        if hits:
+            best = min(hits.values())
+            samples = [s for s, d in hits.items() if d == best]
+            if len(samples) == 1:
+                hit = (samples[0], best)
+        self.cache[key] = hit
+        return hit
+
+    def __init__(self, rescuedf, mm7, mm5):
+        rescuedf = rescuedf.fillna({"index": "", "index2": ""})
+        p7s = dict(zip(rescuedf["Sample_ID"], rescuedf["index"], strict=True))
+        self.len7 = min(len(ix) for ix in p7s.values())
+        self.table7 = self._table({s: ix[: self.len7] for s, ix in p7s.items()}, mm7)
+        self.len5 = 0
+        self.table5 = {}
+        if "index2" in rescuedf.columns:
+            p5s = dict(zip(rescuedf["Sample_ID"], rescuedf["index2"], strict=True))
+            self.len5 = min(len(ix) for ix in p5s.values())
+            self.table5 = self._table(
+                {s: ix[: self.len5] for s, ix in p5s.items()}, mm5
+            )
+        self.cache = {}
+
+
+def _readRecord(handle):
+    head = handle.readline()
+    if not head:
+        return None
+    return (head, handle.readline(), handle.readline(), handle.readline())
+
+
+def _open(fq):
+    return io.BufferedReader(gzip.open(fq, "rb"), buffer_size=1 << 20)
+
+
+def _sampleInfo(outLane, sampleIDs):
+    """
+    Sample_Name and Sample_Project for the sampleIDs, from the
+    Logs/sampleSheetdf.tsv of this outLane or the other outLanes of the
+    flowcell (a sample can come from the wrong lane).
+    """
+    outLane = Path(outLane)
+    flowcell = flowcellNameFromOutLane(outLane.name)
+    sheets = [outLane / "Logs" / "sampleSheetdf.tsv"] + sorted(
+        p / "Logs" / "sampleSheetdf.tsv"
+        for p in outLane.parent.glob(f"{flowcell}_lanes_*")
+        if p != outLane
+    )
+    info = {}
+    for sheet in sheets:
+        if not sheet.exists():
+            continue
+        ssdf = pd.read_csv(sheet, sep="\t")
+        for sample, name, project in ssdf[
+            ["Sample_ID", "Sample_Name", "Sample_Project"]
+        ].itertuples(index=False):
+            if sample in sampleIDs and sample not in info:
+                info[sample] = (name, project)
+    missing = set(sampleIDs) - set(info)
+    if missing:
+        logging.critical(
+            f"Rescue - no Sample_Name / Sample_Project for {sorted(missing)} "
+            "in the Logs/sampleSheetdf.tsv of the flowcell's outLanes."
+        )
+        sys.exit(1)
+    return info
+
+
+def rescueSamples(outLane, correctedSheet, samples=None):
+    """
+    The samples in correctedSheet whose indices differ from the outLane's
+    demuxSheet.csv (or aren't in it), or the given samples.
+    Returns the rows of correctedSheet for them.
+    """
+    corrected = readDemuxSheet(correctedSheet, what="df")
+    current = readDemuxSheet(Path(outLane) / "demuxSheet.csv", what="df")
+    ixCols = [c for c in ("index", "index2") if c in corrected.columns]
+    # Missing indices (short rows, single index samples) are "", NaN would
+    # never compare equal.
+    corrected[ixCols] = corrected[ixCols].fillna("")
+    if "index2" in ixCols and not corrected["index2"].any():
+        ixCols.remove("index2")
+        corrected = corrected.drop(columns="index2")
+    corrected = corrected.drop_duplicates("Sample_ID")
+    if samples:
+        return corrected[corrected["Sample_ID"].isin(samples)].reset_index(drop=True)
+    current = current.reindex(columns=["Sample_ID"] + ixCols).fillna("")
+    merged = corrected.merge(
+        current.drop_duplicates("Sample_ID"),
+        on="Sample_ID",
+        how="left",
+        suffixes=("", "_current"),
+        indicator=True,
+    )
+    changed = merged["_merge"] == "left_only"
+    for ix in ixCols:
+        changed |= merged[ix] != merged[f"{ix}_current"]
+    return corrected[changed.values].reset_index(drop=True)
+
+
+def rescueUndetermined(outLane, rescuedf, mm7=1, mm5=1):
+    """
+    Stream the Undetermined fastqs of an outLane once, and split off the
+    reads whose barcode (from the I1/I2 reads if present, else the read
+    header) matches one of the samples in rescuedf.
+    Reads are written to temporary files first. Only once every lane is
+    done, they are appended to the samples' fastqs (as an extra gzip
+    member) and the Undetermined fastqs are replaced by the leftovers, so
+    an interrupted rescue can simply be rerun.
+    Returns the counts as {(lane, Sample_ID, mismatches): reads} and
+    {(lane, P7, P5): reads}.
+    """
+    outLane = Path(outLane)
+    lookup = barcodeLookupClass(rescuedf, mm7, mm5)
+    info = _sampleInfo(outLane, set(rescuedf["Sample_ID"]))
+    counts = Counter()
+    barcodes = Counter()
+    moves = []
+    for lane, fqs in undeterminedFastqs(outLane).items():
+        reads = sorted(fqs)
+        logging.info(f"Rescue - {outLane.name} - {lane} - {reads}")
+        with ExitStack() as stack:
+            handles = {r: stack.enter_context(_open(fqs[r])) for r in reads}
+            leftovers = {
+                r: stack.enter_context(
+                    gzip.open(
+                        fqs[r].with_name(f".{fqs[r].name}.rescue.tmp"),
+                        "wb",
+                        compresslevel=COMPRESSLEVEL,
+                    )
+                )
+                for r in reads
+            }
+            writers = {}
+            while True:
+                records = {r: _readRecord(handles[r]) for r in reads}
+                if records[reads[0]] is None:
+                    break
+                laneNo, p7, p5 = headerBarcode(records[reads[0]][0])
+                if "I1" in records:
+                    p7 = records["I1"][1].decode().rstrip()
+                if "I2" in records:
+                    p5 = records["I2"][1].decode().rstrip()
+                hit = lookup.match(p7, p5)
+                if hit is None:
+                    for r in reads:
+                        leftovers[r].write(b"".join(records[r]))
+                    continue
+                sample, mm = hit
+                counts[(laneNo, sample, mm)] += 1
+                barcodes[(laneNo, p7, p5)] += 1
+                for r in reads:
+                    if (sample, r) not in writers:
+                        name, project = info[sample]
+                        target = (
+                            outLane
+                            / f"Project_{project}"
+                            / f"Sample_{sample}"
+                            / f"{name}_{r}.fastq.gz"
+                        )
+                        # Index reads only go to samples that have them.
+                        if r.startswith("I") and not target.exists():
+                            writers[(sample, r)] = None
+                            continue
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        tmp = target.with_name(f".{target.name}.{lane}.rescue.tmp")
+                        writers[(sample, r)] = stack.enter_context(
+                            gzip.open(tmp, "wb", compresslevel=COMPRESSLEVEL)
+                        )
+                        moves.append((tmp, target))
+                    if writers[(sample, r)] is not None:
+                        writers[(sample, r)].write(b"".join(records[r]))
+        moves += [
+            (fqs[r].with_name(f".{fqs[r].name}.rescue.tmp"), fqs[r]) for r in reads
+        ]
+    # Everything is written, now put it in place.
+    for tmp, target in moves:
+        if target.name.startswith("Undetermined"):
+            os.replace(tmp, target)
+        else:
+            with open(target, "ab") as out, open(tmp, "rb") as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+            tmp.unlink()
+    return dict(counts), dict(barcodes)
+
+
+def updateStats(outLane, rescuedf, counts, barcodes):
+    """
+    Move the rescued reads from Undetermined to the samples in
+    Reports/Demultiplex_Stats.csv (per lane, perfect / one / two mismatch
+    reads included), with the new indices, and take the rescued barcodes
+    out of Reports/Top_Unknown_Barcodes.csv.
+    parseStats reads these again on the rerun, so gotDepth is right.
+    """
+    reports = Path(outLane) / "Reports"
+    statsFile = reports / "Demultiplex_Stats.csv"
+    muxdf = pd.read_csv(statsFile)
+    muxdf["Lane"] = muxdf["Lane"].astype(str)
+    mmCols = {
+        0: "# Perfect Index Reads",
+        1: "# One Mismatch Index Reads",
+        2: "# Two Mismatch Index Reads",
+    }
+    indexStr = rescuedf.set_index("Sample_ID")["index"]
+    if "index2" in rescuedf.columns:
+        indexStr = indexStr + "-" + rescuedf.set_index("Sample_ID")["index2"]
+    project = dict(zip(rescuedf["Sample_ID"], rescuedf["Sample_Project"], strict=True))
+    for (lane, sample, mm), reads in sorted(counts.items()):
+        row = (muxdf["Lane"] == lane) & (muxdf["SampleID"] == sample)
+        if not row.any():
+            new = {c: 0 for c in muxdf.columns if c.startswith("#")}
+            new.update({"Lane": lane, "SampleID": sample})
+            if "Sample_Project" in muxdf.columns:
+                new["Sample_Project"] = project[sample]
+            muxdf = pd.concat([muxdf, pd.DataFrame([new])], ignore_index=True)
+            row = (muxdf["Lane"] == lane) & (muxdf["SampleID"] == sample)
+        und = (muxdf["Lane"] == lane) & (muxdf["SampleID"] == "Undetermined")
+        for col in ["# Reads"] + ([mmCols[mm]] if mmCols.get(mm) in muxdf else []):
+            muxdf.loc[row, col] += reads
+            if col == "# Reads":
+                muxdf.loc[und, col] -= reads
+    if "Index" in muxdf.columns:
+        rescued = muxdf["SampleID"].isin(indexStr.index)
+        muxdf.loc[rescued, "Index"] = muxdf.loc[rescued, "SampleID"].map(indexStr)
+    # Percentages are relative to the lane, or to the sample's reads.
+    laneReads = muxdf.groupby("Lane")["# Reads"].transform("sum")
+    for col in muxdf.columns:
+        if col == "% Reads":
+            muxdf[col] = (muxdf["# Reads"] / laneReads).round(4)
+        elif col.startswith("% ") and f"# {col[2:]}" in muxdf.columns:
+            muxdf[col] = (muxdf[f"# {col[2:]}"] / muxdf["# Reads"]).fillna(0).round(4)
+    muxdf.to_csv(statsFile, index=False)
+
+    unknownFile = reports / "Top_Unknown_Barcodes.csv"
+    if unknownFile.exists() and barcodes:
+        ubcdf = pd.read_csv(unknownFile)
+        key = ubcdf["Lane"].astype(str) + ":" + ubcdf["index"].astype(str)
+        rescued = {f"{lane}:{p7}": n for (lane, p7, _p5), n in barcodes.items()}
+        if "index2" in ubcdf.columns:
+            key = key + "+" + ubcdf["index2"].astype(str)
+            rescued = {f"{lane}:{p7}+{p5}": n for (lane, p7, p5), n in barcodes.items()}
+        ubcdf["# Reads"] -= key.map(rescued).fillna(0).astype(int)
+        ubcdf[ubcdf["# Reads"] > 0].to_csv(unknownFile, index=False)
+
+
+def updateDemuxSheet(outLane, rescuedf):
+    """
+    Put the rescue indices into demuxSheet.csv (the original is kept as
+    demuxSheet.prerescue.csv), so the rerun reports them, see
+    compareDemuxSheet. Samples new to the outLane are added.
+    """
+    demuxSheet = Path(outLane) / "demuxSheet.csv"
+    backup = demuxSheet.with_name("demuxSheet.prerescue.csv")
+    if not backup.exists():
+        shutil.copy(demuxSheet, backup)
+    rows = rescuedf.set_index("Sample_ID")
+    lines = demuxSheet.read_text().splitlines()
+    out = []
+    columns = None
+    seen = set()
+    lane = None
+    for line in lines:
+        fields = line.split(",")
+        if columns is None or not line.strip(","):
+            out.append(line)
+            if "Sample_ID" in fields:
+                columns = fields
+            continue
+        sample = fields[columns.index("Sample_ID")]
+        if "Lane" in columns:
+            lane = fields[columns.index("Lane")]
+        if sample in rows.index:
+            seen.add(sample)
+            for ix in ("index", "index2"):
+                if ix in columns and ix in rows.columns:
+                    fields[columns.index(ix)] = rows.loc[sample, ix]
+        out.append(",".join(fields))
+    for sample in rows.index:
+        if sample not in seen:
+            new = rows.loc[sample].to_dict()
+            new["Sample_ID"] = sample
+            if lane:
+                new["Lane"] = lane
+            out.append(",".join(str(new.get(c, "")) for c in columns))
+    tmp = demuxSheet.with_name(f".{demuxSheet.name}.{os.getpid()}.tmp")
+    tmp.write_text("\n".join(out) + "\n")
+    os.replace(tmp, demuxSheet)
+
+
+def resetPostmux(outLane, rescuedf):
+    """
+    Make the next dissect run redo postmux for the rescued samples only:
+    their FastQC/kraken/duplicate output and the project's md5sums are
+    removed, the project's postmux flag is dropped and the samples are
+    listed in .<project>.rescued, which flowCellClass.postmux restricts
+    the project to. communication.done is removed so the outLane is
+    shipped and mailed again: the flowcell isn't done anymore until all
+    of its outLanes are, the other outLanes are left as they are.
+    """
+    outLane = Path(outLane)
+    for project, df in rescuedf.groupby("Sample_Project"):
+        for sample in df["Sample_ID"]:
+            shutil.rmtree(
+                outLane / f"FASTQC_Project_{project}" / f"Sample_{sample}",
+                ignore_errors=True,
+            )
+        (outLane / f"Project_{project}" / "md5sums.txt").unlink(missing_ok=True)
+        (outLane / f".{project}.postmux.done").unlink(missing_ok=True)
+        marker = outLane / f".{project}.rescued"
+        rescued = set(marker.read_text().split()) if marker.exists() else set()
+        marker.write_text("\n".join(sorted(rescued | set(df["Sample_ID"]))) + "\n")
+    (outLane / "communication.done").unlink(missing_ok=True)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.argument("outlane", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "-d",
+    "--demuxsheet",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="demuxSheet with the corrected indices. "
+    "default: demuxSheet.suggested.csv in the outLane.",
+)
+@click.option(
+    "-s",
+    "--samples",
+    default=None,
+    help="comma separated Sample_IDs to rescue. "
+    "default: all samples with other indices than in demuxSheet.csv.",
+)
+@click.option(
+    "-m",
+    "--mismatches",
+    type=click.IntRange(0, 2),
+    default=None,
+    help="mismatches allowed per index. default: BarcodeMismatchesIndex1/2 "
+    "of the corrected demuxSheet, else 1.",
+)
+def rescue(outlane, demuxsheet, samples, mismatches):
+    """
+    Re-demultiplex the Undetermined reads of an outLane for samples with
+    corrected indices, without running bcl-convert again. The reads are
+    appended to the samples' fastqs, the demux stats and demuxSheet.csv
+    are updated, and postmux is set up to rerun for these samples only.
+    """
+    logging.basicConfig(
+        stream=sys.stdout,
+        level="INFO",
+        format="%(levelname)s    %(asctime)s    %(message)s",
+    )
+    outLane = Path(outlane)
+    demuxsheet = Path(demuxsheet or outLane / "demuxSheet.suggested.csv")
+    if not undeterminedFastqs(outLane):
+        print(f"[red]No Undetermined fastqs in {outLane}.[/red]")
+        sys.exit(1)
+    rescuedf = rescueSamples(
+        outLane, demuxsheet, samples.split(",") if samples else None
+    )
+    if rescuedf.empty:
+        print("Nothing to rescue, the indices are the same as in demuxSheet.csv.")
+        return
+    _mask, _df, _dualIx, mmdic = readDemuxSheet(demuxsheet)
+    mm7 = mm5 = mismatches
+    if mismatches is None:
+        mm7 = mmdic.get("BarcodeMismatchesIndex1", 1)
+        mm5 = mmdic.get("BarcodeMismatchesIndex2", 1)
+    info = _sampleInfo(outLane, set(rescuedf["Sample_ID"]))
+    rescuedf["Sample_Project"] = rescuedf["Sample_ID"].map(lambda s: info[s][1])
+    print(f"Rescuing {list(rescuedf['Sample_ID'])} (mismatches {mm7}, {mm5}).")
+    counts, barcodes = rescueUndetermined(outLane, rescuedf, mm7, mm5)
+    updateStats(outLane, rescuedf, counts, barcodes)
+    updateDemuxSheet(outLane, rescuedf)
+    resetPostmux(outLane, rescuedf)
+    perSample = Counter()
+    for (_lane, sample, _mm), reads in counts.items():
+        perSample[sample] += reads
+    summary = {s: perSample.get(s, 0) for s in rescuedf["Sample_ID"]}
+    with open(outLane / "Reports" / "rescue.json", "a") as f:
+        f.write(json.dumps({"demuxSheet": str(demuxsheet), "reads": summary}) + "\n")
+    for sample, reads in summary.items():
+        print(f"  {sample}: {reads} reads")
+    print(
+        "Run dissect --reconcile and dissect again to redo postmux for these "
+        "samples and to mail the outLane again."
+    )
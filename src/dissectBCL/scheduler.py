@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import re
+from multiprocessing.connection import wait
+
+from rich import print
+
+from dissectBCL.flowcellIndex import settleFlowcell
+
+# Directories that hold images rather than base calls, they don't say
+# anything about how long a flowcell takes to demultiplex.
+SKIPDIRS = ("Thumbnail_Images", "Images", "Logs")
+
+
+def parseMemory(memory):
+    """
+    '650G' -> 650, '2T' -> 2048. Memory is handled in whole GB throughout.
+    """
+    m = re.fullmatch(r"\s*(\d+)\s*([gGtT]?)[bB]?\s*", str(memory))
+    assert m, f"Can't parse memory value {memory}, use e.g. 650G"
+    gb = int(m.group(1))
+    if m.group(2).upper() == "T":
+        gb *= 1024
+    return gb
+
+
+def estimateFlowcellSize(flowcellDir):
+    """
+    Bytes of base call data in a flowcell directory. Demultiplexing time
+    scales with it, so it's used to run small (MiSeq, small Aviti) flowcells
+    before the big ones. Only stats files, nothing is read.
+    """
+    size = 0
+    stack = [str(flowcellDir)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if e.name not in SKIPDIRS:
+                            stack.append(e.path)
+                    elif e.is_file(follow_symlinks=False):
+                        size += e.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return size
+
+
+def _runJob(target, config, name, flowcellDir, sequencer, threads, memory, args):
+    """
+    Entry point of a flowcell process. Resource shares are written into this
+    process' copy of the config, so everything downstream (bcl-convert,
+    fastqc, clumpify, ...) picks them up from [misc] as before.
+    """
+    config["misc"]["threads"] = str(threads)
+    config["misc"]["memory"] = f"{memory}G"
+    target(config, name, flowcellDir, sequencer, *args)
+
+
+class flowcellSchedulerClass:
+    """
+    Runs up to maxConcurrent flowcell pipelines at the same time, each in
+    its own process. Every process sets up logging for its own flowcell, so
+    the logging.basicConfig(force=True) of one run can't redirect another's
+    log. Queued flowcells are started smallest first.
+    Threads and memory are split evenly over the slots, so the running
+    flowcells never hold more than the [misc] budget. A flowcell can't give
+    back threads (or a JVM its heap) once it runs, so one that runs alone
+    doesn't get the shares of the empty slots: the next flowcell wouldn't
+    have any left.
+    """
+
+    def slots(self):
+        return self.maxConcurrent - len(self.running)
+
+    def heldThreads(self):
+        return sum(threads for *_, threads in self.running.values())
+
+    def submit(self, candidates):
+        """
+        Start as many of the (name, flowcellDir, sequencer) candidates as there
+        are free slots. Running and crashed flowcells are skipped.
+        """
+        queue = [
+            c
+            for c in candidates
+            if c[0] not in self.running and c[0] not in self.crashed
+        ]
+        for c in queue:
+            if c[0] not in self.sizes:
+                self.sizes[c[0]] = estimateFlowcellSize(c[1])
+        queue.sort(key=lambda c: self.sizes[c[0]])
+        started = []
+        queue = queue[: max(0, self.slots())]
+        threads = self.threads
+        for name, flowcellDir, sequencer in queue:
+            proc = self.ctx.Process(
+                target=_runJob,
+                name=name,
+                args=(
+                    self.target,
+                    self.config,
+                    name,
+                    flowcellDir,
+                    sequencer,
+                    threads,
+                    self.memory,
+                    self.args,
+                ),
+            )
+            proc.start()
+            self.running[name] = (proc, flowcellDir, sequencer, threads)
+            print(
+                f"Started {name} ({sequencer}, {self.sizes[name] / 1e9:.1f} GB, "
+                f"{threads} threads, {self.memory}G) as pid {proc.pid}."
+            )
+            started.append(name)
+        return started
+
+    def reap(self, timeout=0):
+        """
+        Wait up to timeout seconds for a running flowcell to finish, then
+        collect every finished one. Returns the names of the finished flowcells.
+        """
+        if not self.running:
+            return []
+        ready = wait([p.sentinel for p, *_ in self.running.values()], timeout=timeout)
+        finished = []
+        for name, (proc, flowcellDir, sequencer, _threads) in list(
+            self.running.items()
+        ):
+            # A ready sentinel means the process is exiting, join() waits for
+            # the last bit of that so the exitcode is set.
+            if proc.sentinel not in ready and proc.is_alive():
+                continue
+            proc.join()
+            del self.running[name]
+            if proc.exitcode == 0:
+                settleFlowcell(self.config, sequencer, name, flowcellDir)
+                print(f"Finished {name}.")
+            else:
+                # The run mailed home before exiting. Like a crash of the old
+                # sequential loop it needs a look & a restart before it's retried.
+                self.crashed.add(name)
+                print(
+                    f"[red]{name} exited with {proc.exitcode}, not retrying until restart.[/red]"
+                )
+            self.sizes.pop(name, None)
+            finished.append(name)
+        return finished
+
+    def __init__(self, config, target, args=()):
+        self.config = config
+        self.target = target
+        self.args = args
+        self.maxConcurrent = max(1, int(config["misc"].get("maxConcurrent", 1)))
+        self.totalThreads = int(config["misc"]["threads"])
+        self.threads = max(1, self.totalThreads // self.maxConcurrent)
+        self.memory = max(
+            1, parseMemory(config["misc"].get("memory", "650G")) // self.maxConcurrent
+        )
+        self.running = {}
+        self.crashed = set()
+        self.sizes = {}
+        # fork: the config (with its detected software versions) is inherited
+        # as is, and the flowcell processes may start their own Pools.
+        self.ctx = multiprocessing.get_context("fork")
@@ -0,0 +1,238 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+from rich import print
+
+from dissectBCL.flowcellIndex import flowcellIndexClass
+
+# inotify constants, see inotify(7).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCHMASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENTHEADER = struct.Struct("iIII")
+
+# Files whose appearance means a flowcell might have become ready.
+MARKERS = ("RTAComplete.txt", "CopyComplete.txt", "RunUploaded.json")
+# Filesystems on which inotify won't see writes made by other hosts.
+REMOTEFS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "lustre", "gpfs")
+
+
+def _loadLibc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1  # noqa: B018
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def fsType(path):
+    """
+    Filesystem type of the mount that holds path, from /proc/self/mountinfo.
+    Returns None if it can't be determined (e.g. not on Linux).
+    """
+    try:
+        with open("/proc/self/mountinfo") as f:
+            mounts = f.read().splitlines()
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best, bestType = "", None
+    for line in mounts:
+        pre, _, post = line.partition(" - ")
+        mountPoint = pre.split(" ")[4]
+        if (
+            path == mountPoint
+            or path.startswith(mountPoint.rstrip("/") + "/")
+            or mountPoint == "/"
+        ) and len(mountPoint) >= len(best):
+            best, bestType = mountPoint, post.split(" ")[0]
+    return bestType
+
+
+class flowcellWatcherClass:
+    """
+    Wait for new flowcells without sleeping a fixed hour between polls.
+
+    On local filesystems inotify watches on the base dirs (and on the
+    flowcells that aren't ready yet) wake us up within seconds of a
+    CopyComplete.txt / RunUploaded.json appearing. Inotify never sees writes
+    made by other hosts, so on NFS & co. we fall back to an adaptive poll:
+    pollMin seconds after a flowcell was found, doubling up to pollMax while
+    nothing shows up. Either way an event is only reported once the flowcell
+    directory has been quiet for settleTime seconds, so a copy that's still
+    in progress isn't picked up.
+    """
+
+    def addWatch(self, path):
+        path = str(path)
+        if self.fd is None or path in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCHMASK)
+        if wd < 0:
+            logging.debug(
+                f"watcher - can't watch {path}: {os.strerror(ctypes.get_errno())}"
+            )
+            return
+        self.watches[wd] = Path(path)
+        self.watched.add(path)
+
+    def removeWatch(self, path):
+        path = str(path)
+        wd = next((wd for wd, p in self.watches.items() if str(p) == path), None)
+        if wd is None:
+            return
+        # The IN_IGNORED that follows finds nothing left to clean up.
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.watches[wd]
+        self.watched.discard(path)
+
+    def isParentDir(self, path):
+        """
+        Base dirs and Aviti serial-ID dirs: a new directory in there is a
+        flowcell (or serial-ID dir). Anything deeper is inside a flowcell.
+        """
+        return path in self.baseDirs.values() or (
+            "aviti" in self.baseDirs and path.parent == self.baseDirs["aviti"]
+        )
+
+    def refreshWatches(self):
+        """
+        Watch the base dirs, the Aviti serial-ID dirs, and every flowcell the
+        index still considers non-terminal. Flowcells that reached a terminal
+        state lose their watch, so the number of watches doesn't grow with
+        years of runs.
+        """
+        keep = set()
+        for platform, baseDir in self.baseDirs.items():
+            keep.add(str(baseDir))
+            if platform == "aviti" and baseDir.exists():
+                for serialDir in baseDir.iterdir():
+                    if serialDir.is_dir():
+                        keep.add(str(serialDir))
+            index = flowcellIndexClass(self.config, platform)
+            try:
+                index.scan()
+                for _name, flowcellDir, _state in index.pending():
+                    keep.add(str(flowcellDir))
+            finally:
+                index.close()
+        for path in self.watched - keep:
+            self.removeWatch(path)
+        for path in sorted(keep):
+            self.addWatch(path)
+
+    def readEvents(self, timeout):
+        """
+        Block up to timeout seconds, return True if anything relevant happened.
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not ready:
+            return False
+        buf = os.read(self.fd, 64 * 1024)
+        relevant = False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, nameLen = EVENTHEADER.unpack_from(buf, offset)
+            offset += EVENTHEADER.size
+            name = buf[offset : offset + nameLen].rstrip(b"\0").decode()
+            offset += nameLen
+            if mask & IN_Q_OVERFLOW:
+                relevant = True
+                continue
+            if mask & IN_IGNORED:
+                gone = self.watches.pop(wd, None)
+                if gone is not None:
+                    self.watched.discard(str(gone))
+                continue
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+            if mask & IN_ISDIR:
+                # New flowcell (or Aviti serial-ID) directory. New dirs inside
+                # a flowcell (e.g. every cycle's C*.1) aren't interesting.
+                if self.isParentDir(parent):
+                    self.addWatch(parent / name)
+                    relevant = True
+            elif name in MARKERS:
+                relevant = True
+        return relevant
+
+    def settle(self):
+        """
+        Swallow events until the watched dirs have been quiet for settleTime.
+        """
+        while self.readEvents(self.settleTime):
+            pass
+
+    def wait(self):
+        """
+        Return once it's worth polling getNewFlowCell again.
+        """
+        if self.fd is not None:
+            timeout = self.pollMax
+            print(f"Watching for new flowcells (inotify, safety poll in {timeout}s).")
+            self.refreshWatches()
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                if self.readEvents(deadline - time.monotonic()):
+                    logging.info("watcher - flowcell event, waiting for it to settle.")
+                    self.settle()
+                    return True
+            return False
+        print(f"Going back to sleep for {self.interval} seconds.")
+        time.sleep(self.interval)
+        self.interval = min(self.interval * 2, self.pollMax)
+        return False
+
+    def reset(self):
+        """
+        A flowcell was found, poll quickly again afterwards.
+        """
+        self.interval = self.pollMin
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __init__(self, config, platformFilter=None, useInotify=True):
+        self.config = config
+        self.pollMin = int(config["misc"].get("pollMin", 60))
+        self.pollMax = int(config["misc"].get("pollMax", 900))
+        self.settleTime = int(config["misc"].get("settleTime", 30))
+        self.interval = self.pollMin
+        self.baseDirs = {
+            platform: Path(config["Dirs"][f"baseDir_{platform}"])
+            for platform in ("illumina", "aviti")
+            if platformFilter in (None, platform)
+        }
+        self.watches = {}
+        self.watched = set()
+        self.fd = None
+        self.libc = _loadLibc() if useInotify else None
+        remote = [
+            str(d)
+            for d in self.baseDirs.values()
+            if (fsType(d) or "").startswith(REMOTEFS)
+        ]
+        if remote:
+            logging.info(f"watcher - {remote} on a remote filesystem, polling.")
+        elif self.libc is not None:
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+            else:
+                logging.info(
+                    f"watcher - inotify unavailable ({os.strerror(ctypes.get_errno())}), polling."
+                )
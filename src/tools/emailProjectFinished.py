@@ -6,23 +6,15 @@ import smtplib
 import sys
 from email.mime.text import MIMEText
 
-import requests
-
 from dissectBCL.misc import getConf, projectPI
+from dissectBCL.parkour import parkourClient
 
 
 def getContactDetails(projectID, config):
     """
     Retrieve user data from a given sequencing request
     """
-    res = requests.get(
-        config["parkour"]["URL"]
-        + "/api/requests/"
-        + projectID
-        + "/get_contact_details",
-        auth=(config["parkour"]["user"], config["parkour"]["password"]),
-        verify=config["parkour"]["cert"],
-    )
+    res = parkourClient(config).get(f"/api/requests/{projectID}/get_contact_details")
     if res.status_code != 200:
         raise RuntimeError(f"API error: {res.json()}")
     return res.json()
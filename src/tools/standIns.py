@@ -0,0 +1,374 @@
+import configparser
+import json
+import random
+import socketserver
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import rich_click as click
+
+# Served when no recording is available. internal_pis needs to be non-empty,
+# dissectBCL refuses to start on an empty PI list.
+DEFAULTRESPONSES = {
+    "internal_pis": {"pis": ["manke"]},
+    "analysis_list": {},
+    "generate_ro_crate": {"ro_crate": {"@graph": []}, "skipped_records": []},
+    "get_contact_details": {
+        "user_name": "Jane Doe",
+        "user_email": "jane.doe@localhost",
+        "pi_name": "Manke",
+    },
+}
+
+FEXSEND = '''#!{python}
+"""
+fexsend stand-in, written by dissectBCL's standIns. Keeps 'uploads' under
+{store}. Supports -l (list), -d (delete) and -s (upload from stdin).
+"""
+import random
+import sys
+import time
+from pathlib import Path
+
+store = Path({store!r})
+time.sleep({latency} + random.uniform(0, {jitter}))
+args = sys.argv[1:]
+if args[0] == "-l":
+    print("\\n".join(sorted(p.name for p in store.iterdir())))
+elif args[0] == "-d":
+    (store / args[1]).unlink(missing_ok=True)
+elif args[0] == "-s":
+    with open(store / args[1], "wb") as f:
+        while True:
+            chunk = sys.stdin.buffer.read(1 << 20)
+            if not chunk:
+                break
+            f.write(chunk)
+else:
+    sys.exit(f"fexsend stand-in: unsupported arguments {{args}}")
+'''
+
+
+def _sleep(latency, jitter):
+    if latency or jitter:
+        time.sleep(latency + random.uniform(0, jitter))
+
+
+class _parkourHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        standIn = self.server.standIn
+        _sleep(standIn.latency, standIn.jitter)
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        name = [p for p in url.path.split("/") if p][-1]
+        standIn.record("GET", url.path, query)
+        if name not in DEFAULTRESPONSES:
+            self._reply(404, {"detail": f"{url.path} not recorded"})
+            return
+        self._reply(200, standIn.response(name, query))
+
+    def do_POST(self):
+        standIn = self.server.standIn
+        _sleep(standIn.latency, standIn.jitter)
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        data = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        standIn.record("POST", url.path, data)
+        self._reply(200, {"success": True})
+
+
+class parkourStandInClass:
+    """
+    Parkour stand-in. GETs of analysis_list, internal_pis, generate_ro_crate
+    and get_contact_details are answered from recordings: <name>_<value>.json
+    for the first query value (e.g. analysis_list_HCCMWDRXY.json, keyed on
+    flowcell_id), then <name>.json, then DEFAULTRESPONSES. Every request,
+    including the POSTs to run_statistics/upload and put_filepaths, is
+    appended to captureDir/parkour.jsonl.
+    """
+
+    def response(self, name, query):
+        if self.recordings:
+            for value in list(query.values())[:1]:
+                f = self.recordings / f"{name}_{value}.json"
+                if f.exists():
+                    return json.loads(f.read_text())
+            f = self.recordings / f"{name}.json"
+            if f.exists():
+                return json.loads(f.read_text())
+        return DEFAULTRESPONSES[name]
+
+    def record(self, method, path, payload):
+        with self.lock, open(self.captureDir / "parkour.jsonl", "a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "method": method,
+                        "path": path,
+                        "data": payload,
+                    }
+                )
+                + "\n"
+            )
+
+    def captured(self):
+        f = self.captureDir / "parkour.jsonl"
+        if not f.exists():
+            return []
+        return [json.loads(line) for line in f.read_text().splitlines()]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __init__(self, captureDir, recordings=None, port=0, latency=0, jitter=0):
+        self.captureDir = Path(captureDir)
+        self.captureDir.mkdir(parents=True, exist_ok=True)
+        self.recordings = Path(recordings) if recordings else None
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _parkourHandler)
+        self.server.daemon_threads = True
+        self.server.standIn = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+
+class _smtpHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib.sendmail: no auth, no TLS, no extensions.
+    """
+
+    def _send(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink = self.server.sink
+        self._send("220 dissectBCL SMTP sink")
+        sender, rcpts = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors="replace").strip()
+            verb = cmd.split(" ")[0].upper()
+            if verb in ("HELO", "EHLO"):
+                self._send("250 localhost")
+            elif verb == "MAIL":
+                sender, rcpts = cmd.split(":", 1)[1].strip(" <>"), []
+                self._send("250 OK")
+            elif verb == "RCPT":
+                rcpts.append(cmd.split(":", 1)[1].strip(" <>"))
+                self._send("250 OK")
+            elif verb == "DATA":
+                self._send("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    dataLine = self.rfile.readline()
+                    if dataLine in (b".\r\n", b".\n", b""):
+                        break
+                    if dataLine.startswith(b".."):
+                        dataLine = dataLine[1:]
+                    lines.append(dataLine)
+                _sleep(sink.latency, sink.jitter)
+                sink.store(sender, rcpts, b"".join(lines))
+                self._send("250 OK: queued")
+            elif verb == "RSET":
+                sender, rcpts = None, []
+                self._send("250 OK")
+            elif verb == "NOOP":
+                self._send("250 OK")
+            elif verb == "QUIT":
+                self._send("221 Bye")
+                return
+            else:
+                self._send("502 Command not implemented")
+
+
+class _threadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class smtpSinkClass:
+    """
+    SMTP sink for mailHome & co. Every message is written to
+    captureDir/mail/<n>.eml, with its envelope in captureDir/mail.jsonl.
+    Point [communication] host at host:port, smtplib parses that.
+    """
+
+    def store(self, sender, rcpts, message):
+        with self.lock:
+            self.count += 1
+            emlFile = self.mailDir / f"{self.count:05d}.eml"
+            emlFile.write_bytes(message)
+            with open(self.captureDir / "mail.jsonl", "a") as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "time": time.time(),
+                            "from": sender,
+                            "to": rcpts,
+                            "file": str(emlFile),
+                        }
+                    )
+                    + "\n"
+                )
+
+    def captured(self):
+        f = self.captureDir / "mail.jsonl"
+        if not f.exists():
+            return []
+        return [json.loads(line) for line in f.read_text().splitlines()]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __init__(self, captureDir, port=0, latency=0, jitter=0):
+        self.captureDir = Path(captureDir)
+        self.mailDir = self.captureDir / "mail"
+        self.mailDir.mkdir(parents=True, exist_ok=True)
+        self.latency = latency
+        self.jitter = jitter
+        self.count = 0
+        self.lock = threading.Lock()
+        self.server = _threadingTCPServer(("127.0.0.1", port), _smtpHandler)
+        self.server.sink = self
+        self.host = f"127.0.0.1:{self.server.server_address[1]}"
+
+
+def writeFexsend(binDir, storeDir, latency=0, jitter=0):
+    """
+    Write a fexsend stand-in into binDir, uploads end up in storeDir.
+    Put binDir first on the PATH to use it.
+    """
+    binDir = Path(binDir)
+    storeDir = Path(storeDir)
+    binDir.mkdir(parents=True, exist_ok=True)
+    storeDir.mkdir(parents=True, exist_ok=True)
+    fexsend = binDir / "fexsend"
+    fexsend.write_text(
+        FEXSEND.format(
+            python=sys.executable,
+            store=str(storeDir.resolve()),
+            latency=latency,
+            jitter=jitter,
+        )
+    )
+    fexsend.chmod(fexsend.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return fexsend
+
+
+def writeConfig(configfile, outfile, parkourURL, smtpHost):
+    """
+    Copy of configfile with Parkour and the mail host pointed at the stand-ins.
+    """
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    for section in ("parkour", "communication"):
+        if section not in config:
+            config[section] = {}
+    config["parkour"]["URL"] = parkourURL
+    config["parkour"]["cert"] = ""
+    config["communication"]["host"] = smtpHost
+    with open(outfile, "w") as f:
+        config.write(f)
+    return outfile
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option(
+    "--workdir",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="directory for captured requests, mails, fex uploads and the fexsend stand-in.",
+)
+@click.option(
+    "--recordings",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="directory with recorded Parkour responses (e.g. analysis_list_<FID>.json).",
+)
+@click.option(
+    "--configfile",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="dissectBCL ini file. If given, a copy pointing at the stand-ins is written into the workdir.",
+)
+@click.option("--httpPort", "httpport", type=int, default=0, help="default = random")
+@click.option("--smtpPort", "smtpport", type=int, default=0, help="default = random")
+@click.option(
+    "--latency",
+    type=float,
+    default=0,
+    help="seconds added to every Parkour request, mail and fexsend call. default = 0",
+)
+@click.option(
+    "--jitter",
+    type=float,
+    default=0,
+    help="up to this many random seconds on top of --latency. default = 0",
+)
+def main(workdir, recordings, configfile, httpport, smtpport, latency, jitter):
+    """
+    Run local stand-ins for Parkour, the SMTP host and fexsend, so dissect -f
+    can run (and be benchmarked) end to end offline.
+    """
+    workdir = Path(workdir)
+    captureDir = workdir / "captured"
+    parkour = parkourStandInClass(
+        captureDir, recordings, httpport, latency, jitter
+    ).start()
+    smtp = smtpSinkClass(captureDir, smtpport, latency, jitter).start()
+    fexsend = writeFexsend(workdir / "bin", workdir / "fex", latency, jitter)
+    print(f"Parkour stand-in: {parkour.url}")
+    print(f"SMTP sink:        {smtp.host}")
+    print(f"fexsend stand-in: {fexsend}")
+    print(f"Captured traffic: {captureDir}")
+    if configfile:
+        outfile = writeConfig(
+            configfile, workdir / "dissectBCL_standIns.ini", parkour.url, smtp.host
+        )
+        print(f"Config:           {outfile}")
+    print(f"\nexport PATH={fexsend.parent}:$PATH")
+    print("Stop with Ctrl-C.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        parkour.stop()
+        smtp.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,10 @@ import sys
 from pathlib import Path
 from subprocess import check_output
 
-import requests
 from rich import print
 
 from dissectBCL.misc import projectPI
+from dissectBCL.parkour import getParkourClient
 
 
 def fetchLatestSeqDir(pref, PI, postfix):
@@ -78,14 +78,9 @@ def fetchFolders(flowcellPath, piList, prefix, postfix, fexBool, parkourVars):
                     d = {"data": tarBall, "metadata": None}
                     print(
                         f"{tarBall} found in fexlist. Added filepaths to Parkour2: ",
-                        requests.post(
-                            parkourURL
-                            + "/api/requests/"
-                            + proj.split("_")[1]
-                            + "/put_filepaths/",
-                            auth=parkourAuth,
+                        getParkourClient(parkourURL, parkourAuth, parkourCert).post(
+                            f"/api/requests/{proj.split('_')[1]}/put_filepaths/",
                             data=d,
-                            verify=parkourCert,
                         ),
                     )
             else:
@@ -237,14 +232,9 @@ def rel(
             }
             print(
                 "Adding filepaths to Parkour2:",
-                requests.post(
-                    parkourURL
-                    + "/api/requests/"
-                    + proj.split("_")[1]
-                    + "/put_filepaths/",
-                    auth=parkourAuth,
+                getParkourClient(parkourURL, parkourAuth, parkourCert).post(
+                    f"/api/requests/{proj.split('_')[1]}/put_filepaths/",
                     data=d,
-                    verify=parkourCert,
                 ),
             )  # print the returned answer from the API
         else:
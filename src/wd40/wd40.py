@@ -15,7 +15,6 @@ can_string += "[blue]    WD40   | [yellow]D[/yellow] |  Kriechöl[/blue]\n"
 can_string += "[blue]           | [yellow]4[/yellow] |[/blue]\n"
 can_string += "[blue]           | [yellow]0[/yellow] |[/blue]\n"
 can_string += "[blue]           |___|[/blue]\n"
-print(can_string)
 
 click.rich_click.OPTION_GROUPS = {
     "wd40": [
@@ -58,6 +57,7 @@ click.rich_click.COMMAND_GROUPS = {
 @click.version_option(version("dissectBCL"), prog_name="wd40")
 @click.pass_context
 def cli(ctx, configpath, debug):
+    print(can_string)
     ctx.ensure_object(dict)
     ctx.obj["DEBUG"] = debug
     ctx.obj["configpath"] = configpath
@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path_factory, monkeypatch):
+    """
+    Keep dissectBCL's on-disk caches out of the user's ~/.cache.
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path_factory.mktemp("cache")))
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="Also run the (timing dependent) benchmarks.",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: timing dependent, only runs with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
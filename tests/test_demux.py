@@ -1,8 +1,13 @@
+import numpy as np
 import pandas as pd
 import os
 from dissectBCL.demux import detMask
 from dissectBCL.demux import hamming2Mismatch
+from dissectBCL.demux import matchingSheets
+from dissectBCL.demux import misMatcher
+from dissectBCL.demux import parseStats
 from dissectBCL.demux import readDemuxSheet
+from dissectBCL.demux import writeDemuxSheet
 
 class Test_demux_data():
     def test_hamming2Mismatch(self):
@@ -35,6 +40,86 @@ class Test_demuxSheet_Files():
             ['Lane', 'Sample_ID', 'index', 'index2', 'Sample_Project'], dtype='object'))
         assert dualIx
 
+class Test_writeDemuxSheet():
+    @staticmethod
+    def ssDicFor(sequencer, dualIx):
+        if sequencer == "aviti":
+            df = pd.DataFrame({
+                "SampleName": ["S1", "S2", "PhiX"],
+                "Index1": ["AAAAAAAA", "CCCCCCCC", np.nan],
+                "Index2": ["GGGGGGGG", np.nan, "TTTTTTTT"],
+                "Lane": ["1", "1+2", "1"],
+                "Project": ["Project_1_a_B", "Project_1_a_B", "PhiX"],
+                "Extra": [1, 2, 3],
+            })
+            mask = {"R1FastQMask": "R1:Y151N*", "I1Mask": "I1:Y8", "I2Mask": "I2:Y8"}
+            mm = {"I1MismatchThreshold": 1, "I2MismatchThreshold": 2}
+            opts = ["SpikeInAsUnassigned,FALSE,,,"]
+        else:
+            df = pd.DataFrame({
+                "Lane": [1, 1, 2],
+                "Sample_ID": ["S1", "S2", "S3"],
+                "Sample_Name": ["a", "b", "c"],
+                "index": ["AAAAAAAA", "CCCCCCCC", np.nan],
+                "index2": ["GGGGGGGG", np.nan, "TTTTTTTT"],
+                "Sample_Project": ["Project_1_a_B", "Project_1_a_B", "Project_2_c_D"],
+                "reqDepth": [1.5, np.nan, 2.0],
+            })
+            mask = "Y151;I8;I8;Y151"
+            mm = {"BarcodeMismatchesIndex1": 1, "BarcodeMismatchesIndex2": 0}
+            opts = ["CreateFastQForIndexReads,1,,", "TrimUMI,0,,"]
+        return {"sampleSheet": df, "mask": mask, "dualIx": dualIx, "convertOpts": opts, "mismatch": mm}
+
+    def test_golden(self, tmp_path):
+        # Golden files were written by the iterrows() writers this replaced.
+        golden = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), 'test_demux', 'demuxSheets'
+        )
+        for sequencer in ('illumina', 'aviti'):
+            for dualIx in (True, False):
+                for split in (True, False):
+                    name = f"{sequencer}_{'dual' if dualIx else 'single'}_{'split' if split else 'nosplit'}.csv"
+                    writeDemuxSheet(tmp_path / name, self.ssDicFor(sequencer, dualIx), split, sequencer)
+                    with open(os.path.join(golden, name), 'rb') as f:
+                        assert (tmp_path / name).read_bytes() == f.read(), name
+        ssDic = self.ssDicFor('illumina', True)
+        del ssDic['mismatch']
+        ssDic['convertOpts'] = []
+        writeDemuxSheet(tmp_path / 'nomismatch.csv', ssDic, True)
+        with open(os.path.join(golden, 'illumina_nomismatch.csv'), 'rb') as f:
+            assert (tmp_path / 'nomismatch.csv').read_bytes() == f.read()
+        # Nothing left behind from the atomic write.
+        assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith('.')) == []
+
+    def test_readDemuxSheet_roundtrip(self, tmp_path):
+        ssDic = self.ssDicFor('illumina', True)
+        writeDemuxSheet(tmp_path / 'demuxSheet.csv', ssDic, True)
+        mask, df, dualIx, manDic = readDemuxSheet(tmp_path / 'demuxSheet.csv')
+        assert mask == ssDic['mask']
+        assert manDic == ssDic['mismatch']
+        assert list(df['Sample_ID']) == ['S1', 'S2', 'S3']
+        assert dualIx
+
+    def test_10k_samples(self, tmp_path):
+        import time
+        n = 10000
+        ssDic = self.ssDicFor('illumina', True)
+        ssDic['sampleSheet'] = pd.DataFrame({
+            'Lane': [1 + i % 4 for i in range(n)],
+            'Sample_ID': [f'S{i}' for i in range(n)],
+            'index': [f'{i:010d}'.translate(str.maketrans('0123456789', 'ACGTACGTAC')) for i in range(n)],
+            'index2': ['ACGTACGTAC'] * n,
+            'Sample_Project': [f'Project_{i // 100}_a_B' for i in range(n)],
+        })
+        start = time.perf_counter()
+        writeDemuxSheet(tmp_path / 'demuxSheet.csv', ssDic, True)
+        took = time.perf_counter() - start
+        assert took < 1
+        lines = (tmp_path / 'demuxSheet.csv').read_text().splitlines()
+        assert lines[-1] == '4,S9999,AAAAAACCCC,ACGTACGTAC,Project_99_a_B'
+        assert len(lines) == n + 12
+
+
 class Test_detmask_Files():
     def readss(self, ss):
         sspath = os.path.join(
@@ -272,3 +357,437 @@ class Test_detmask_Files_aviti():
         assert convOpts == []
         assert minP5 == 8
         assert minP7 == 8
+
+
+class Test_misMatcher():
+    @staticmethod
+    def reference(P7s, P5s, sequencer):
+        # The pairwise misc.hamming implementation misMatcher used to have.
+        from itertools import combinations
+        from dissectBCL.misc import hamming
+        mmDic = {}
+        for i, ix_list in enumerate((P7s, P5s)):
+            if not ix_list.empty and not ix_list.isnull().all():
+                hammings = [hamming(a, b) for a, b in combinations(ix_list, 2)]
+                if hammings:
+                    key = f"I{i + 1}MismatchThreshold" if sequencer == "aviti" else f"BarcodeMismatchesIndex{i + 1}"
+                    mmDic[key] = hamming2Mismatch(min(hammings))
+        return mmDic
+
+    def test_hammingMatrix_matches_hamming(self):
+        import random
+        from dissectBCL.misc import hamming, hammingMatrix
+        rng = random.Random(42)
+        barcodes = [
+            ''.join(rng.choice('ACGTN') for _ in range(rng.choice([6, 8, 10])))
+            for _ in range(60)
+        ] + [float('nan'), None]
+        dist = hammingMatrix(barcodes, blockBytes=512)
+        for i, a in enumerate(barcodes):
+            for j, b in enumerate(barcodes):
+                assert dist[i, j] == hamming(a, b)
+
+    def test_same_thresholds_as_pairwise(self):
+        cases = [
+            (['AAAAAAAA', 'AAAAAACC', 'TTTTTTTT'], []),
+            (['AAAAAAAA', 'CCCCCCCC'], []),
+            (['AAAAAAAA', 'AAAAAAAA'], ['ACGTACGT', float('nan')]),
+            (['ACGT'], ['ACGT']),
+            ([float('nan'), float('nan')], ['ACGTACGTAC', 'ACGTACGT']),
+        ]
+        for P7s, P5s in cases:
+            for sequencer in ('illumina', 'aviti'):
+                P7s_ser = pd.Series(P7s, dtype='object')
+                P5s_ser = pd.Series(P5s, dtype='object')
+                assert misMatcher(P7s_ser, P5s_ser, sequencer) == self.reference(
+                    P7s_ser, P5s_ser, sequencer
+                )
+
+    def test_joint_dual_index(self):
+        # Close on P7 but far apart on P5: per index that would be 0 and 2.
+        P7s = pd.Series(['AAAAAAAA', 'AAAAAACC', 'TTTTTTTT'])
+        P5s = pd.Series(['CCCCCCCC', 'GGGGGGGG', 'TTTTAAAA'])
+        assert misMatcher(P7s, P5s, 'illumina') == {
+            'BarcodeMismatchesIndex1': 2,
+            'BarcodeMismatchesIndex2': 2,
+        }
+        # Close on both: P7 at 2, P5 at 4. (1, 2) would clash, (2, 1) doesn't.
+        P5s = pd.Series(['CCCCCCCC', 'CCCCGGGG', 'TTTTAAAA'])
+        assert misMatcher(P7s, P5s, 'aviti') == {
+            'I1MismatchThreshold': 2,
+            'I2MismatchThreshold': 1,
+        }
+        # Identical dual indices stay at 0.
+        P5s = pd.Series(['CCCCCCCC', 'CCCCCCCC', 'TTTTAAAA'])
+        P7s = pd.Series(['AAAAAAAA', 'AAAAAAAA', 'TTTTTTTT'])
+        assert misMatcher(P7s, P5s, 'illumina') == {
+            'BarcodeMismatchesIndex1': 0,
+            'BarcodeMismatchesIndex2': 0,
+        }
+
+    def test_jointMismatch(self):
+        import numpy as np
+        from dissectBCL.demux import jointMismatch
+        # One pair close on P7, one close on P5: (2, 1) and (1, 2) clash,
+        # (2, 0), (0, 2) and (1, 1) don't. The balanced one wins.
+        d7 = np.array([2, 4])
+        d5 = np.array([4, 2])
+        assert jointMismatch(d7, d5) == (1, 1)
+        # Never below the starting point.
+        assert jointMismatch(d7, d5, (2, 0)) == (2, 0)
+
+    def test_collisions(self):
+        P7s = pd.Series(['AAAAAAAA', 'AAAAAAAC', 'TTTTTTTT', 'TTTTTTTG'])
+        mmDic, collisions = misMatcher(P7s, pd.Series(dtype='float64'), 'illumina', returnCollisions=True)
+        assert mmDic == {'BarcodeMismatchesIndex1': 0}
+        assert collisions == {
+            'BarcodeMismatchesIndex1': [
+                ('AAAAAAAA', 'AAAAAAAC', 1),
+                ('TTTTTTTT', 'TTTTTTTG', 1),
+            ]
+        }
+
+    def test_384plex_is_fast(self):
+        import itertools
+        import time
+        barcodes = [''.join(p) for p in itertools.islice(itertools.product('ACGT', repeat=10), 0, 4**10, 4**10 // 1536)][:1536]
+        P7s = pd.Series(barcodes)
+        start = time.perf_counter()
+        misMatcher(P7s, P7s.str[::-1], 'illumina')
+        assert time.perf_counter() - start < 5
+
+
+class Test_parseStats():
+    def test_illumina_lanes_averaged(self, tmp_path):
+        (tmp_path / 'Reports').mkdir()
+        (tmp_path / 'Reports' / 'Quality_Metrics.csv').write_text(
+            'Lane,SampleID,index,index2,ReadNumber,Yield,YieldQ30,QualityScoreSum,Mean Quality Score (PF),% Q30\n'
+            '1,S1,AAAA,CCCC,1,1,1,1,30.0,0.90\n'
+            '1,S1,AAAA,CCCC,2,1,1,1,20.0,0.80\n'
+            '2,S1,AAAA,CCCC,1,1,1,1,33.0,0.93\n'
+            '2,S1,AAAA,CCCC,2,1,1,1,20.0,0.80\n'
+            '3,S1,AAAA,CCCC,1,1,1,1,36.0,0.99\n'
+            '3,S1,AAAA,CCCC,2,1,1,1,20.0,0.80\n'
+            '1,S2,GGGG,TTTT,1,1,1,1,35.555,0.5\n'
+            '1,Undetermined,,,1,1,1,1,10.0,0.1\n'
+        )
+        (tmp_path / 'Reports' / 'Demultiplex_Stats.csv').write_text(
+            'Lane,SampleID,Sample_Project,Index,# Reads\n'
+            '1,S1,P,AAAA-CCCC,100\n'
+            '2,S1,P,AAAA-CCCC,200\n'
+            '3,S1,P,AAAA-CCCC,300\n'
+            '1,S2,P,GGGG-TTTT,5\n'
+            '1,Undetermined,,,7\n'
+        )
+        ssdf = pd.DataFrame({'Sample_ID': ['S2', 'S1', 'S3'], 'Lane': ['1+2+3'] * 3})
+        df = parseStats(tmp_path, ssdf)
+        assert list(df['Sample_ID']) == ['S2', 'S1', 'S3']
+        # A true mean over all 3 lanes.
+        assert list(df['meanQ'][:2]) == ['1:35.56', '1:33.0,2:20.0']
+        assert list(df['percQ30'][:2]) == ['1:50.0', '1:94.0,2:80.0']
+        assert list(df['gotDepth'][:2]) == [5, 600]
+        assert pd.isna(df['gotDepth'].iloc[2])
+
+    def test_aviti(self, tmp_path):
+        import json
+        for project, sample, reads in (('P1', 'S1', 2), ('P2', 'S2', 1)):
+            d = tmp_path / 'Samples' / project / sample
+            d.mkdir(parents=True)
+            (d / f'{sample}_stats.json').write_text(json.dumps({
+                'QualityScoreMean': 40.1,
+                'PercentQ30': 95.2,
+                'NumPolonies': 1000 * reads,
+                'Reads': [{}] * reads,
+            }))
+        # Not in the sampleSheet, so never read.
+        d = tmp_path / 'Samples' / 'P1' / 'S9'
+        d.mkdir()
+        (d / 'S9_stats.json').write_text('not json')
+        ssdf = pd.DataFrame({
+            'SampleName': ['S1', 'S2', 'S3', 'PhiX'],
+            'Project': ['P1', 'P2', 'P2', np.nan],
+            'Sample_ID': ['S1', 'S2', 'S3', np.nan],
+        })
+        df = parseStats(tmp_path, ssdf, mode='aviti')
+        assert list(df['meanQ'][:2]) == ['1:40.1,2:40.1', '1:40.1']
+        assert list(df['percQ30'][:2]) == ['1:95.2,2:95.2', '1:95.2']
+        assert list(df['gotDepth'][:2]) == [2000, 1000]
+        assert df[['meanQ', 'gotDepth']].iloc[2:].isna().all().all()
+
+
+class Test_matchingSheets():
+    @staticmethod
+    def autodf():
+        return pd.DataFrame({
+            'Sample_ID': ['S1', 'S2', 'S3'],
+            'index': ['AAAA', 'CCCC', 'GGGG'],
+            'index2': ['TTTT', 'TTTT', 'TTTT'],
+            'I7_Index_ID': ['A1', 'A2', 'A3'],
+            'I5_Index_ID': ['B1', 'B2', 'B3'],
+        })
+
+    def test_dualIx(self, caplog):
+        import logging
+        mandf = pd.DataFrame({
+            'Sample_ID': ['S3', 'S1', 'S9'],
+            'index': ['GGGG', 'ACGT', 'TTTT'],
+            'index2': ['CCCC', 'TTTT', 'TTTT'],
+        })
+        with caplog.at_level(logging.INFO):
+            df = matchingSheets(self.autodf(), mandf)
+        assert list(df['index']) == ['ACGT', 'CCCC', 'GGGG']
+        assert list(df['index2']) == ['TTTT', 'TTTT', 'CCCC']
+        assert df['I7_Index_ID'].isna().tolist() == [True, False, False]
+        assert df['I5_Index_ID'].isna().tolist() == [False, False, True]
+        # One table for all changes.
+        assert len(caplog.records) == 1
+        msg = caplog.records[0].getMessage()
+        assert 'for 2 sample(s)' in msg
+        assert 'AAAA -> ACGT' in msg and 'TTTT -> CCCC' in msg
+        assert 'S2' not in msg
+
+    def test_singleIx(self):
+        mandf = pd.DataFrame({
+            'Sample_ID': ['S1', 'S2'],
+            'index': ['ACGT', 'CCCC'],
+        })
+        df = matchingSheets(self.autodf(), mandf)
+        assert list(df['index']) == ['ACGT', 'CCCC', 'GGGG']
+        assert df['index2'].isna().tolist() == [True, False, False]
+        assert df['I5_Index_ID'].isna().tolist() == [True, False, False]
+
+    def test_no_indices(self):
+        autodf = pd.DataFrame({'Sample_ID': ['S1']})
+        assert matchingSheets(autodf, pd.DataFrame({'Sample_ID': ['S1']})) is autodf
+
+    def test_large_sheet_is_fast(self):
+        import time
+        n = 20000
+        autodf = pd.DataFrame({
+            'Sample_ID': [f'S{i}' for i in range(n)],
+            'index': ['AAAA'] * n,
+            'index2': ['CCCC'] * n,
+            'I7_Index_ID': ['A'] * n,
+            'I5_Index_ID': ['B'] * n,
+        })
+        mandf = autodf[['Sample_ID', 'index', 'index2']].copy()
+        mandf.loc[::2, 'index'] = 'GGGG'
+        start = time.perf_counter()
+        df = matchingSheets(autodf, mandf)
+        assert time.perf_counter() - start < 2
+        assert (df['index'] == 'GGGG').sum() == n // 2
+
+
+class Test_runConverter():
+    def test_streams_and_bounded_tail(self, tmp_path, caplog):
+        import logging
+        import sys
+        from dissectBCL.demux import runConverter
+        script = tmp_path / 'tool.py'
+        script.write_text(
+            'import sys, time\n'
+            'from pathlib import Path\n'
+            'print("starting", flush=True)\n'
+            'Path(sys.argv[1], "out.fastq.gz").write_bytes(b"x" * 2000000)\n'
+            'time.sleep(1.5)\n'
+            'for i in range(50000):\n'
+            '    sys.stderr.write(f"line {i}\\n")\n'
+            'sys.exit(3)\n'
+        )
+        out = tmp_path / 'out'
+        out.mkdir()
+        caplog.set_level(logging.INFO)
+        exitcode, tail = runConverter(
+            [sys.executable, script, out], out, 'lane_1', interval=0.5, tailLines=10
+        )
+        assert exitcode == 3
+        assert tail.splitlines() == [f'line {i}' for i in range(49990, 50000)]
+        messages = [r.getMessage() for r in caplog.records]
+        assert 'Demux - lane_1 - stdout: starting' in messages
+        assert 'Demux - lane_1 - stderr: line 49999' in messages
+        progress = [m for m in messages if 'progress' in m]
+        assert progress
+        assert progress[-1].startswith('Demux - lane_1 - progress: 0.0 GB written')
+
+
+class Test_P5Orientation():
+    def test_rcP5DemuxSheet(self, tmp_path):
+        import shutil
+        from dissectBCL.demux import rcP5DemuxSheet
+        sheet = tmp_path / 'demuxSheet.csv'
+        shutil.copy(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'test_demux', 'demuxSheet.csv'
+        ), sheet)
+        before = readDemuxSheet(sheet, what='df')
+        rcP5DemuxSheet(sheet)
+        after = readDemuxSheet(sheet, what='df')
+        assert sheet.with_suffix('.bak').exists()
+        assert list(after['index']) == list(before['index'])
+        assert after['index2'].iloc[0] == 'GATGTCGA'
+        assert before['index2'].iloc[0] == 'TCGACATC'
+
+    def test_scoreP5Orientation(self, tmp_path):
+        from dissectBCL.demux import scoreP5Orientation
+        demuxdf = pd.DataFrame({
+            'Sample_ID': ['S1', 'S2'],
+            'index': ['AAAACCCC', 'GGGGTTTT'],
+            'index2': ['AACCGGTT', 'ACACACAC'],
+        })
+        (tmp_path / 'Demultiplex_Stats.csv').write_text(
+            'Lane,SampleID,Index,# Reads\n'
+            '1,S1,AAAACCCC-AACCGGTT,3\n'
+            '1,S2,GGGGTTTT-ACACACAC,0\n'
+            '1,Undetermined,,500\n'
+        )
+        assert scoreP5Orientation(tmp_path, demuxdf) == (3, 0)
+        (tmp_path / 'Top_Unknown_Barcodes.csv').write_text(
+            'Lane,index,index2,# Reads,% of Unknown Barcodes,% of All Reads\n'
+            '1,AAAACCCC,AACCGGTT,100,0.2,0.2\n'
+            '1,GGGGTTTT,GTGTGTGT,200,0.4,0.4\n'
+            '1,AAAACCCC,AACCGGTTNN,50,0.1,0.1\n'
+            '1,TTTTTTTT,AACCGGTT,150,0.3,0.3\n'
+        )
+        # AACCGGTT is its own RC.
+        assert scoreP5Orientation(tmp_path, demuxdf) == (3, 350)
+
+
+class Test_previewSummary():
+    def test_go_and_no_go(self, tmp_path):
+        from dissectBCL.demux import previewSummary
+        demuxdf = pd.DataFrame({'Sample_ID': ['S1', 'S2', 'S3']})
+        (tmp_path / 'Demultiplex_Stats.csv').write_text(
+            'Lane,SampleID,Index,# Reads\n'
+            '1,S1,A,400\n'
+            '1,S2,C,300\n'
+            '1,Undetermined,,300\n'
+        )
+        (tmp_path / 'Top_Unknown_Barcodes.csv').write_text(
+            'Lane,index,index2,# Reads\n'
+            '1,GGGG,TTTT,20\n'
+            '1,AAAA,CCCC,250\n'
+        )
+        summary = previewSummary(tmp_path, demuxdf)
+        assert summary['assignmentRate'] == 0.7
+        assert summary['emptySamples'] == ['S3']
+        assert summary['topUnknown'][0] == ('AAAA+CCCC', 250, 0.25)
+        # 1 of 3 samples empty.
+        assert not summary['go']
+        assert summary['reasons'] == ['1 of 3 samples without reads (maximum 10%)']
+        assert previewSummary(tmp_path, demuxdf, maxEmpty=0.5)['go']
+        summary = previewSummary(tmp_path, demuxdf, minAssigned=0.8, maxEmpty=0.5)
+        assert summary['reasons'] == ['70% of reads assigned (minimum 80%)']
+
+
+class Test_diagnoseUnknownBarcodes():
+    def test_variants_and_other_lanes(self, tmp_path):
+        from dissectBCL.demux import diagnoseUnknownBarcodes, suggestDemuxSheet
+        sampleDF = pd.DataFrame({
+            'Lane': [1, 1, 1],
+            'Sample_ID': ['S1', 'S2', 'S3'],
+            'index': ['AAAACCCC', 'GGGGTTTT', 'ACGTACGA'],
+            'index2': ['CAGTCAGT', 'TTGGAACC', 'GATCGATC'],
+            'Sample_Project': ['P1', 'P1', 'P1'],
+        })
+        otherDF = pd.DataFrame({
+            'Lane': [2],
+            'Sample_ID': ['S4'],
+            'index': ['TTTTCCCC'],
+            'index2': ['GGGGAAAA'],
+            'Sample_Project': ['P2'],
+        })
+        unknownDF = pd.DataFrame({
+            'Lane': [1] * 6,
+            # S1 P5 RC, S1 P5 RC with a mismatch, S2 swapped, S4, S1 P7 RC,
+            # and one that matches nothing.
+            'index': ['AAAACCCC', 'AAAACCCA', 'TTGGAACC', 'TTTTCCCC', 'GGGGTTTT', 'CACACACA'],
+            'index2': ['ACTGACTG', 'ACTGACTG', 'GGGGTTTT', 'GGGGAAAA', 'CAGTCAGT', 'CACACACA'],
+            '# Reads': [1000, 100, 500, 300, 10, 90],
+        })
+        diag = diagnoseUnknownBarcodes(
+            unknownDF, sampleDF, 2000, {'lanes_2': otherDF}
+        )
+        hits = diag['hits'].set_index('barcode')
+        assert hits.loc['AAAACCCC+ACTGACTG', 'variant'] == 'P5 RC'
+        assert hits.loc['AAAACCCC+ACTGACTG', 'mismatches'] == 0
+        assert hits.loc['AAAACCCA+ACTGACTG', 'mismatches'] == 1
+        assert hits.loc['TTGGAACC+GGGGTTTT', 'variant'] == 'P7/P5 swapped'
+        assert hits.loc['TTTTCCCC+GGGGAAAA', 'variant'] == 'from lanes_2'
+        assert 'CACACACA+CACACACA' not in hits.index
+        # S1 keeps the variant with most reads, P7 RC (10 reads) is dropped.
+        corrections = diag['corrections'].set_index('Sample_ID')
+        assert corrections.loc['S1', 'variant'] == 'P5 RC'
+        assert corrections.loc['S1', 'reads'] == 1100
+        assert diag['recovered'] == 1900
+        assert diag['fraction'] == 0.95
+
+        ssDic = {
+            'sampleSheet': sampleDF,
+            'mask': 'Y51;I8;I8;Y51',
+            'convertOpts': [],
+            'dualIx': True,
+            'mismatch': {},
+        }
+        suggestDemuxSheet(
+            tmp_path / 'demuxSheet.suggested.csv', ssDic, diag['corrections'],
+            {'lanes_2': otherDF}, True
+        )
+        mask, df, dualIx, manDic = readDemuxSheet(tmp_path / 'demuxSheet.suggested.csv')
+        df = df.set_index('Sample_ID')
+        assert df.loc['S1', 'index2'] == 'ACTGACTG'
+        assert df.loc['S2', 'index'] == 'TTGGAACC'
+        assert df.loc['S2', 'index2'] == 'GGGGTTTT'
+        assert df.loc['S3', 'index'] == 'ACGTACGA'
+        assert df.loc['S4', 'Lane'] == '1'
+
+    def test_ambiguous_and_single_index(self):
+        from dissectBCL.demux import diagnoseUnknownBarcodes
+        sampleDF = pd.DataFrame({
+            'Sample_ID': ['S1', 'S2'],
+            'index': ['AAAAAAAA', 'CCCCCCCC'],
+            'index2': [np.nan, np.nan],
+        })
+        unknownDF = pd.DataFrame({
+            # RC of S1 and S2, and one that is neither.
+            'index': ['TTTTTTTT', 'GGGGGGGG', 'TTTTGGGG'],
+            '# Reads': [50, 40, 30],
+        })
+        diag = diagnoseUnknownBarcodes(unknownDF, sampleDF, 200)
+        assert list(diag['hits']['variant']) == ['P7 RC', 'P7 RC']
+        assert diag['fraction'] == 0.45
+        # GGGGGGGT is 1 off from S2's RC, ambiguous with a sample that
+        # RCs to GGGGGGGA.
+        sampleDF.loc[len(sampleDF)] = ['S3', 'TCCCCCCC', np.nan]
+        unknownDF = pd.DataFrame({'index': ['GGGGGGGT'], '# Reads': [10]})
+        diag = diagnoseUnknownBarcodes(unknownDF, sampleDF, 10)
+        assert diag['hits'].empty
+        assert diag['recovered'] == 0
+
+    def test_noindex_sample(self):
+        from dissectBCL.demux import diagnoseUnknownBarcodes
+        # The noindex sheet as read by the pipeline, P7 and P5 are NaN.
+        sampleDF = Test_detmask_Files().readss('noindex.tsv')
+        sampleDF[['index', 'index2']] = np.nan
+        unknownDF = pd.DataFrame({'index': ['TTTTTTTT'], '# Reads': [10]})
+        diag = diagnoseUnknownBarcodes(unknownDF, sampleDF, 10)
+        assert diag['hits'].empty
+        assert diag['corrections'].empty
+        assert diag['fraction'] == 0.0
+
+    def test_single_index_sheet(self):
+        from dissectBCL.demux import diagnoseUnknownBarcodes
+        # No index2 column at all, here and in the other outLane.
+        sampleDF = pd.DataFrame({
+            'Sample_ID': ['S1', 'S2'],
+            'index': ['AAAAAAAA', np.nan],
+        })
+        otherDF = pd.DataFrame({'Sample_ID': ['S3'], 'index': ['GGGGCCCC']})
+        unknownDF = pd.DataFrame({
+            'index': ['TTTTTTTT', 'GGGGCCCC'],
+            '# Reads': [50, 30],
+        })
+        diag = diagnoseUnknownBarcodes(unknownDF, sampleDF, 100, {'lanes_2': otherDF})
+        hits = diag['hits'].set_index('barcode')
+        assert hits.loc['TTTTTTTT', 'variant'] == 'P7 RC'
+        assert hits.loc['GGGGCCCC', 'variant'] == 'from lanes_2'
+        assert diag['fraction'] == 0.8
@@ -1,7 +1,7 @@
 import configparser
 import json
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from dissectBCL.fakeNews import pushParkour, shipFiles
 
@@ -107,7 +107,7 @@ class _FakeSampleSheet:
 
 
 class Test_pushParkour_aviti_outBaseDir:
-    @patch("dissectBCL.fakeNews.requests.post")
+    @patch("requests.Session.request")
     def test_reads_RunStats_from_outBaseDir_not_config_outputDir(
         self, mock_post, tmp_path
     ):
@@ -148,6 +148,7 @@ class Test_pushParkour_aviti_outBaseDir:
             "cert": "",
         }
         sampleSheet = _FakeSampleSheet({outLane: {}})
+        mock_post.return_value = Mock(status_code=200)
 
         pushParkour(
             "20260804_AV251009_run1",
@@ -0,0 +1,444 @@
+import random
+import threading
+import time
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from dissectBCL.flowcell import sampleSheetClass
+
+
+def sheet(rows, runInfoLanes, forceLaneSplit=False):
+    ss = sampleSheetClass.__new__(sampleSheetClass)
+    ss.fullSS = pd.DataFrame(
+        rows, columns=["Lane", "Sample_ID", "index", "index2", "Sample_Project"]
+    )
+    ss.runInfoLanes = runInfoLanes
+    ss.forceLaneSplit = forceLaneSplit
+    return ss
+
+
+class Test_decideSplit():
+    def test_split(self):
+        ss = sheet(
+            [
+                ("1", "S1", "AAAA", "CCCC", "P1"),
+                ("1", "S2", "AAAA", "GGGG", "P1"),
+                ("2", "S3", "AAAA", "CCCC", "P2"),
+                ("2", "PhiX", "TTTT", "TTTT", "0000_PhiX_DeepSeq"),
+                ("1", "PhiX", "TTTT", "TTTT", "0000_PhiX_DeepSeq"),
+            ],
+            2,
+        )
+        assert ss.decideSplit(aviti=False)
+        assert ss.splitExplanation == {
+            "laneSplit": True,
+            "samplesInMultipleLanes": [],
+            "projectsInMultipleLanes": [],
+            "lanesListed": 2,
+            "lanesFound": 2,
+            "indexClashes": [],
+            "forced": False,
+        }
+
+    def test_no_split(self):
+        ss = sheet(
+            [
+                ("1", "S1", "AAAA", "CCCC", "P1"),
+                ("2", "S1", "AAAA", "CCCC", "P1"),
+                ("2", "S2", "AAAA", "GGGG", "P1"),
+                ("2", "S3", "TTTT", None, "P2"),
+                ("2", "S4", "TTTT", None, "P2"),
+            ],
+            2,
+        )
+        assert not ss.decideSplit(aviti=False)
+        assert ss.splitExplanation["samplesInMultipleLanes"] == ["S1"]
+        assert ss.splitExplanation["projectsInMultipleLanes"] == ["P1"]
+        # Samples without a P5 can't clash.
+        assert ss.splitExplanation["indexClashes"] == []
+
+    def test_clash_overrides(self):
+        ss = sheet(
+            [
+                ("1", "S1", "AAAA", "CCCC", "P1"),
+                ("1", "S2", "GGGG", "CCCC", "P1"),
+                ("1", "S3", "AAAA", "CCCC", "P2"),
+            ],
+            2,
+        )
+        assert ss.decideSplit(aviti=False)
+        assert ss.splitExplanation["lanesListed"] == 1
+        assert ss.splitExplanation["indexClashes"] == [
+            {"indices": ["AAAA", "CCCC"], "samples": ["S1", "S3"]}
+        ]
+
+    def test_forced(self):
+        ss = sheet([("1", "S1", "AAAA", "CCCC", "P1")], 2, forceLaneSplit=True)
+        assert ss.decideSplit(aviti=False)
+        assert ss.splitExplanation["forced"]
+
+    def test_aviti_colnames(self):
+        ss = sheet([("1", "S1", "AAAA", "CCCC", "P1"), ("2", "S1", "AAAA", "CCCC", "P1")], 2)
+        ss.fullSS.columns = ["Lane", "SampleName", "Index1", "Index2", "Project"]
+        assert not ss.decideSplit(aviti=True)
+        assert ss.splitExplanation["samplesInMultipleLanes"] == ["S1"]
+
+    def test_large_sheet_is_fast(self):
+        rng = random.Random(1)
+        rows = [
+            (
+                str(1 + i % 4),
+                f"S{i}",
+                "".join(rng.choice("ACGT") for _ in range(10)),
+                "".join(rng.choice("ACGT") for _ in range(10)),
+                f"P{i // 500}",
+            )
+            for i in range(40000)
+        ]
+        ss = sheet(rows, 4)
+        start = time.perf_counter()
+        assert not ss.decideSplit(aviti=False)
+        assert time.perf_counter() - start < 2
+        assert len(ss.splitExplanation["projectsInMultipleLanes"]) == 80
+
+
+FAKEBCLCONVERT = '''#!{python}
+import sys, time, json
+from pathlib import Path
+args = sys.argv[1:]
+out = Path(args[args.index("--output-directory") + 1])
+start = time.time()
+print(f"converting {{out.name}}", flush=True)
+time.sleep(0.5)
+if "{fail}" and "lanes{fail}" in str(out):
+    sys.stderr.write("boom")
+    sys.exit(2)
+out.mkdir(exist_ok=True)
+(out / "Reports").mkdir()
+(out / "Reports" / "Quality_Metrics.csv").write_text(
+    "Lane,SampleID,ReadNumber,Mean Quality Score (PF),% Q30\\n1,S1,1,30.0,0.9\\n"
+)
+(out / "Reports" / "Demultiplex_Stats.csv").write_text("Lane,SampleID,# Reads\\n1,S1,10\\n")
+(out / "run.json").write_text(json.dumps({{
+    "start": start, "end": time.time(),
+    "threads": args[args.index("--bcl-num-conversion-threads") + 1],
+}}))
+'''
+
+
+def fakeFlowcell(tmp_path, concurrentLanes, fail=""):
+    import sys
+    from dissectBCL.flowcell import flowCellClass
+    bclconvert = tmp_path / 'bclconvert'
+    bclconvert.write_text(FAKEBCLCONVERT.format(python=sys.executable, fail=fail))
+    bclconvert.chmod(0o755)
+    fc = flowCellClass.__new__(flowCellClass)
+    fc.name = 'flowcell'
+    fc.sequencer = 'NovaSeq'
+    fc.successfulrun = 'SuccessfullyCompleted'
+    fc.exitStats = {}
+    fc.bclPath = tmp_path / 'bcl'
+    fc._inputSize = None
+    fc.inputSizeLock = threading.Lock()
+    fc.outBaseDir = tmp_path / 'out'
+    fc.outBaseDir.mkdir()
+    fc.config = {
+        'software': {'bclconvert': str(bclconvert)},
+        'misc': {'threads': '8', 'concurrentLanes': str(concurrentLanes)},
+    }
+    fc.sampleSheet = sampleSheetClass.__new__(sampleSheetClass)
+    fc.sampleSheet.laneSplitStatus = True
+    fc.sampleSheet.ssDic = {
+        f'flowcell_lanes_{lane}': {
+            'sampleSheet': pd.DataFrame({
+                'Lane': [lane], 'Sample_ID': ['S1'], 'index': ['AAAA'],
+                'Sample_Project': ['P'],
+            }),
+            'mask': 'Y51;I4', 'dualIx': False, 'convertOpts': [],
+            'mismatch': {'BarcodeMismatchesIndex1': 1},
+        }
+        for lane in (1, 2, 3, 4)
+    }
+    return fc
+
+
+class Test_demux_lanes():
+    def test_sequential(self, tmp_path):
+        import json
+        fc = fakeFlowcell(tmp_path, 1)
+        fc.demux()
+        runs = [
+            json.loads((fc.outBaseDir / outLane / 'run.json').read_text())
+            for outLane in fc.sampleSheet.ssDic
+        ]
+        assert [r['threads'] for r in runs] == ['4'] * 4
+        assert all(a['end'] <= b['start'] for a, b in zip(runs, runs[1:]))
+        assert fc.exitStats['demux'] == 0
+
+    def test_concurrent(self, tmp_path, caplog):
+        import json
+        import logging
+        caplog.set_level(logging.INFO)
+        fc = fakeFlowcell(tmp_path, 2)
+        with patch(
+            'dissectBCL.flowcell.estimateFlowcellSize', return_value=10**9
+        ) as scan:
+            fc.demux()
+        # The input is scanned once, not once per lane.
+        assert scan.call_count == 1
+        runs = [
+            json.loads((fc.outBaseDir / outLane / 'run.json').read_text())
+            for outLane in fc.sampleSheet.ssDic
+        ]
+        # 8 threads over 2 lanes, split in conversion & compression.
+        assert [r['threads'] for r in runs] == ['2'] * 4
+        assert runs[1]['start'] < runs[0]['end']
+        for outLane, _ssDic in fc.sampleSheet.ssDic.items():
+            assert (fc.outBaseDir / outLane / 'bclconvert.done').exists()
+            assert list(_ssDic['sampleSheet']['gotDepth']) == [10]
+            log = (fc.outBaseDir / outLane / 'demux.log').read_text()
+            assert f'Demux - {outLane} - bclConvert exit 0' in log
+            # Logged by the thread that streams bcl-convert's stdout.
+            assert f'Demux - {outLane} - stdout: converting {outLane}' in log
+            assert 'of the 1.0 GB input' in log
+            others = set(fc.sampleSheet.ssDic) - {outLane}
+            assert not any(f'Demux - {o} ' in log for o in others)
+
+        # Resume: done lanes aren't converted again.
+        (fc.outBaseDir / 'flowcell_lanes_3' / 'bclconvert.done').unlink()
+        before = {
+            o: (fc.outBaseDir / o / 'run.json').stat().st_mtime_ns
+            for o in fc.sampleSheet.ssDic
+        }
+        fc.demux()
+        for o in fc.sampleSheet.ssDic:
+            changed = (fc.outBaseDir / o / 'run.json').stat().st_mtime_ns != before[o]
+            assert changed == (o == 'flowcell_lanes_3')
+
+    @patch('dissectBCL.flowcell.mailHome')
+    def test_concurrent_failure(self, mock_mail, tmp_path):
+        fc = fakeFlowcell(tmp_path, 2, fail='_2')
+        with pytest.raises(SystemExit):
+            fc.demux()
+        assert mock_mail.call_args[0][0] == 'flowcell_lanes_2'
+        assert 'boom' in mock_mail.call_args[0][1]
+        assert not (fc.outBaseDir / 'flowcell_lanes_2' / 'bclconvert.done').exists()
+        assert (fc.outBaseDir / 'flowcell_lanes_1' / 'bclconvert.done').exists()
+        assert 'demux' not in fc.exitStats
+
+
+FAKEMISEQ = '''#!{python}
+import sys
+from pathlib import Path
+args = sys.argv[1:]
+out = Path(args[args.index("--output-directory") + 1])
+sheet = Path(args[args.index("--sample-sheet") + 1]).read_text()
+out.mkdir(exist_ok=True)
+with open(out.parent / "calls.txt" if out.name == "P5check" else out / "calls.txt", "a") as f:
+    f.write(" ".join(args[-2:]) + "\\n")
+(out / "Reports").mkdir()
+# The P5s on the flowcell are AATTGGCC, the RC of GGCCAATT.
+fwd = 1000 if "AATTGGCC" in sheet else 0
+(out / "Reports" / "Demultiplex_Stats.csv").write_text(
+    f"Lane,SampleID,Index,# Reads\\n1,S1,AAAACCCC-GGCCAATT,{{fwd}}\\n1,Undetermined,,50\\n"
+)
+(out / "Reports" / "Top_Unknown_Barcodes.csv").write_text(
+    "Lane,index,index2,# Reads\\n" + ("" if fwd else "1,AAAACCCC,AATTGGCC,40\\n")
+)
+(out / "Reports" / "Quality_Metrics.csv").write_text(
+    "Lane,SampleID,ReadNumber,Mean Quality Score (PF),% Q30\\n1,S1,1,30.0,0.9\\n"
+)
+'''
+
+
+class Test_predictP5():
+    def run(self, tmp_path, index2, demux=True):
+        import sys
+        fc = fakeFlowcell(tmp_path, 1)
+        bclconvert = tmp_path / 'bclconvert'
+        bclconvert.write_text(FAKEMISEQ.format(python=sys.executable))
+        fc.sequencer = 'MiSeq'
+        fc.sampleSheet.ssDic = {
+            'flowcell_lanes_1': {
+                'sampleSheet': pd.DataFrame({
+                    'Lane': [1], 'Sample_ID': ['S1'], 'index': ['AAAACCCC'],
+                    'index2': [index2], 'Sample_Project': ['P'],
+                    'I5_Index_ID': ['X'],
+                }),
+                'mask': 'Y51;I8;I8', 'dualIx': True, 'convertOpts': [],
+                'mismatch': {'BarcodeMismatchesIndex1': 1},
+            }
+        }
+        if demux:
+            fc.demux()
+        return fc, fc.outBaseDir / 'flowcell_lanes_1'
+
+    def test_rc_up_front(self, tmp_path):
+        fc, outputFolder = self.run(tmp_path, 'GGCCAATT')
+        _ssDic = fc.sampleSheet.ssDic['flowcell_lanes_1']
+        # One check on the first tile, then one full run.
+        assert (outputFolder / 'calls.txt').read_text().splitlines() == [
+            '--first-tile-only true',
+            '--bcl-sampleproject-subdirectories true',
+        ]
+        assert not (outputFolder / 'P5check').exists()
+        assert (outputFolder / 'demuxSheet.bak').exists()
+        assert _ssDic['P5RC']
+        assert list(_ssDic['sampleSheet']['index2']) == ['AATTGGCC']
+        assert list(_ssDic['sampleSheet']['gotDepth']) == [1000]
+
+    def test_orientation_ok(self, tmp_path):
+        fc, outputFolder = self.run(tmp_path, 'AATTGGCC')
+        assert not (outputFolder / 'demuxSheet.bak').exists()
+        assert not fc.sampleSheet.ssDic['flowcell_lanes_1']['P5RC']
+        assert len((outputFolder / 'calls.txt').read_text().splitlines()) == 2
+
+
+class Test_preview():
+    def test_go(self, tmp_path):
+        fc = fakeFlowcell(tmp_path, 1)
+        assert fc.preview()
+        for outLane in fc.sampleSheet.ssDic:
+            outputFolder = fc.outBaseDir / outLane
+            assert (outputFolder / 'demuxSheet.csv').exists()
+            assert not (outputFolder / 'preview').exists()
+            assert not (outputFolder / 'bclconvert.done').exists()
+        assert fc.previewSummaries['flowcell_lanes_1']['assignmentRate'] == 1.0
+
+    @patch('dissectBCL.flowcell.mailHome')
+    def test_miseq_p5_rc(self, mock_mail, tmp_path):
+        # The sheet's P5s need an RC: the preview scores the RC'ed sheet, like
+        # the full run would demultiplex with, instead of calling a no-go.
+        fc, outputFolder = Test_predictP5().run(tmp_path, 'GGCCAATT', demux=False)
+        assert fc.preview()
+        mock_mail.assert_not_called()
+        assert fc.previewSummaries['flowcell_lanes_1']['go']
+        assert (outputFolder / 'demuxSheet.bak').exists()
+        fc.demux()
+        # No second orientation check, one full run.
+        assert (outputFolder / 'calls.txt').read_text().splitlines() == [
+            '--bcl-sampleproject-subdirectories true',
+        ]
+        _ssDic = fc.sampleSheet.ssDic['flowcell_lanes_1']
+        assert _ssDic['P5RC']
+        assert list(_ssDic['sampleSheet']['gotDepth']) == [1000]
+
+    @patch('dissectBCL.flowcell.mailHome')
+    def test_no_go(self, mock_mail, tmp_path):
+        fc = fakeFlowcell(tmp_path, 1, fail='_2')
+        assert not fc.preview()
+        assert not fc.previewSummaries['flowcell_lanes_2']['go']
+        assert fc.previewSummaries['flowcell_lanes_1']['go']
+        assert mock_mail.call_args[0][0] == 'flowcell preview: no-go'
+        assert 'boom' in mock_mail.call_args[0][1]
+
+
+FAKEPOSTMUX = '''#!{python}
+import json, sys, time
+from pathlib import Path
+tool = Path(sys.argv[0]).name
+args = sys.argv[1:]
+start = time.time()
+if tool == "fastqc":
+    out = Path(args[args.index("-o") + 1])
+    time.sleep(0.6 if "S1" in out.name else 0.05)
+    (out / "sample_fastqc.zip").touch()
+    sample = out.name
+elif tool == "clumpify.sh":
+    Path("tmp.fq.gz").touch()
+    sample = Path.cwd().name
+elif tool == "splitFastq":
+    sample = Path.cwd().name
+elif tool == "kraken2":
+    report = Path(args[args.index("--report") + 1])
+    report.touch()
+    sample = report.parent.name
+with open({log!r}, "a") as f:
+    f.write(json.dumps([tool, sample, start, time.time()]) + "\\n")
+'''
+
+
+class Test_postmux_graph():
+    def test_samples_dont_wait_for_projects(self, tmp_path, monkeypatch):
+        import gzip
+        import json
+        import sys
+        bindir = tmp_path / 'bin'
+        bindir.mkdir()
+        log = tmp_path / 'tools.jsonl'
+        for tool in ('fastqc', 'clumpify.sh', 'splitFastq', 'kraken2'):
+            (bindir / tool).write_text(FAKEPOSTMUX.format(python=sys.executable, log=str(log)))
+            (bindir / tool).chmod(0o755)
+        monkeypatch.setenv('PATH', str(bindir), prepend=':')
+        fc = fakeFlowcell(tmp_path, 1)
+        fc.config['software'].update({
+            'fastqc_adapters': 'adapters.txt', 'splitFastq': 'splitFastq',
+            'kraken2db': 'db',
+        })
+        fc.config['Dirs'] = {'tempDir': str(tmp_path)}
+        fc.config['misc']['threads'] = '20'
+        outLane = 'flowcell_lanes_1'
+        fc.sampleSheet.ssDic = {outLane: fc.sampleSheet.ssDic[outLane]}
+        _ssDic = fc.sampleSheet.ssDic[outLane]
+        _ssDic['PE'] = True
+        _ssDic['sampleSheet'] = pd.DataFrame({
+            'Sample_ID': ['S1', 'S2'], 'Sample_Project': ['P1', 'P2'],
+        })
+        laneFolder = fc.outBaseDir / outLane
+        for project, sample in (('P1', 'S1'), ('P2', 'S2')):
+            (laneFolder / f'.{project}.renamed.done').parent.mkdir(exist_ok=True)
+            (laneFolder / f'.{project}.renamed.done').touch()
+            sampleDir = laneFolder / f'Project_{project}' / f'Sample_{sample}'
+            sampleDir.mkdir(parents=True)
+            for r in ('R1', 'R2'):
+                (sampleDir / f'{sample}_{r}.fastq.gz').write_bytes(gzip.compress(b''))
+        finished = {}
+
+        def md5_multiqc(project, laneFolder, flowcell):
+            finished[project] = time.time()
+
+        with patch('dissectBCL.flowcell.md5_multiqc', side_effect=md5_multiqc):
+            fc.postmux()
+        runs = {}
+        for line in log.read_text().splitlines():
+            tool, sample, start, end = json.loads(line)
+            runs[(tool, sample)] = (start, end)
+        assert set(runs) == {
+            (tool, f'Sample_{s}')
+            for tool in ('fastqc', 'clumpify.sh', 'splitFastq', 'kraken2')
+            for s in ('S1', 'S2')
+        }
+        # P2 is done (multiqc included) while S1's FastQC still runs.
+        assert finished['P2'] < runs[('fastqc', 'Sample_S1')][1]
+        assert finished['P1'] > runs[('kraken2', 'Sample_S1')][1]
+        for project in ('P1', 'P2'):
+            assert (laneFolder / f'.{project}.postmux.done').exists()
+        assert not list(laneFolder.rglob('tmp.fq.gz'))
+        fanout = json.loads(
+            (laneFolder / 'FASTQC_Project_P1' / 'Sample_S1' / 'fanout.json').read_text()
+        )
+        assert fanout['problems'] == []
+        assert fanout['files']['S1_R1.fastq.gz']['reads'] == 0
+        assert fc.exitStats['postmux'] == 0
+
+    def test_failure_mails_and_exits(self, tmp_path, monkeypatch):
+        import sys
+        bindir = tmp_path / 'bin'
+        bindir.mkdir()
+        (bindir / 'fastqc').write_text(f'#!{sys.executable}\nimport sys\nsys.exit(1)\n')
+        (bindir / 'fastqc').chmod(0o755)
+        monkeypatch.setenv('PATH', str(bindir), prepend=':')
+        fc = fakeFlowcell(tmp_path, 1)
+        fc.config['software']['fastqc_adapters'] = 'adapters.txt'
+        outLane = 'flowcell_lanes_1'
+        fc.sampleSheet.ssDic = {outLane: fc.sampleSheet.ssDic[outLane]}
+        fc.sampleSheet.ssDic[outLane]['PE'] = True
+        laneFolder = fc.outBaseDir / outLane
+        (laneFolder / 'Project_P' / 'Sample_S1').mkdir(parents=True)
+        (laneFolder / '.P.renamed.done').touch()
+        with patch('dissectBCL.flowcell.mailHome') as mail, pytest.raises(SystemExit):
+            fc.postmux()
+        assert mail.call_args[0][1] == 'FastQC runs failed for project P.'
+        assert not (laneFolder / '.P.postmux.done').exists()
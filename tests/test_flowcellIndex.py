@@ -0,0 +1,159 @@
+from pathlib import Path
+from unittest.mock import patch
+
+from dissectBCL.flowcellIndex import flowcellIndexClass, settleFlowcell
+from dissectBCL.misc import getNewFlowCell
+
+
+def _illumina_config(tmp_path):
+    base = tmp_path / "base"
+    out = tmp_path / "out"
+    logs = tmp_path / "logs"
+    base.mkdir()
+    out.mkdir()
+    return {
+        "Dirs": {
+            "baseDir_illumina": str(base),
+            "outputDir_illumina": str(out),
+            "flowLogDir_illumina": str(logs),
+        }
+    }
+
+
+def _make_flowcell(base, name, copied=True):
+    fc = Path(base) / name
+    fc.mkdir()
+    (fc / "RTAComplete.txt").touch()
+    if copied:
+        (fc / "CopyComplete.txt").touch()
+    return fc
+
+
+class Test_flowcellIndex:
+    def test_index_persists_under_flowLogDir(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        _make_flowcell(config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX")
+
+        getNewFlowCell(config, None, "illumina")
+
+        assert (tmp_path / "logs" / "flowcellIndex.sqlite").exists()
+
+    def test_waits_for_copycomplete(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        fc = _make_flowcell(
+            config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX", copied=False
+        )
+
+        assert getNewFlowCell(config, None, "illumina") == (None, None, None)
+
+        (fc / "CopyComplete.txt").touch()
+        assert getNewFlowCell(config, None, "illumina") == (
+            fc.name,
+            fc,
+            "illumina",
+        )
+
+    def test_terminal_flowcells_are_never_globbed_again(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        fc = _make_flowcell(config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX")
+        done = Path(config["Dirs"]["outputDir_illumina"]) / f"{fc.name}_lanes_1"
+        done.mkdir()
+        (done / "communication.done").touch()
+
+        assert getNewFlowCell(config, None, "illumina") == (None, None, None)
+
+        with patch.object(flowcellIndexClass, "doneState") as mock_doneState:
+            assert getNewFlowCell(config, None, "illumina") == (None, None, None)
+        mock_doneState.assert_not_called()
+
+    def test_reconcile_picks_up_removed_flags(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        fc = _make_flowcell(config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX")
+        done = Path(config["Dirs"]["outputDir_illumina"]) / f"{fc.name}_lanes_1"
+        done.mkdir()
+        (done / "communication.done").touch()
+        assert getNewFlowCell(config, None, "illumina") == (None, None, None)
+
+        # Removing the flag alone doesn't bring it back, the index says it's done.
+        (done / "communication.done").unlink()
+        assert getNewFlowCell(config, None, "illumina") == (None, None, None)
+
+        index = flowcellIndexClass(config, "illumina")
+        counts = index.reconcile()
+        index.close()
+        assert counts["ready"] == 1
+        assert getNewFlowCell(config, None, "illumina")[0] == fc.name
+
+    def test_first_use_seeds_from_flags(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        base = config["Dirs"]["baseDir_illumina"]
+        failed = _make_flowcell(base, "260101_A001_0001_AXXX")
+        shipped = _make_flowcell(base, "260102_A001_0002_AYYY")
+        new = _make_flowcell(base, "260103_A001_0003_AZZZ")
+        out = Path(config["Dirs"]["outputDir_illumina"])
+        (out / f"{failed.name}_lanes_1").mkdir()
+        (out / f"{failed.name}_lanes_1" / "run.failed").touch()
+        (out / f"{shipped.name}_lanes_1_2").mkdir()
+        (out / f"{shipped.name}_lanes_1_2" / "fastq.made").touch()
+
+        index = flowcellIndexClass(config, "illumina")
+        states = index.known()
+        index.close()
+
+        assert states == {
+            failed.name: "failed",
+            shipped.name: "communicated",
+            new.name: "ready",
+        }
+
+    def test_lane_split_needs_every_outlane_done(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        fc = _make_flowcell(config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX")
+        out = Path(config["Dirs"]["outputDir_illumina"])
+        for lane in ("lanes_1", "lanes_2"):
+            (out / f"{fc.name}_{lane}").mkdir()
+        (out / f"{fc.name}_lanes_1" / "communication.done").touch()
+
+        # One outLane still needs work (e.g. it was rescued).
+        index = flowcellIndexClass(config, "illumina")
+        assert index.reconcile()["ready"] == 1
+        index.close()
+        assert settleFlowcell(config, "illumina", fc.name, fc) is None
+        assert getNewFlowCell(config, fc, "illumina")[0] == fc.name
+
+        (out / f"{fc.name}_lanes_2" / "communication.done").touch()
+        index = flowcellIndexClass(config, "illumina")
+        assert index.reconcile()["communicated"] == 1
+        index.close()
+        assert settleFlowcell(config, "illumina", fc.name, fc) == "communicated"
+
+    def test_settle_marks_communicated(self, tmp_path):
+        config = _illumina_config(tmp_path)
+        fc = _make_flowcell(config["Dirs"]["baseDir_illumina"], "260101_A001_0001_AXXX")
+        assert getNewFlowCell(config, None, "illumina")[0] == fc.name
+
+        assert settleFlowcell(config, "illumina", fc.name, fc) is None
+        done = Path(config["Dirs"]["outputDir_illumina"]) / f"{fc.name}_lanes_1"
+        done.mkdir()
+        (done / "communication.done").touch()
+        assert settleFlowcell(config, "illumina", fc.name, fc) == "communicated"
+
+    def test_aviti_outcome_failed_is_terminal(self, tmp_path):
+        base = tmp_path / "base"
+        out = tmp_path / "out"
+        out.mkdir()
+        fc = base / "AV251009" / "20260804_AV251009_run1"
+        fc.mkdir(parents=True)
+        (fc / "RunUploaded.json").write_text('{"outcome": "OutcomeFailed"}')
+        config = {
+            "Dirs": {
+                "baseDir_aviti": str(base),
+                "outputDir_aviti": str(out),
+                "flowLogDir_aviti": str(tmp_path / "logs"),
+            }
+        }
+
+        assert getNewFlowCell(config, None, "aviti") == (None, None, None)
+        index = flowcellIndexClass(config, "aviti")
+        assert index.get(fc.name)["state"] == "failed"
+        index.close()
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Modules that are only needed once a flowcell is processed. None of the
+# console scripts should pull them in just to start up (or print --help).
+HEAVY = ("pandas", "numpy", "interop", "Bio", "dominate", "ruamel", "requests")
+# Cumulative import time budget per entry point, in seconds.
+BUDGET = float(os.environ.get("DISSECTBCL_IMPORT_BUDGET", 0.75))
+
+
+def _importtime(module):
+    """
+    Cold import of module in a fresh interpreter, parsed from -X importtime.
+    Returns ({imported module: cumulative seconds}, seconds for module).
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self, cumulative, name = line.split(":", 1)[1].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times, times[module]
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "dissectBCL.dissect",
+        "wd40.wd40",
+        "tools.emailProjectFinished",
+        "tools.prep_contaminome",
+    ],
+)
+class Test_importtime:
+    def test_no_heavy_imports(self, module):
+        times, _ = _importtime(module)
+        heavy = sorted(m for m in times if m.split(".")[0] in HEAVY)
+        assert heavy == [], f"{module} imports {heavy} at startup"
+
+    def test_cold_start_budget(self, module):
+        _, took = _importtime(module)
+        assert took < BUDGET, f"{module} took {took:.2f}s to import"
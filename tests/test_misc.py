@@ -20,10 +20,12 @@ from dissectBCL.misc import getConf
 from dissectBCL.misc import getNewFlowCell
 from dissectBCL.misc import projectPI
 from dissectBCL.misc import _resolve_internal_pis
+from dissectBCL.misc import _internal_pis
 from dissectBCL.misc import _fetch_ro_crate_metadata
 from dissectBCL.misc import _build_ro_crate_archive
 from dissectBCL.misc import _add_fastq_file_entities
 from dissectBCL.misc import fexUpload
+from dissectBCL.misc import getSoftwareVersions
 from zipfile import ZipFile, ZIP_STORED
 
 
@@ -61,8 +63,8 @@ class Test_projectPI:
 
 
 class Test_getConf_internal_pis:
-    @patch("dissectBCL.misc.requests.get")
-    def test_resolves_pi_list_from_parkour(self, mock_get, tmp_path):
+    @patch("requests.Session.request")
+    def test_resolves_pi_list_from_parkour(self, mock_get, tmp_path, capsys):
         mock_get.return_value = Mock(
             status_code=200,
             json=lambda: {"pis": ["Manke", "Cabezas"]},
@@ -70,18 +72,20 @@ class Test_getConf_internal_pis:
         ini_path = _write_test_ini(tmp_path)
 
         config = getConf(str(ini_path), quickload=True)
+        # wd40 & the email tool quickload, they don't want startup timings.
+        assert "Startup timing" not in capsys.readouterr().out
 
         mock_get.assert_called_once_with(
+            "GET",
             "https://parkour.domain.tld/api/internal_pis/",
             params={"organizations": "MPI-IE"},
-            auth=("parkourUser", "parkourPw"),
-            verify="/path/to/cert.pem",
+            timeout=(10, 60),
         )
         # Names are lowercased so they match the lowercased PI tokens the
         # shipping code compares against.
         assert config["Internals"]["PIs"] == "cabezas,manke"
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_raises_loudly_on_parkour_failure(self, mock_get, tmp_path):
         # Parkour being unreachable must crash rather than degrade: an empty PI
         # list would misroute internal PIs to external FEX shipment. Restarting
@@ -92,7 +96,7 @@ class Test_getConf_internal_pis:
         with pytest.raises(RuntimeError):
             getConf(str(ini_path), quickload=True)
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_raises_loudly_on_non_200_response(self, mock_get, tmp_path):
         mock_get.return_value = Mock(status_code=500, text="server error")
         ini_path = _write_test_ini(tmp_path)
@@ -100,7 +104,7 @@ class Test_getConf_internal_pis:
         with pytest.raises(RuntimeError):
             getConf(str(ini_path), quickload=True)
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_empty_pi_list_raises_runtimeerror(self, mock_get):
         # A 200 with an empty list (e.g. a misconfigured/bracketed Organizations
         # value) must crash rather than treat every PI as external.
@@ -117,7 +121,7 @@ class Test_getConf_internal_pis:
         with pytest.raises(RuntimeError):
             _resolve_internal_pis(config)
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_malformed_200_body_raises_runtimeerror(self, mock_get):
         # A 200 whose JSON lacks "pis" must surface as the descriptive
         # RuntimeError, not a bare KeyError.
@@ -250,6 +254,69 @@ class Test_getNewFlowCell_aviti_serial_id_nesting:
         assert result == (None, None, None)
 
 
+class Test_internal_pi_cache:
+    def _config(self, ttl=3600, maxStale=86400):
+        config = configparser.ConfigParser()
+        config["Internals"] = {"Organizations": "MPI-IE"}
+        config["parkour"] = {
+            "URL": "https://parkour.domain.tld",
+            "user": "u",
+            "password": "p",
+            "cert": "/cert.pem",
+            "piCacheTTL": str(ttl),
+            "piCacheMaxStale": str(maxStale),
+        }
+        return config
+
+    @patch("requests.Session.request")
+    def test_fresh_cache_skips_parkour(self, mock_get):
+        mock_get.return_value = Mock(status_code=200, json=lambda: {"pis": ["Manke"]})
+        config = self._config()
+
+        assert _internal_pis(config) == "manke"
+        mock_get.side_effect = ConnectionError("network down")
+        assert _internal_pis(config) == "manke"
+        assert mock_get.call_count == 1
+
+    @patch("requests.Session.request")
+    def test_stale_cache_is_served_and_refreshed(self, mock_get):
+        mock_get.return_value = Mock(status_code=200, json=lambda: {"pis": ["Manke"]})
+        config = self._config(ttl=0)
+        assert _internal_pis(config) == "manke"
+
+        mock_get.return_value = Mock(
+            status_code=200, json=lambda: {"pis": ["Manke", "Akhtar"]}
+        )
+        with patch("dissectBCL.misc.threading.Thread") as mock_thread:
+            assert _internal_pis(config) == "manke"
+        mock_thread.return_value.start.assert_called_once()
+        # Run the refresh the thread would have run.
+        mock_thread.call_args.kwargs["target"](*mock_thread.call_args.kwargs["args"])
+        with patch("dissectBCL.misc.threading.Thread"):
+            assert _internal_pis(config) == "akhtar,manke"
+
+    @patch("requests.Session.request")
+    def test_too_old_cache_fails_loudly_without_parkour(self, mock_get):
+        mock_get.return_value = Mock(status_code=200, json=lambda: {"pis": ["Manke"]})
+        config = self._config(ttl=0, maxStale=0)
+        assert _internal_pis(config) == "manke"
+
+        mock_get.side_effect = ConnectionError("network down")
+        with pytest.raises(RuntimeError):
+            _internal_pis(config)
+
+    @patch("requests.Session.request")
+    def test_empty_list_is_never_cached(self, mock_get):
+        mock_get.return_value = Mock(status_code=200, json=lambda: {"pis": []})
+        config = self._config()
+        with pytest.raises(RuntimeError):
+            _internal_pis(config)
+
+        mock_get.return_value = Mock(status_code=200, json=lambda: {"pis": ["Manke"]})
+        assert _internal_pis(config) == "manke"
+        assert mock_get.call_count == 2
+
+
 class Test_getConf_sequencer_gating:
     def _write_full_ini(self, tmp_path):
         adapters = tmp_path / "adapters.txt"
@@ -290,7 +357,7 @@ class Test_getConf_sequencer_gating:
             return Mock(stdout=b"", stderr=b"BBTools version 39.01\n")
         raise AssertionError(f"unexpected command probed: {cmd}")
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     @patch("dissectBCL.misc.sp.run")
     @patch("dissectBCL.misc.version", return_value="1.0")
     def test_illumina_only_skips_bases2fastq_probe(
@@ -309,7 +376,7 @@ class Test_getConf_sequencer_gating:
         assert "bases2fastq" not in config["softwareVers"]
         assert "splitFastq" in config["softwareVers"]
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     @patch("dissectBCL.misc.sp.run")
     @patch("dissectBCL.misc.version", return_value="1.0")
     def test_aviti_only_skips_bclconvert_probe(
@@ -329,8 +396,52 @@ class Test_getConf_sequencer_gating:
         assert "splitFastq" in config["softwareVers"]
 
 
+class Test_versionCache:
+    def _config(self, tmp_path):
+        bclconvert = tmp_path / "bclconvert"
+        bclconvert.write_text("#!/bin/sh\n")
+        bclconvert.chmod(0o755)
+        return {"software": {"bclconvert": str(bclconvert)}}, bclconvert
+
+    @patch("dissectBCL.misc.sp.run")
+    def test_versions_cached_until_binary_changes(self, mock_run, tmp_path):
+        mock_run.side_effect = Test_getConf_sequencer_gating._run_side_effect
+        config, bclconvert = self._config(tmp_path)
+
+        vers, timings = getSoftwareVersions(config, "illumina")
+        assert vers["bclconvert"] == "00.000.000.4.4.4"
+        assert timings["bclconvert"] != "cached"
+        probed = [c.args[0][0] for c in mock_run.call_args_list]
+        assert str(bclconvert) in probed
+
+        mock_run.reset_mock()
+        vers2, timings2 = getSoftwareVersions(config, "illumina")
+        assert vers2 == vers
+        assert timings2["bclconvert"] == "cached"
+        probed = [c.args[0][0] for c in mock_run.call_args_list]
+        assert str(bclconvert) not in probed
+
+        # An upgraded binary gets probed again.
+        bclconvert.write_text("#!/bin/sh\n# v2\n")
+        mock_run.reset_mock()
+        _, timings3 = getSoftwareVersions(config, "illumina")
+        assert timings3["bclconvert"] != "cached"
+
+    @patch("dissectBCL.misc.sp.run")
+    def test_unresolvable_binaries_are_not_cached(self, mock_run, tmp_path):
+        mock_run.side_effect = Test_getConf_sequencer_gating._run_side_effect
+        config = {"software": {"bclconvert": "/does/not/exist/bclconvert"}}
+
+        getSoftwareVersions(config, "illumina")
+        mock_run.reset_mock()
+        getSoftwareVersions(config, "illumina")
+
+        probed = [c.args[0][0] for c in mock_run.call_args_list]
+        assert "/does/not/exist/bclconvert" in probed
+
+
 class Test_ro_crate_archive:
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_fetch_ro_crate_metadata_returns_graph_on_success(self, mock_get):
         mock_get.return_value = Mock(
             status_code=200,
@@ -348,13 +459,13 @@ class Test_ro_crate_archive:
 
         assert result == {"@graph": []}
         mock_get.assert_called_once_with(
+            "GET",
             "https://parkour.domain.tld/api/generate_ro_crate/",
             params={"requests": "42", "preview": "true"},
-            auth=("u", "p"),
-            verify="/cert.pem",
+            timeout=(10, 60),
         )
 
-    @patch("dissectBCL.misc.requests.get")
+    @patch("requests.Session.request")
     def test_fetch_ro_crate_metadata_returns_none_on_failure(self, mock_get):
         mock_get.side_effect = ConnectionError("down")
         config = configparser.ConfigParser()
@@ -449,6 +560,44 @@ class Test_ro_crate_archive:
             assert "Project_42_jdoe_manke/sample_R1.fastq.gz" in names
             assert "ro-crate-metadata.json" in names
 
+    def test_build_ro_crate_archive_checks_fanout_crc32(self, tmp_path):
+        import io
+        import json
+        import zlib
+        from dissectBCL.misc import fanoutRecords
+
+        project_dir = tmp_path / "Project_42_jdoe_manke"
+        sample_dir = project_dir / "Sample_S1"
+        fanout_dir = tmp_path / "FASTQC_Project_42_jdoe_manke" / "Sample_S1"
+        sample_dir.mkdir(parents=True)
+        fanout_dir.mkdir(parents=True)
+        records = {}
+        for r in ("R1", "R2"):
+            fastq = sample_dir / f"S1_{r}.fastq.gz"
+            fastq.write_bytes(b"fake-gzip-bytes")
+            st = fastq.stat()
+            records[fastq.name] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "error": None,
+                "crc32": zlib.crc32(b"fake-gzip-bytes"),
+            }
+        fanout = fanout_dir / "fanout.json"
+        fanout.write_text(json.dumps({"files": records}))
+        opas = (project_dir, fanout_dir.parent)
+
+        with patch("dissectBCL.misc.fanoutRecords", wraps=fanoutRecords) as load:
+            _build_ro_crate_archive("fc", "p", opas, None, fileobj=io.BytesIO())
+        # Once per folder, not per file: Sample_S1 and the FASTQC one.
+        assert sorted(c.args[0].name for c in load.call_args_list) == [
+            "Sample_S1", "Sample_S1",
+        ]
+
+        records["S1_R1.fastq.gz"]["crc32"] += 1
+        fanout.write_text(json.dumps({"files": records}))
+        with pytest.raises(ValueError, match="CRC32"):
+            _build_ro_crate_archive("fc", "p", opas, None, fileobj=io.BytesIO())
+
 
 class Test_fexUpload:
     @patch("dissectBCL.misc._build_ro_crate_archive")
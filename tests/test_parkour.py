@@ -0,0 +1,86 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from dissectBCL.parkour import endpointName, getParkourClient, parkourClientClass
+
+
+class _Parkour(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.hits.append((self.path, self.headers.get("Authorization")))
+        server.ports.add(self.client_address[1])
+        if server.failures > 0:
+            server.failures -= 1
+            status, body = 503, b"{}"
+        else:
+            status, body = 200, json.dumps({"pis": ["Manke"]}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def parkour():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Parkour)
+    server.hits = []
+    server.ports = set()
+    server.failures = 0
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Test_parkourClient:
+    def test_endpointName(self):
+        assert (
+            endpointName("/api/requests/1234/put_filepaths/")
+            == "/api/requests/<id>/put_filepaths/"
+        )
+        assert endpointName("/api/internal_pis/?a=1") == "/api/internal_pis/"
+
+    def test_retries_with_auth_and_keepalive(self, parkour):
+        parkour.failures = 2
+        url = f"http://127.0.0.1:{parkour.server_address[1]}/"
+        client = parkourClientClass(url, ("u", "p"), False, retries=3, backoff=0)
+
+        res = client.get("/api/internal_pis/", params={"organizations": "MPI-IE"})
+        assert res.status_code == 200
+        assert res.json() == {"pis": ["Manke"]}
+        client.get("/api/internal_pis/")
+
+        assert len(parkour.hits) == 4
+        assert all(auth and auth.startswith("Basic ") for _, auth in parkour.hits)
+        # One pooled connection for all of them.
+        assert len(parkour.ports) == 1
+        m = client.metrics()["GET /api/internal_pis/"]
+        assert m["calls"] == 2
+        assert m["errors"] == 0
+
+    def test_last_response_returned_after_retries(self, parkour):
+        parkour.failures = 10
+        url = f"http://127.0.0.1:{parkour.server_address[1]}"
+        client = parkourClientClass(url, ("u", "p"), False, retries=1, backoff=0)
+
+        res = client.get("/api/internal_pis/")
+        assert res.status_code == 503
+        assert len(parkour.hits) == 2
+        assert client.metrics()["GET /api/internal_pis/"]["errors"] == 1
+
+    def test_client_is_shared(self):
+        a = getParkourClient("https://parkour.tld/", ("u", "p"), "/cert.pem")
+        b = getParkourClient("https://parkour.tld", ("u", "p"), "/cert.pem")
+        assert a is b
+        assert a.session.auth == ("u", "p")
+        assert a.session.verify == "/cert.pem"
@@ -0,0 +1,466 @@
+import gzip
+import hashlib
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import pytest
+
+from dissectBCL.postmux import md5Runner, md5Threads, taskGraphClass
+
+
+def recorder():
+    lock = threading.Lock()
+    log = {"events": [], "threads": 0, "maxThreads": 0}
+
+    def task(name, cost, duration=0.05, ok=True):
+        def run():
+            with lock:
+                log["threads"] += cost
+                log["maxThreads"] = max(log["maxThreads"], log["threads"])
+                log["events"].append(("start", name))
+            time.sleep(duration)
+            with lock:
+                log["threads"] -= cost
+                log["events"].append(("end", name))
+            return ok
+        return run
+
+    return log, task
+
+
+class Test_taskGraph():
+    def test_dependencies_and_budget(self):
+        log, task = recorder()
+        graph = taskGraphClass(4)
+        tails = []
+        for sample, duration in (("big", 0.3), ("small", 0.02)):
+            fqc = graph.add((sample, "fastqc"), task((sample, "fastqc"), 2, duration), cost=2)
+            clump = graph.add(
+                (sample, "clumpify"), task((sample, "clumpify"), 2), cost=2, after=[fqc]
+            )
+            tails.append(
+                graph.add((sample, "kraken"), task((sample, "kraken"), 1), after=[clump])
+            )
+        graph.add("multiqc", task("multiqc", 1), after=tails)
+        assert graph.run() is None
+        events = log["events"]
+        assert log["maxThreads"] <= 4
+        assert len(graph.done) == 7
+        # The small sample is done before the big one finishes FastQC.
+        assert events.index(("end", ("small", "kraken"))) < events.index(
+            ("end", ("big", "fastqc"))
+        )
+        for sample in ("big", "small"):
+            assert events.index(("end", (sample, "fastqc"))) < events.index(
+                ("start", (sample, "clumpify"))
+            )
+            assert events.index(("end", (sample, "clumpify"))) < events.index(
+                ("start", (sample, "kraken"))
+            )
+            assert events.index(("end", (sample, "kraken"))) < events.index(
+                ("start", "multiqc")
+            )
+
+    def test_ready_task_that_doesnt_fit_isnt_starved(self):
+        # A big sample's clumpify needs the whole budget, the small samples'
+        # tasks would keep backfilling the threads it waits for.
+        log, task = recorder()
+        graph = taskGraphClass(8)
+        fqc = graph.add(("big", "fastqc"), task(("big", "fastqc"), 2, 0.1), cost=2, priority=100)
+        graph.add(
+            ("big", "clumpify"), task(("big", "clumpify"), 8), cost=8, after=[fqc], priority=100
+        )
+        for i in range(12):
+            fqc = graph.add((i, "fastqc"), task((i, "fastqc"), 2), cost=2, priority=1)
+            graph.add((i, "clumpify"), task((i, "clumpify"), 1), after=[fqc], priority=1)
+        assert graph.run() is None
+        assert log["maxThreads"] <= 8
+        events = log["events"]
+        ready = events.index(("end", ("big", "fastqc")))
+        started = events.index(("start", ("big", "clumpify")))
+        # Nothing else is started between the big clumpify becoming ready
+        # and it starting.
+        assert not [e for e in events[ready:started] if e[0] == "start"]
+        assert any(e[0] == "start" for e in events[started + 1:])
+
+    def test_cost_capped_at_budget(self):
+        log, task = recorder()
+        graph = taskGraphClass(2)
+        graph.add("clumpify", task("clumpify", 2), cost=10)
+        assert graph.run() is None
+        assert graph.tasks["clumpify"]["cost"] == 2
+
+    def test_failure(self):
+        log, task = recorder()
+        graph = taskGraphClass(2)
+        bad = graph.add("bad", task("bad", 1, ok=False), onFail="bad failed")
+        graph.add("slow", task("slow", 1, duration=0.2))
+        graph.add("after", task("after", 1), after=[bad])
+        graph.add("later", task("later", 1))
+        assert graph.run() == ("bad", "bad failed")
+        started = [name for event, name in log["events"] if event == "start"]
+        # Running tasks finish, nothing new is started.
+        assert sorted(started) == ["bad", "slow"]
+        assert ("end", "slow") in log["events"]
+
+    def test_exception(self):
+        def boom():
+            raise SystemExit(1)
+
+        graph = taskGraphClass(2)
+        graph.add("boom", boom)
+        with pytest.raises(SystemExit):
+            graph.run()
+
+
+def skewedProject(tmp_path, n=12):
+    """
+    One big sample (6x) and n small ones, as fastq.gz of that many MB.
+    The big one sorts last by name.
+    """
+    sizes = {f"S{i:02d}": 1 for i in range(n)}
+    sizes["S99"] = 6
+    for ID, mb in sizes.items():
+        sampleDir = tmp_path / "Project_P" / f"Sample_{ID}"
+        sampleDir.mkdir(parents=True)
+        with open(sampleDir / f"{ID}_R1.fastq.gz", "wb") as f:
+            f.truncate(mb << 20)
+    return sizes
+
+
+class Test_largestFirst():
+    def test_order_and_threads(self, tmp_path):
+        from dissectBCL.postmux import largestFirst, sizeThreads
+        skewedProject(tmp_path, n=2)
+        assert largestFirst(tmp_path, "P", {"S00", "S01", "S99", "gone"}) == [
+            ("S99", 6 << 20), ("S00", 1 << 20), ("S01", 1 << 20), ("gone", 0),
+        ]
+        assert sizeThreads(0, 10, 1 << 29) == 1
+        assert sizeThreads((1 << 29) + 1, 10, 1 << 29) == 2
+        assert sizeThreads(100 << 30, 10, 1 << 29) == 10
+
+    def test_clump_and_kraken_threads_follow_size(self):
+        from dissectBCL.postmux import clumpThreads, krakenThreads
+        config = {"misc": {"threads": "40"}}
+        assert clumpThreads(config) == 10
+        assert clumpThreads(config, 1 << 20) == 1
+        assert clumpThreads(config, 2 << 30) == 4
+        assert krakenThreads(config, 2 << 30) == 2
+        assert krakenThreads({"misc": {"threads": "4"}}, 100 << 30) == 4
+
+    def test_largest_sample_starts_first(self, tmp_path):
+        """
+        With priority the big sample (last by name) is started first, the
+        others keep the order they were added in.
+        """
+        from dissectBCL.postmux import largestFirst
+        sizes = skewedProject(tmp_path, n=3)
+        nameOrder = sorted(largestFirst(tmp_path, "P", sizes))
+        for prioritize, started in (
+            (False, ["S00", "S01", "S02", "S99"]),
+            (True, ["S99", "S00", "S01", "S02"]),
+        ):
+            # One thread: tasks finish in the order they are started.
+            graph = taskGraphClass(1)
+            for ID, size in nameOrder:
+                graph.add(ID, lambda: True, priority=size if prioritize else 0)
+            graph.run()
+            assert graph.done == started
+
+    @pytest.mark.benchmark
+    def test_makespan_benchmark(self, tmp_path, record_property):
+        """
+        A skewed project on 4 threads, every task takes 0.1s per MB.
+        In set/name order the big sample starts last: 12 small ones take
+        3 rounds (0.3s), then the big one 0.6s. Largest first it runs
+        alongside the small ones, 0.6s in total.
+        """
+        from dissectBCL.postmux import largestFirst
+        sizes = skewedProject(tmp_path)
+
+        def makespan(order, prioritize):
+            graph = taskGraphClass(4)
+            for ID, size in order:
+                graph.add(
+                    ID,
+                    lambda mb=sizes[ID]: time.sleep(0.1 * mb),
+                    priority=size if prioritize else 0,
+                )
+            start = time.perf_counter()
+            graph.run()
+            return time.perf_counter() - start
+
+        nameOrder = sorted(largestFirst(tmp_path, "P", sizes))
+        fifo = makespan(nameOrder, prioritize=False)
+        ljf = makespan(nameOrder, prioritize=True)
+        record_property("makespan_name_order", round(fifo, 2))
+        record_property("makespan_largest_first", round(ljf, 2))
+        assert ljf < 0.8 * fifo
+
+
+class Test_md5():
+    def test_md5Runner(self, tmp_path):
+        fq = tmp_path / "S1_R1.fastq.gz"
+        data = os.urandom(100_000)
+        fq.write_bytes(data)
+        # A buffer that doesn't divide the file size.
+        assert md5Runner(fq, bufSize=4096) == (
+            "S1_R1.fastq.gz", hashlib.md5(data).hexdigest()
+        )
+        (tmp_path / "empty.fastq.gz").touch()
+        assert md5Runner(tmp_path / "empty.fastq.gz")[1] == hashlib.md5().hexdigest()
+
+    def test_md5Threads(self):
+        assert md5Threads({"misc": {"threads": "40"}}, 100) == 20
+        assert md5Threads({"misc": {"threads": "40"}}, 3) == 3
+        assert md5Threads({"misc": {"threads": "1"}}, 3) == 1
+
+    def test_md5Runner_memory(self, tmp_path):
+        """
+        Hashing a 32MB file allocates about the 1MB buffer, not the file.
+        """
+        fq = tmp_path / "big.fastq.gz"
+        chunk = os.urandom(1 << 20)
+        with open(fq, "wb") as f:
+            for _ in range(32):
+                f.write(chunk)
+        tracemalloc.start()
+        md5Runner(fq)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak < 4 << 20
+
+    @pytest.mark.benchmark
+    def test_md5_throughput_benchmark(self, tmp_path, record_property):
+        fq = tmp_path / "big.fastq.gz"
+        chunk = os.urandom(1 << 20)
+        with open(fq, "wb") as f:
+            for _ in range(256):
+                f.write(chunk)
+        start = time.perf_counter()
+        md5Runner(fq)
+        took = time.perf_counter() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record_property("md5_MB_per_s", round(256 / took))
+        record_property("peak_rss_MB", round(rss / 1024))
+        assert took < 5
+
+
+def fastqRecords(n, start=0):
+    return [
+        f"@read{i} 1:N:0:ACGT\nACGTACGT\n+\nFFFFFFFF\n".encode()
+        for i in range(start, start + n)
+    ]
+
+
+class Test_fanout():
+    def test_scanFastq(self, tmp_path):
+        import zlib
+        from dissectBCL.postmux import scanFastq
+        fq = tmp_path / "S1_R1.fastq.gz"
+        # Two gzip members (as pigz / rescue write them).
+        raw = gzip.compress(b"".join(fastqRecords(300))) + gzip.compress(
+            b"".join(fastqRecords(200, 300))
+        )
+        fq.write_bytes(raw)
+        # A small buffer puts chunk ends in the middle of records and members.
+        rec, sub = scanFastq(fq, subsampleReads=50, bufSize=1000)
+        assert rec["error"] is None
+        assert rec["reads"] == 500
+        assert rec["md5"] == hashlib.md5(raw).hexdigest()
+        assert rec["crc32"] == zlib.crc32(raw)
+        assert rec["size"] == len(raw)
+        assert len(sub) == 50
+        assert len(set(sub)) == 50
+        assert all(r in fastqRecords(500) for r in sub)
+        # Not just the head of the file.
+        assert any(int(r.split(b" ")[0][5:]) >= 300 for r in sub)
+        # Same seed and read count: R2 keeps the same reads.
+        assert scanFastq(fq, subsampleReads=50)[1] == sub
+        # Fewer reads than asked for: all of them.
+        assert scanFastq(fq, subsampleReads=1000)[1] == fastqRecords(500)
+
+    def test_scanFastq_errors(self, tmp_path):
+        from dissectBCL.postmux import scanFastq
+        fq = tmp_path / "S1_R1.fastq.gz"
+        full = gzip.compress(b"".join(fastqRecords(100)))
+        fq.write_bytes(full[:-20])
+        assert scanFastq(fq)[0]["error"] == "gzip stream is truncated"
+        fq.write_bytes(gzip.compress(b"".join(fastqRecords(2)) + b"@read2\nACGT\n"))
+        assert "incomplete record" in scanFastq(fq)[0]["error"]
+        fq.write_bytes(b"")
+        assert scanFastq(fq)[0]["error"] == "no gzip stream"
+        fq.write_bytes(b"not gzip")
+        assert scanFastq(fq)[0]["error"]
+
+    def test_fanoutSample(self, tmp_path):
+        import json
+        from dissectBCL.misc import fanoutRecord
+        from dissectBCL.postmux import fanoutSample
+        sampleDir = tmp_path / "Project_P" / "Sample_S1"
+        sampleDir.mkdir(parents=True)
+        for r in ("R1", "R2"):
+            (sampleDir / f"S1_{r}.fastq.gz").write_bytes(
+                gzip.compress(b"".join(fastqRecords(30)))
+            )
+        config = {"misc": {"subsampleReads": "10"}}
+        assert fanoutSample("P", tmp_path, "S1", config, {"S1": 30})
+        qcDir = tmp_path / "FASTQC_Project_P" / "Sample_S1"
+        fanout = json.loads((qcDir / "fanout.json").read_text())
+        assert fanout["problems"] == []
+        assert fanout["files"]["S1_R1.fastq.gz"]["subsample"] == (
+            "S1_R1.subsample.fastq.gz"
+        )
+        # The subsamples aren't in the delivered FASTQC folder.
+        assert sorted(f.name for f in qcDir.iterdir()) == ["fanout.json"]
+        subDir = tmp_path / "Subsamples" / "Project_P" / "Sample_S1"
+        with gzip.open(subDir / "S1_R1.subsample.fastq.gz") as f:
+            r1 = f.read()
+        with gzip.open(subDir / "S1_R2.subsample.fastq.gz") as f:
+            assert f.read() == r1
+        assert r1.count(b"\n") == 40
+        rec = fanoutRecord(sampleDir / "S1_R1.fastq.gz")
+        assert rec["reads"] == 30
+
+        # Up to date: nothing is read again.
+        with patch("dissectBCL.postmux.scanFastq") as scan:
+            assert fanoutSample("P", tmp_path, "S1", config, {"S1": 30})
+        scan.assert_not_called()
+
+        # A changed fastq is no longer vouched for, R1/R2 and stats disagree.
+        (sampleDir / "S1_R2.fastq.gz").write_bytes(
+            gzip.compress(b"".join(fastqRecords(29)))
+        )
+        assert fanoutRecord(sampleDir / "S1_R2.fastq.gz") is None
+        assert not fanoutSample("P", tmp_path, "S1", config, {"S1": 30})
+        problems = json.loads((qcDir / "fanout.json").read_text())["problems"]
+        assert problems == [
+            "read counts differ between fastqs: "
+            "{'S1_R1.fastq.gz': 30, 'S1_R2.fastq.gz': 29}",
+            "S1_R2.fastq.gz: 29 reads, Demultiplex_Stats.csv has 30",
+        ]
+
+    def test_md5sums_from_fanout(self, tmp_path):
+        from dissectBCL.postmux import fanoutSample, md5_multiqc
+        sampleDir = tmp_path / "Project_P" / "Sample_S1"
+        sampleDir.mkdir(parents=True)
+        fq = sampleDir / "S1_R1.fastq.gz"
+        fq.write_bytes(gzip.compress(b"".join(fastqRecords(5))))
+        config = {"misc": {"threads": "4", "subsampleReads": "0"}}
+        assert fanoutSample("P", tmp_path, "S1", config)
+
+        class fakeFlowcell:
+            pass
+        fc = fakeFlowcell()
+        fc.config = config
+        with (
+            patch("dissectBCL.postmux.md5Runner") as md5,
+            patch("dissectBCL.postmux.multiQC_yaml", side_effect=RuntimeError),
+            pytest.raises(RuntimeError),
+        ):
+            md5_multiqc("P", tmp_path, fc)
+        md5.assert_not_called()
+        assert (tmp_path / "Project_P" / "md5sums.txt").read_text() == (
+            f"S1_R1.fastq.gz\t{hashlib.md5(fq.read_bytes()).hexdigest()}\n"
+        )
+
+
+FAKECLUMP = '''#!{python}
+import gzip, sys
+args = dict(a.split("=", 1) for a in sys.argv[1:] if "=" in a)
+if {fail!r}:
+    sys.exit(3)
+with open(args["in"], "rb") as f, open(args["out"], "wb") as out:
+    out.write(gzip.compress(gzip.decompress(f.read())))
+'''
+
+FAKESPLIT = '''#!{python}
+import gzip, shutil, sys
+tmp, base = sys.argv[-2:]
+if {fail!r}:
+    sys.exit(4)
+with gzip.open(tmp) as f, gzip.open(base + "_R1.fastq.gz", "wb") as out:
+    shutil.copyfileobj(f, out)
+with open(base + ".duplicate.txt", "w") as out:
+    print(10, 0, 0.0, file=out)
+'''
+
+
+class Test_waitPipeline():
+    def procs(self, *sleeps):
+        import subprocess
+        import sys
+        return [
+            subprocess.Popen([sys.executable, "-c", f"import time; time.sleep({t})"])
+            for t in sleeps
+        ]
+
+    def test_busy_reader_isnt_killed(self):
+        from dissectBCL.postmux import waitPipeline
+        # The writer is done, the reader takes well beyond the grace period.
+        assert waitPipeline(self.procs(0, 1), grace=0.1) == (0, 0)
+
+    def test_orphaned_writer_is_killed(self):
+        from dissectBCL.postmux import waitPipeline
+        # The reader is done, nothing will read what the writer writes.
+        start = time.perf_counter()
+        assert waitPipeline(self.procs(30, 0), grace=0.1) == (-9, 0)
+        assert time.perf_counter() - start < 10
+
+
+class Test_clmpRunner():
+    def runner(self, tmp_path, monkeypatch, stream=True, failClump=False, failSplit=False):
+        import sys
+        from dissectBCL.postmux import clmpRunner
+        bindir = tmp_path / "bin"
+        bindir.mkdir()
+        for tool, script, fail in (
+            ("clumpify.sh", FAKECLUMP, failClump),
+            ("splitFastq", FAKESPLIT, failSplit),
+        ):
+            (bindir / tool).write_text(script.format(python=sys.executable, fail=fail))
+            (bindir / tool).chmod(0o755)
+        monkeypatch.setenv("PATH", str(bindir), prepend=":")
+        sampleDir = tmp_path / "Sample_S1"
+        sampleDir.mkdir()
+        fq = sampleDir / "S1_R1.fastq.gz"
+        fq.write_bytes(gzip.compress(b"".join(fastqRecords(10))))
+        cmd = " ".join([
+            "clumpify.sh", f"in={fq}", "out=tmp.fq.gz",
+            str(sampleDir), "0", "S1", "2", "1" if stream else "0", "splitFastq",
+        ])
+        start = time.perf_counter()
+        codes = clmpRunner(cmd)
+        assert time.perf_counter() - start < 10
+        assert not (sampleDir / "tmp.fq.gz").exists()
+        return codes, fq
+
+    @pytest.mark.parametrize("stream", [True, False])
+    def test_clmpRunner(self, tmp_path, monkeypatch, stream):
+        codes, fq = self.runner(tmp_path, monkeypatch, stream)
+        assert codes == (0, 0)
+        assert gzip.decompress(fq.read_bytes()) == b"".join(fastqRecords(10))
+        # Every splitFastq output ends up under the sample's name.
+        assert sorted(f.name for f in fq.parent.iterdir()) == [
+            "S1.duplicate.txt", "S1_R1.fastq.gz",
+        ]
+
+    def test_clumpify_fails(self, tmp_path, monkeypatch):
+        # splitFastq waits on the FIFO for a writer that never comes.
+        codes, fq = self.runner(tmp_path, monkeypatch, failClump=True)
+        assert codes == (3, -9)
+        assert gzip.decompress(fq.read_bytes()) == b"".join(fastqRecords(10))
+        assert [f.name for f in fq.parent.iterdir()] == ["S1_R1.fastq.gz"]
+
+    def test_splitFastq_fails(self, tmp_path, monkeypatch):
+        # clumpify can't open the FIFO without a reader, it's killed.
+        (exitcode, exitcode_split), fq = self.runner(
+            tmp_path, monkeypatch, failSplit=True
+        )
+        assert exitcode == -9
+        assert exitcode_split == 4
+        assert gzip.decompress(fq.read_bytes()) == b"".join(fastqRecords(10))
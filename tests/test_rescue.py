@@ -0,0 +1,231 @@
+import gzip
+import json
+
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+from dissectBCL.demux import readDemuxSheet
+from dissectBCL.flowcellIndex import outputState
+from dissectBCL.rescue import barcodeLookupClass, headerBarcode, rescue, rescueSamples
+
+FLOWCELL = "210608_A00931_0309_BHCCMWDRXY"
+SHEETHEAD = (
+    "[Header],,,\n"
+    "FileFormatVersion,2,,\n"
+    ",,,\n"
+    "[BCLConvert_Settings],,,\n"
+    "BarcodeMismatchesIndex1,1,,\n"
+    "BarcodeMismatchesIndex2,1,,\n"
+    "OverrideCycles,Y51;I8;I8;Y51,,\n"
+    ",,,\n"
+    "[BCLConvert_Data],,,,,,\n"
+    "Lane,Sample_ID,index,index2,Sample_Project\n"
+)
+
+
+def fastq(reads):
+    return "".join(
+        f"@A00931:309:HCCMWDRXY:1:1101:{i}:1000 {r}:N:0:{bc}\nACGT\n+\nFFFF\n"
+        for i, (bc, r) in enumerate(reads)
+    ).encode()
+
+
+def readFastq(path):
+    with gzip.open(path, "rt") as f:
+        return [line.rstrip().split(":")[-1] for line in f if line.startswith("@")]
+
+
+@pytest.fixture
+def outLane(tmp_path):
+    lane = tmp_path / f"{FLOWCELL}_lanes_1"
+    other = tmp_path / f"{FLOWCELL}_lanes_2"
+    for d in (lane / "Logs", lane / "Reports", other / "Logs"):
+        d.mkdir(parents=True)
+    # S1 was sequenced with its P5 reverse complemented, S3 ended up in lane 1.
+    (lane / "demuxSheet.csv").write_text(
+        SHEETHEAD + "1,S1,AAAACCCC,CAGTCAGT,P1\n1,S2,GGGGTTTT,TTGGAACC,P1\n"
+    )
+    (lane / "demuxSheet.suggested.csv").write_text(
+        SHEETHEAD
+        + "1,S1,AAAACCCC,ACTGACTG,P1\n1,S2,GGGGTTTT,TTGGAACC,P1\n"
+        + "1,S3,TTTTCCCC,GGGGAAAA,P2\n"
+    )
+    cols = ["Sample_ID", "Sample_Name", "Sample_Project"]
+    pd.DataFrame([["S1", "name1", "P1"], ["S2", "name2", "P1"]], columns=cols).to_csv(
+        lane / "Logs" / "sampleSheetdf.tsv", sep="\t"
+    )
+    pd.DataFrame([["S3", "name3", "P2"]], columns=cols).to_csv(
+        other / "Logs" / "sampleSheetdf.tsv", sep="\t"
+    )
+    sample = lane / "Project_P1" / "Sample_S1"
+    sample.mkdir(parents=True)
+    for r in ("R1", "R2"):
+        with gzip.open(sample / f"name1_{r}.fastq.gz", "wb") as f:
+            f.write(fastq([("AAAACCCC+CAGTCAGT", r[1])]))
+    und = [
+        "AAAACCCC+ACTGACTG",
+        "CACACACA+CACACACA",
+        "AAAACCCA+ACTGACTG",
+        "TTTTCCCC+GGGGAAAA",
+        "AAAACCCC+ACTGACTG",
+    ]
+    for r in ("R1", "R2"):
+        with gzip.open(lane / f"Undetermined_S0_L001_{r}_001.fastq.gz", "wb") as f:
+            f.write(fastq([(bc, r[1]) for bc in und]))
+    (lane / "Reports" / "Demultiplex_Stats.csv").write_text(
+        "Lane,SampleID,Sample_Project,Index,# Reads,# Perfect Index Reads,"
+        "# One Mismatch Index Reads,% Reads,% Perfect Index Reads\n"
+        "1,S1,P1,AAAACCCC-CAGTCAGT,1,1,0,0.1,1\n"
+        "1,S2,P1,GGGGTTTT-TTGGAACC,4,4,0,0.4,1\n"
+        "1,Undetermined,,,5,5,0,0.5,1\n"
+    )
+    (lane / "Reports" / "Top_Unknown_Barcodes.csv").write_text(
+        "Lane,index,index2,# Reads\n"
+        "1,AAAACCCC,ACTGACTG,2\n"
+        "1,CACACACA,CACACACA,1\n"
+        "1,AAAACCCA,ACTGACTG,1\n"
+        "1,TTTTCCCC,GGGGAAAA,1\n"
+    )
+    fqc = lane / "FASTQC_Project_P1" / "Sample_S1"
+    fqc.mkdir(parents=True)
+    (fqc / "name1_R1_fastqc.zip").touch()
+    (lane / "FASTQC_Project_P1" / "Sample_S2").mkdir()
+    (lane / "Project_P1" / "md5sums.txt").touch()
+    for flag in (".P1.postmux.done", "communication.done", "bclconvert.done"):
+        (lane / flag).touch()
+    return lane
+
+
+class Test_rescue():
+    def test_headerBarcode(self):
+        assert headerBarcode(
+            b"@A00931:309:HCCMWDRXY:2:1101:1000:1000 1:N:0:ACGTACGT+TTGGCCAA\n"
+        ) == ("2", "ACGTACGT", "TTGGCCAA")
+
+    def test_barcodeLookup(self):
+        df = pd.DataFrame({
+            "Sample_ID": ["S1", "S2"],
+            "index": ["AAAAAAAA", "AAAAAACC"],
+            "index2": ["CCCCCCCC", "GGGGGGGG"],
+        })
+        lookup = barcodeLookupClass(df, 1, 1)
+        assert lookup.match("AAAAAAAA", "CCCCCCCC") == ("S1", 0)
+        assert lookup.match("AAAAAAAT", "CCCCCCCA") == ("S1", 2)
+        # Index reads can be longer than the indices.
+        assert lookup.match("AAAAAACCTT", "GGGGGGGGTT") == ("S2", 0)
+        # Within reach of S1 and S2 on P7, P5 decides.
+        assert lookup.match("AAAAAAAC", "GGGGGGGG") == ("S2", 1)
+        assert lookup.match("AAAAAAAC", "TTTTTTTT") is None
+        assert lookup.cache[("AAAAAAAC", "TTTTTTTT")] is None
+        # Single index.
+        lookup = barcodeLookupClass(df[["Sample_ID", "index"]], 0, 0)
+        assert lookup.match("AAAAAACC", "") == ("S2", 0)
+        assert lookup.match("AAAAAACA", "") is None
+
+    def test_rescue(self, outLane):
+        result = CliRunner().invoke(rescue, [str(outLane)])
+        assert result.exit_code == 0, result.output
+        # S1: 2 perfect reads and one with a mismatch, S3 from lane 2.
+        s1 = outLane / "Project_P1" / "Sample_S1"
+        assert readFastq(s1 / "name1_R1.fastq.gz") == [
+            "AAAACCCC+CAGTCAGT",
+            "AAAACCCC+ACTGACTG",
+            "AAAACCCA+ACTGACTG",
+            "AAAACCCC+ACTGACTG",
+        ]
+        assert len(readFastq(s1 / "name1_R2.fastq.gz")) == 4
+        s3 = outLane / "Project_P2" / "Sample_S3" / "name3_R1.fastq.gz"
+        assert readFastq(s3) == ["TTTTCCCC+GGGGAAAA"]
+        assert readFastq(outLane / "Undetermined_S0_L001_R2_001.fastq.gz") == [
+            "CACACACA+CACACACA"
+        ]
+        assert not list(outLane.rglob("*.rescue.tmp"))
+
+        muxdf = pd.read_csv(outLane / "Reports" / "Demultiplex_Stats.csv")
+        muxdf = muxdf.set_index("SampleID")
+        assert muxdf.loc["S1", "# Reads"] == 4
+        assert muxdf.loc["S1", "# Perfect Index Reads"] == 3
+        assert muxdf.loc["S1", "# One Mismatch Index Reads"] == 1
+        assert muxdf.loc["S1", "Index"] == "AAAACCCC-ACTGACTG"
+        assert muxdf.loc["S3", "# Reads"] == 1
+        assert muxdf.loc["S3", "Sample_Project"] == "P2"
+        assert muxdf.loc["Undetermined", "# Reads"] == 1
+        assert muxdf.loc["S2", "% Reads"] == 0.4
+        ubcdf = pd.read_csv(outLane / "Reports" / "Top_Unknown_Barcodes.csv")
+        assert list(ubcdf["index"]) == ["CACACACA"]
+
+        df = readDemuxSheet(outLane / "demuxSheet.csv", what="df").set_index(
+            "Sample_ID"
+        )
+        assert df.loc["S1", "index2"] == "ACTGACTG"
+        assert df.loc["S3", "Lane"] == "1"
+        assert (outLane / "demuxSheet.prerescue.csv").exists()
+
+        # Postmux is redone for the rescued samples only.
+        assert not (outLane / "FASTQC_Project_P1" / "Sample_S1").exists()
+        assert (outLane / "FASTQC_Project_P1" / "Sample_S2").exists()
+        assert not (outLane / "Project_P1" / "md5sums.txt").exists()
+        assert not (outLane / ".P1.postmux.done").exists()
+        assert (outLane / ".P1.rescued").read_text().split() == ["S1"]
+        assert (outLane / ".P2.rescued").read_text().split() == ["S3"]
+        assert not (outLane / "communication.done").exists()
+        assert (outLane / "bclconvert.done").exists()
+        summary = json.loads((outLane / "Reports" / "rescue.json").read_text())
+        assert summary["reads"] == {"S1": 3, "S3": 1}
+
+        # A second run finds nothing left to do.
+        result = CliRunner().invoke(rescue, [str(outLane)])
+        assert result.exit_code == 0
+        assert "Nothing to rescue" in result.output
+
+    def test_rescue_samples_and_mismatches(self, outLane):
+        result = CliRunner().invoke(rescue, [str(outLane), "-s", "S1", "-m", "0"])
+        assert result.exit_code == 0, result.output
+        s1 = outLane / "Project_P1" / "Sample_S1" / "name1_R1.fastq.gz"
+        assert len(readFastq(s1)) == 3
+        assert not (outLane / "Project_P2").exists()
+        assert len(readFastq(outLane / "Undetermined_S0_L001_R1_001.fastq.gz")) == 3
+
+    def test_rescue_single_index(self, outLane):
+        # Single index: no index2 in the demuxSheet, an empty one in the
+        # corrected sheet. Only S1's P7 changed.
+        head = SHEETHEAD.replace("OverrideCycles,Y51;I8;I8;Y51", "OverrideCycles,Y51;I8;Y51")
+        (outLane / "demuxSheet.csv").write_text(
+            head.replace(",index2,", ",")
+            + "1,S1,AAAACCCC,P1\n1,S2,GGGGTTTT,P1\n"
+        )
+        (outLane / "demuxSheet.suggested.csv").write_text(
+            head + "1,S1,GGTTTTCC,,P1\n1,S2,GGGGTTTT,,P1\n"
+        )
+        und = ["GGTTTTCC", "CACACACA", "GGTTTTCA"]
+        for r in ("R1", "R2"):
+            with gzip.open(outLane / f"Undetermined_S0_L001_{r}_001.fastq.gz", "wb") as f:
+                f.write(fastq([(bc, r[1]) for bc in und]))
+        (outLane / "Reports" / "Top_Unknown_Barcodes.csv").write_text(
+            "Lane,index,# Reads\n1,GGTTTTCC,1\n1,CACACACA,1\n1,GGTTTTCA,1\n"
+        )
+        rescuedf = rescueSamples(outLane, outLane / "demuxSheet.suggested.csv")
+        assert list(rescuedf["Sample_ID"]) == ["S1"]
+        assert "index2" not in rescuedf.columns
+
+        result = CliRunner().invoke(rescue, [str(outLane)])
+        assert result.exit_code == 0, result.output
+        s1 = outLane / "Project_P1" / "Sample_S1" / "name1_R1.fastq.gz"
+        assert readFastq(s1)[1:] == ["GGTTTTCC", "GGTTTTCA"]
+        assert readFastq(outLane / "Undetermined_S0_L001_R1_001.fastq.gz") == [
+            "CACACACA"
+        ]
+        assert (outLane / ".P1.rescued").read_text().split() == ["S1"]
+
+    def test_rescue_one_of_two_outlanes(self, outLane):
+        # Both outLanes were shipped, only lanes_1 is rescued: the flowcell
+        # needs work again, lanes_2 is left alone.
+        other = outLane.with_name(f"{FLOWCELL}_lanes_2")
+        (other / "communication.done").touch()
+        assert outputState(outLane.parent, FLOWCELL) == "communicated"
+        result = CliRunner().invoke(rescue, [str(outLane)])
+        assert result.exit_code == 0, result.output
+        assert not (outLane / "communication.done").exists()
+        assert (other / "communication.done").exists()
+        assert outputState(outLane.parent, FLOWCELL) is None
@@ -0,0 +1,95 @@
+import sys
+from pathlib import Path
+
+from dissectBCL.scheduler import (
+    estimateFlowcellSize,
+    flowcellSchedulerClass,
+    parseMemory,
+)
+
+
+def _config(tmp_path, maxConcurrent=2):
+    for d in ("base", "out"):
+        (tmp_path / d).mkdir(exist_ok=True)
+    return {
+        "Dirs": {
+            "baseDir_illumina": str(tmp_path / "base"),
+            "outputDir_illumina": str(tmp_path / "out"),
+        },
+        "misc": {"threads": "40", "memory": "600G", "maxConcurrent": maxConcurrent},
+    }
+
+
+def _flowcell(tmp_path, name, size):
+    fc = tmp_path / "base" / name
+    (fc / "Data").mkdir(parents=True)
+    (fc / "Data" / "L001.cbcl").write_bytes(b"\0" * size)
+    # Thumbnails don't count towards the size.
+    (fc / "Thumbnail_Images").mkdir()
+    (fc / "Thumbnail_Images" / "big.jpg").write_bytes(b"\0" * 10 * size)
+    return (name, fc, "illumina")
+
+
+def _recordJob(config, name, flowcellDir, sequencer, outDir):
+    Path(outDir, f"{name}.txt").write_text(
+        f"{config['misc']['threads']} {config['misc']['memory']}"
+    )
+    if name.endswith("CRASH"):
+        sys.exit(1)
+
+
+class Test_scheduler:
+    def test_parseMemory(self):
+        assert parseMemory("650G") == 650
+        assert parseMemory("2T") == 2048
+        assert parseMemory("64gb") == 64
+
+    def test_size_skips_images(self, tmp_path):
+        _, fc, _ = _flowcell(tmp_path, "260101_A001_0001_AXXX", 100)
+        assert estimateFlowcellSize(fc) == 100
+
+    def test_smallest_first_and_budget_split(self, tmp_path):
+        config = _config(tmp_path)
+        big = _flowcell(tmp_path, "260101_A001_0001_ABIG", 3000)
+        small = _flowcell(tmp_path, "260102_M001_0002_ASMALL", 10)
+        mid = _flowcell(tmp_path, "260103_N001_0003_AMID", 200)
+        scheduler = flowcellSchedulerClass(config, _recordJob, (tmp_path,))
+
+        started = scheduler.submit([big, small, mid])
+        assert started == [small[0], mid[0]]
+        assert scheduler.slots() == 0
+        while scheduler.running:
+            scheduler.reap(timeout=None)
+
+        assert (tmp_path / f"{small[0]}.txt").read_text() == "20 300G"
+        assert (tmp_path / f"{mid[0]}.txt").read_text() == "20 300G"
+        # Alone, the big one still gets its share only.
+        assert scheduler.submit([big]) == [big[0]]
+        while scheduler.running:
+            scheduler.reap(timeout=None)
+        assert (tmp_path / f"{big[0]}.txt").read_text() == "20 300G"
+
+    def test_threads_never_exceed_budget(self, tmp_path):
+        config = _config(tmp_path, maxConcurrent=3)
+        flowcells = [
+            _flowcell(tmp_path, f"26010{i}_A001_000{i}_AFC{i}", 10) for i in range(5)
+        ]
+        scheduler = flowcellSchedulerClass(config, _recordJob, (tmp_path,))
+        # Flowcells arriving one by one, and a few at a time.
+        for batch in ([flowcells[0]], flowcells[1:3], flowcells[3:]):
+            scheduler.submit(batch)
+            assert scheduler.heldThreads() <= 40
+            scheduler.reap(timeout=None)
+            assert scheduler.heldThreads() <= 40
+        while scheduler.running:
+            scheduler.reap(timeout=None)
+
+    def test_crashed_flowcells_are_not_restarted(self, tmp_path):
+        config = _config(tmp_path, maxConcurrent=1)
+        crash = _flowcell(tmp_path, "260101_A001_0001_ACRASH", 10)
+        scheduler = flowcellSchedulerClass(config, _recordJob, (tmp_path,))
+
+        assert scheduler.submit([crash]) == [crash[0]]
+        assert scheduler.reap(timeout=None) == [crash[0]]
+        assert crash[0] in scheduler.crashed
+        assert scheduler.submit([crash]) == []
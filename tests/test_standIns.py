@@ -0,0 +1,127 @@
+import configparser
+import json
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from dissectBCL.fakeNews import mailHome, pullParkour
+from dissectBCL.misc import _resolve_internal_pis, fexUpload
+from tools.standIns import parkourStandInClass, smtpSinkClass, writeFexsend
+
+
+@pytest.fixture
+def standIns(tmp_path):
+    recordings = tmp_path / "recordings"
+    recordings.mkdir()
+    (recordings / "analysis_list_HCCMWDRXY.json").write_text(
+        json.dumps(
+            {
+                "Project_1234_jdoe_Manke": {
+                    "S1": ["lib1", "RNA-seq", "protocol", "mouse", "idx", 10]
+                }
+            }
+        )
+    )
+    parkour = parkourStandInClass(tmp_path / "captured", recordings).start()
+    smtp = smtpSinkClass(tmp_path / "captured").start()
+    config = configparser.ConfigParser()
+    config["Internals"] = {"Organizations": "MPI-IE"}
+    config["parkour"] = {"URL": parkour.url, "user": "u", "password": "p", "cert": ""}
+    config["communication"] = {
+        "subject": "dissectBCL",
+        "fromAddress": "dissect@localhost",
+        "bioinfoCore": "core@localhost",
+        "finishedTo": "a@localhost, b@localhost",
+        "host": smtp.host,
+    }
+    yield parkour, smtp, config
+    parkour.stop()
+    smtp.stop()
+
+
+class Test_standIns:
+    def test_parkour_recordings_and_capture(self, standIns):
+        parkour, _, config = standIns
+
+        assert _resolve_internal_pis(config) == "manke"
+        df = pullParkour("210608_A00931_0309_BHCCMWDRXY", config, aviti=False)
+        assert list(df["Sample_ID"]) == ["S1"]
+        assert df["reqDepth"].iloc[0] == 10_000_000
+
+        captured = parkour.captured()
+        assert [c["path"] for c in captured] == [
+            "/api/internal_pis/",
+            "/api/analysis_list/analysis_list/",
+        ]
+        assert captured[1]["data"] == {"flowcell_id": "HCCMWDRXY"}
+
+    def test_latency_injection(self, tmp_path):
+        parkour = parkourStandInClass(tmp_path / "captured", latency=0.2).start()
+        config = configparser.ConfigParser()
+        config["Internals"] = {"Organizations": "MPI-IE"}
+        config["parkour"] = {"URL": parkour.url, "user": "u", "password": "p", "cert": ""}
+        start = time.monotonic()
+        _resolve_internal_pis(config)
+        parkour.stop()
+        assert time.monotonic() - start >= 0.2
+
+    @patch("dissectBCL.fakeNews.version", return_value="1.0")
+    def test_smtp_sink_captures_mailHome(self, mock_version, standIns):
+        _, smtp, config = standIns
+
+        mailHome("flowcell", "<p>crashed</p>", config, toCore=True)
+        mailHome("flowcell", "<p>done</p>", config)
+
+        mails = smtp.captured()
+        assert [m["to"] for m in mails] == [
+            ["core@localhost"],
+            ["a@localhost", "b@localhost"],
+        ]
+        assert "crashed" in Path(mails[0]["file"]).read_text()
+
+    def test_fexsend_stand_in(self, standIns, tmp_path, monkeypatch):
+        _, _, config = standIns
+        fexsend = writeFexsend(tmp_path / "bin", tmp_path / "fex")
+        monkeypatch.setenv("PATH", str(fexsend.parent), prepend=":")
+        outLane = tmp_path / "210608_A00931_0309_BHCCMWDRXY_lanes_1"
+        project = "Project_1234_jdoe_Manke"
+        sample = outLane / project / "Sample_S1"
+        sample.mkdir(parents=True)
+        (sample / "S1_R1.fastq.gz").write_bytes(b"reads")
+        fastqc = outLane / f"FASTQC_{project}"
+        fastqc.mkdir()
+
+        opas = (outLane / project, fastqc)
+        assert fexUpload(outLane.name, project, "dissect@localhost", opas, config) == (
+            "Uploaded"
+        )
+        assert fexUpload(outLane.name, project, "dissect@localhost", opas, config) == (
+            "Replaced"
+        )
+        uploaded = list((tmp_path / "fex").iterdir())
+        assert [p.name for p in uploaded] == [
+            f"{outLane.name}_{project}_ro_crate.zip"
+        ]
+        assert uploaded[0].stat().st_size > 0
+
+    def test_cli(self, tmp_path):
+        from click.testing import CliRunner
+        from tools.standIns import main
+        ini = tmp_path / "dissectBCL.ini"
+        ini.write_text("[parkour]\nURL = https://parkour\ncert = /cert.pem\n")
+        # Ctrl-C as soon as it waits.
+        with patch("tools.standIns.time.sleep", side_effect=KeyboardInterrupt):
+            result = CliRunner().invoke(
+                main, ["--workdir", str(tmp_path / "work"), "--configfile", str(ini)]
+            )
+        assert result.exit_code == 0, result.output
+        assert "Parkour stand-in: http://127.0.0.1:" in result.output
+        config = configparser.ConfigParser()
+        config.read(tmp_path / "work" / "dissectBCL_standIns.ini")
+        assert config["parkour"]["URL"].startswith("http://127.0.0.1:")
+        assert config["communication"]["host"].startswith("127.0.0.1:")
+        assert (tmp_path / "work" / "bin" / "fexsend").exists()
+        # --workdir is required.
+        assert CliRunner().invoke(main, []).exit_code == 2
@@ -0,0 +1,99 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from dissectBCL.watcher import flowcellWatcherClass
+
+
+def _config(tmp_path):
+    base = tmp_path / "base"
+    base.mkdir()
+    (tmp_path / "out").mkdir()
+    return {
+        "Dirs": {
+            "baseDir_illumina": str(base),
+            "outputDir_illumina": str(tmp_path / "out"),
+            "flowLogDir_illumina": str(tmp_path / "logs"),
+        },
+        "misc": {"pollMin": "1", "pollMax": "8", "settleTime": "1"},
+    }
+
+
+class Test_watcher:
+    def test_inotify_wakes_up_on_copycomplete(self, tmp_path):
+        config = _config(tmp_path)
+        watcher = flowcellWatcherClass(config, "illumina")
+        if watcher.fd is None:
+            pytest.skip("inotify not available here")
+        fc = tmp_path / "base" / "260101_A001_0001_AXXX"
+
+        def sequencer():
+            time.sleep(0.2)
+            fc.mkdir()
+            (fc / "RTAComplete.txt").touch()
+            time.sleep(0.2)
+            (fc / "CopyComplete.txt").touch()
+
+        t = threading.Thread(target=sequencer)
+        start = time.monotonic()
+        t.start()
+        assert watcher.wait()
+        t.join()
+        watcher.close()
+        # Woken up by the event (plus settleTime), not by the 8s safety poll.
+        assert time.monotonic() - start < 5
+        assert str(fc) in watcher.watched
+
+    def test_poll_fallback_backs_off(self, tmp_path):
+        config = _config(tmp_path)
+        watcher = flowcellWatcherClass(config, "illumina", useInotify=False)
+        assert watcher.fd is None
+        with patch("dissectBCL.watcher.time.sleep") as mock_sleep:
+            for _ in range(5):
+                assert not watcher.wait()
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2, 4, 8, 8]
+        watcher.reset()
+        assert watcher.interval == 1
+
+    def test_remote_filesystem_polls(self, tmp_path):
+        config = _config(tmp_path)
+        with patch("dissectBCL.watcher.fsType", return_value="nfs4"):
+            watcher = flowcellWatcherClass(config, "illumina")
+        assert watcher.fd is None
+
+    def test_nested_dirs_arent_watched(self, tmp_path):
+        config = _config(tmp_path)
+        watcher = flowcellWatcherClass(config, "illumina")
+        if watcher.fd is None:
+            pytest.skip("inotify not available here")
+        fc = tmp_path / "base" / "260101_A001_0001_AXXX"
+        watcher.refreshWatches()
+        fc.mkdir()
+        assert watcher.readEvents(1)
+        assert str(fc) in watcher.watched
+        (fc / "Data").mkdir()
+        (fc / "Data" / "C1.1").mkdir()
+        assert not watcher.readEvents(0.2)
+        assert watcher.watched == {str(tmp_path / "base"), str(fc)}
+        watcher.close()
+
+    def test_terminal_flowcells_lose_their_watch(self, tmp_path):
+        from dissectBCL.flowcellIndex import markFlowcell
+        config = _config(tmp_path)
+        watcher = flowcellWatcherClass(config, "illumina")
+        if watcher.fd is None:
+            pytest.skip("inotify not available here")
+        fc = tmp_path / "base" / "260101_A001_0001_AXXX"
+        fc.mkdir()
+        watcher.refreshWatches()
+        assert str(fc) in watcher.watched
+        markFlowcell(config, "illumina", fc.name, "communicated", fc)
+        watcher.refreshWatches()
+        assert watcher.watched == {str(tmp_path / "base")}
+        assert list(watcher.watches.values()) == [tmp_path / "base"]
+        # The kernel's IN_IGNORED for the removed watch is harmless.
+        (fc / "CopyComplete.txt").touch()
+        assert not watcher.readEvents(0.2)
+        watcher.close()